@@ -0,0 +1,192 @@
+"""
+This builds the embedding index of the catalogue images used by the
+similarity search: the normalized penultimate-layer features of every
+image, per model, and for large catalogues the IVF-PQ index over them.
+
+The job is incremental like the precomputation of the predictions: only
+the images that are new or whose content changed since the last run go
+through the model, and the trained quantizer is reused until the
+catalogue has doubled in size. Run it from the repository root:
+
+    python -m app.build_embedding_index
+"""
+import argparse
+import logging
+import math
+import os
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from app.config import Configuration
+from app.ml.embedding_index import (
+    build_ivf,
+    embed_batch,
+    embedding_version,
+    train_quantizer,
+)
+from app.ml.prediction_store import model_store_path, read_manifest, write_store
+from app.precompute_predictions import CatalogueDataset
+from app.utils import file_content_hash, list_images
+
+
+conf = Configuration()
+
+
+def load_previous(model_path, version):
+    """Returns the manifest and the memory-mapped arrays of the previous
+    run, or (None, {}) when the model weights changed."""
+    manifest = read_manifest(model_path)
+    if manifest is None or manifest["weights_version"] != version:
+        return None, {}
+    generation = manifest["generation"]
+    arrays = {
+        file_name[: -len("-{}.npy".format(generation))]: np.load(
+            os.path.join(model_path, file_name), mmap_mode="r"
+        )
+        for file_name in os.listdir(model_path)
+        if file_name.endswith("-{}.npy".format(generation))
+    }
+    return manifest, arrays
+
+
+def save(model_path, version, image_ids, digests, embeddings, ivf=None, **arrays):
+    """Writes the embeddings, and the IVF-PQ arrays if any, to the store."""
+    manifest = {
+        "weights_version": version,
+        "images": {
+            image_id: [row, digests[image_id]] for row, image_id in enumerate(image_ids)
+        },
+        "ivf": ivf,
+    }
+    write_store(model_path, manifest, embeddings=embeddings, **arrays)
+
+
+def quantizer_settings(count, args):
+    """Returns the IVF-PQ settings for a catalogue of count images, or
+    None when it is too small for an IVF index."""
+    if args.ivf_min_images is None or count < args.ivf_min_images:
+        return None
+    return {
+        "lists": args.ivf_lists or max(1, int(4 * math.sqrt(count))),
+        "subvectors": args.pq_subvectors,
+    }
+
+
+def stored_settings(manifest):
+    """Returns the IVF-PQ settings of a stored index, or None."""
+    ivf = (manifest or {}).get("ivf")
+    if ivf is None:
+        return None
+    return {"lists": ivf["lists"], "subvectors": ivf["subvectors"]}
+
+
+def quantizer(embeddings, previous, arrays, args):
+    """Returns the IVF-PQ settings and arrays of the embeddings, reusing
+    the quantizer of the previous run while it still fits the catalogue,
+    or (None, {}) when the catalogue is too small for an IVF index."""
+    count = len(embeddings)
+    settings = quantizer_settings(count, args)
+    if settings is None:
+        return None, {}
+    if (
+        not args.retrain
+        and stored_settings(previous) == settings
+        and count <= 2 * previous["ivf"]["trained_on"]
+    ):
+        centroids = np.asarray(arrays["ivf_centroids"])
+        codebooks = np.asarray(arrays["pq_codebooks"])
+        trained_on = previous["ivf"]["trained_on"]
+    else:
+        logging.info("Training the quantizer on {} embeddings".format(count))
+        centroids, codebooks = train_quantizer(
+            embeddings, settings["lists"], settings["subvectors"]
+        )
+        trained_on = count
+    ivf = dict(settings, trained_on=trained_on)
+    return ivf, build_ivf(embeddings, centroids, codebooks)
+
+
+def build_model_index(model_id, image_ids, digests, args):
+    """Computes the embeddings of the new or changed images with the model
+    and writes the index."""
+    model_path = model_store_path(model_id, args.index_path)
+    version = embedding_version(model_id)
+    previous, arrays = load_previous(model_path, version)
+    previous_images = (previous or {}).get("images", {})
+    todo = [
+        image_id
+        for image_id in image_ids
+        if previous_images.get(image_id, [None, None])[1] != digests[image_id]
+    ]
+    if (
+        not todo
+        and len(previous_images) == len(image_ids)
+        and not args.retrain
+        and stored_settings(previous) == quantizer_settings(len(image_ids), args)
+    ):
+        logging.info("Embeddings of {} are up to date".format(model_id))
+        return
+    logging.info("Embedding {} images with {}".format(len(todo), model_id))
+
+    computed = {}
+    loader = DataLoader(
+        CatalogueDataset(todo, model_id), batch_size=args.batch_size, num_workers=args.workers
+    )
+    done = 0
+    for batch in loader:
+        for image_id, embedding in zip(
+            todo[done : done + len(batch)], embed_batch(model_id, batch)
+        ):
+            computed[image_id] = embedding
+        done += len(batch)
+        logging.info("{}: {}/{} images".format(model_id, done, len(todo)))
+
+    dim = (
+        next(iter(computed.values())).shape[0] if computed else arrays["embeddings"].shape[1]
+    )
+    embeddings = np.empty((len(image_ids), dim), dtype=np.float16)
+    for row, image_id in enumerate(image_ids):
+        if image_id in computed:
+            embeddings[row] = computed[image_id]
+        else:
+            embeddings[row] = arrays["embeddings"][previous_images[image_id][0]]
+    ivf, ivf_arrays = quantizer(embeddings, previous, arrays, args)
+    save(model_path, version, image_ids, digests, embeddings, ivf, **ivf_arrays)
+    logging.info("Embeddings of {} stored in {}".format(model_id, model_path))
+
+
+def build_embedding_index(args):
+    """Builds the embedding index of the selected models."""
+    image_ids = sorted(list_images())
+    digests = {
+        image_id: file_content_hash(os.path.join(conf.image_folder_path, image_id))
+        for image_id in image_ids
+    }
+    for model_id in args.models:
+        build_model_index(model_id, image_ids, digests, args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Builds the embedding index of the catalogue images."
+    )
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--index-path", default=conf.embedding_index_path)
+    parser.add_argument(
+        "--ivf-min-images",
+        type=int,
+        default=conf.embedding_ivf_min_images,
+        help="catalogue size from which the IVF-PQ index is built",
+    )
+    parser.add_argument("--ivf-lists", type=int, default=conf.embedding_ivf_lists)
+    parser.add_argument(
+        "--pq-subvectors", type=int, default=conf.embedding_pq_subvectors
+    )
+    parser.add_argument(
+        "--retrain", action="store_true", help="retrains the IVF-PQ quantizer"
+    )
+    build_embedding_index(parser.parse_args())
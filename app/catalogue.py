@@ -0,0 +1,191 @@
+"""
+This is the in-memory index of the catalogue images. It is built at
+startup and kept up to date by polling the modification times of the
+image folder, so that the routes never list the directory. Each image
+carries its metadata: file size, dimensions, content hash and the label
+id parsed from its file name. The images are named after the WordNet id
+of their class, whose index is looked up in the list of the 1000 Imagenet
+WordNet ids saved by app/prepare_images.py.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from PIL import Image
+
+from app.config import Configuration
+from app.utils import file_content_hash, list_images
+
+
+conf = Configuration()
+
+
+def image_metadata(image_path, stat):
+    """Returns the metadata of an image file."""
+    with Image.open(image_path) as img:
+        width, height = img.size
+    return {
+        "bytes": stat.st_size,
+        "width": width,
+        "height": height,
+        "sha256": file_content_hash(image_path),
+    }
+
+
+IMAGENET_CLASSES = 1000
+
+
+def imagenet_label_ids(image_folder_path, wnids):
+    """Returns the label id of each Imagenet WordNet id, from the
+    imagenet_wnids.json list of the image folder. Without it, the sorted
+    WordNet ids of the images give the label ids only when they cover the
+    1000 classes, as in the full sample set, and no label id is known
+    otherwise."""
+    try:
+        with open(os.path.join(image_folder_path, "imagenet_wnids.json")) as f:
+            wnids = json.load(f)
+    except FileNotFoundError:
+        if len(wnids) != IMAGENET_CLASSES:
+            return {}
+        wnids = sorted(wnids)
+    return {wnid: label_id for label_id, wnid in enumerate(wnids)}
+
+
+class CatalogueIndex:
+    """Sorted index of the catalogue images and their metadata."""
+
+    def __init__(self, image_folder_path, poll_interval):
+        self.image_folder_path = image_folder_path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._image_ids = []
+        self._metadata = {}
+        self._signatures = {}
+        self._poller = None
+        self.version = None
+        self.refreshes = 0
+
+    def refresh(self):
+        """Rescans the image folder, reading the metadata of the new and
+        changed images only. It blocks on disk I/O."""
+        if os.path.isdir(self.image_folder_path):
+            image_ids = sorted(list_images())
+        else:
+            image_ids = []
+        signatures = {}
+        metadata = {}
+        for image_id in image_ids:
+            image_path = os.path.join(self.image_folder_path, image_id)
+            try:
+                stat = os.stat(image_path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            signatures[image_id] = signature
+            if self._signatures.get(image_id) == signature:
+                metadata[image_id] = self._metadata[image_id]
+                continue
+            try:
+                metadata[image_id] = image_metadata(image_path, stat)
+            except OSError:
+                logging.warning("Skipping unreadable image {}".format(image_id))
+                del signatures[image_id]
+
+        image_ids = [image_id for image_id in image_ids if image_id in metadata]
+        label_ids = imagenet_label_ids(
+            self.image_folder_path,
+            {image_id.split("_")[0] for image_id in image_ids},
+        )
+        for image_id in image_ids:
+            wnid = image_id.split("_")[0]
+            metadata[image_id] = dict(
+                metadata[image_id],
+                image_id=image_id,
+                wnid=wnid,
+                label_id=label_ids.get(wnid),
+            )
+
+        digest = hashlib.sha256()
+        for image_id in image_ids:
+            digest.update(image_id.encode())
+            digest.update(metadata[image_id]["sha256"].encode())
+            digest.update(str(metadata[image_id]["label_id"]).encode())
+        with self._lock:
+            self._image_ids = image_ids
+            self._metadata = metadata
+            self._signatures = signatures
+            self.version = digest.hexdigest()[:16]
+            self.refreshes += 1
+
+    def _ensure_loaded(self):
+        if self.version is None:
+            self.refresh()
+
+    def images(self):
+        """Returns the sorted list of the image ids."""
+        self._ensure_loaded()
+        return self._image_ids
+
+    def metadata(self, image_id):
+        """Returns the metadata of an image, or None."""
+        self._ensure_loaded()
+        return self._metadata.get(image_id)
+
+    def __contains__(self, image_id):
+        self._ensure_loaded()
+        return image_id in self._metadata
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._image_ids)
+
+    def search(self, prefix="", offset=0, limit=None):
+        """Returns the number of images whose id starts with the prefix
+        and the metadata of the requested page of them."""
+        self._ensure_loaded()
+        with self._lock:
+            image_ids = self._image_ids
+            metadata = self._metadata
+        start = bisect.bisect_left(image_ids, prefix)
+        # "\U0010ffff" sorts after every character that can follow the prefix
+        end = bisect.bisect_left(image_ids, prefix + "\U0010ffff")
+        total = end - start
+        stop = end if limit is None else min(end, start + offset + limit)
+        page = [metadata[image_id] for image_id in image_ids[start + offset : stop]]
+        return total, page
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                logging.exception("Catalogue refresh failed")
+
+    async def start(self):
+        """Builds the index and starts polling the image folder."""
+        await asyncio.to_thread(self.refresh)
+        if self.poll_interval:
+            self._poller = asyncio.get_running_loop().create_task(self._poll())
+
+    async def stop(self):
+        """Stops polling the image folder."""
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    def stats(self):
+        """Returns the index metrics."""
+        return {
+            "images": len(self._image_ids),
+            "version": self.version,
+            "refreshes": self.refreshes,
+        }
+
+
+catalogue = CatalogueIndex(conf.image_folder_path, conf.catalogue_poll_seconds)
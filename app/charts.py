@@ -0,0 +1,95 @@
+"""
+This renders the charts exported by the service. It uses the
+object-oriented Figure API on the Agg canvas instead of the global pyplot
+state machine, so every chart has its own figure and concurrent renders
+never share state. Charts are rendered in the worker pools and memoized
+by the hash of their payload.
+"""
+import hashlib
+import json
+from io import BytesIO
+
+from app.config import Configuration
+from app.executor import executor
+from app.metrics import timed
+from app.utils import ByteLRUCache, LazyModule
+
+
+conf = Configuration()
+
+# matplotlib is only imported by the processes that render charts
+figure = LazyModule("matplotlib.figure")
+
+SCORE_COLORS = ["#1a4a04", "#750014", "#795703", "#06216c", "#3f0355"]
+CHANNEL_COLORS = {
+    "blue": "#0000ff",
+    "green": "#00ff00",
+    "red": "#ff0000",
+    "hue": "#3f0355",
+    "saturation": "#795703",
+    "value": "#363a3f",
+    "luma": "#363a3f",
+}
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def save_figure(fig, image_format):
+    """Returns the figure encoded in the given format."""
+    buffer = BytesIO()
+    fig.tight_layout()
+    # SVG output does not embed the creation date, so it is deterministic
+    metadata = {"Date": None} if image_format == "svg" else None
+    fig.savefig(buffer, format=image_format, metadata=metadata)
+    return buffer.getvalue()
+
+
+def render_scores_chart(scores, image_format="png"):
+    """Returns the horizontal bar chart of the classification scores,
+    given as a list of (label_name, score)."""
+    labels = [item[0] for item in scores]
+    data = [item[1] for item in scores]
+
+    fig = figure.Figure()
+    ax = fig.add_subplot()
+    ax.barh(labels, data, color=SCORE_COLORS[: len(labels)] or None)
+    ax.grid()
+    ax.set_title("Classification Scores")
+    ax.invert_yaxis()
+    return save_figure(fig, image_format)
+
+
+def render_histogram_chart(histograms, image_format="png"):
+    """Returns the line chart of the histograms, given as a dictionary
+    channel name -> counts."""
+    fig = figure.Figure(figsize=(8, 4))
+    ax = fig.add_subplot()
+    for name, counts in histograms.items():
+        ax.plot(counts, color=CHANNEL_COLORS.get(name), label=name)
+    ax.set_xlim(0, max(len(counts) for counts in histograms.values()) - 1)
+    ax.grid()
+    ax.legend()
+    ax.set_title("Histogram of the Image")
+    return save_figure(fig, image_format)
+
+
+RENDERERS = {"scores": render_scores_chart, "histogram": render_histogram_chart}
+
+chart_cache = ByteLRUCache(conf.chart_cache_mb)
+
+
+def chart_key(kind, payload, image_format):
+    """Returns the cache key of a chart, the hash of its payload."""
+    data = json.dumps([kind, payload, image_format], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+async def render_chart(kind, payload, image_format="png", key=None):
+    """Returns the encoded chart, rendering it in the worker pools on a
+    cache miss. The key defaults to the hash of the payload."""
+    key = key or chart_key(kind, payload, image_format)
+    data = chart_cache.get(key)
+    if data is None:
+        with timed("chart_render"):
+            data = await executor.run_process(RENDERERS[kind], payload, image_format)
+        chart_cache.put(key, data)
+    return data
@@ -14,3 +14,165 @@ class Configuration:
         "vgg16",
         "inception_v3",
     )
+
+    # model registry
+    # maximum memory (in MB) used by the resident models, None means no limit
+    model_memory_budget_mb = None
+    # models loaded and warmed up with a dummy forward pass at startup
+    warmup_models = ()
+    # heavy modules are imported on their first use, so that the web
+    # process starts fast; the ones listed here are imported on startup
+    # instead, e.g. ("torch", "torchvision", "cv2", "matplotlib.figure")
+    preload_modules = ()
+
+    # micro-batching of the classification requests
+    batch_max_size = 8
+    batch_max_wait_ms = 5.0
+    # pending requests per model before the server answers 503
+    batch_queue_depth = 64
+
+    # execution layer for the blocking work of the routes
+    thread_pool_workers = min(8, os.cpu_count() or 1)
+    # workers for the PIL-heavy work, 0 runs it in the thread pool instead
+    process_pool_workers = 0
+    # queued and running tasks before the server answers 503
+    max_pending_tasks = 32
+    retry_after_seconds = 1
+
+    # inference options of the models, the "default" entry applies to the
+    # models without a specific one
+    #   inference_mode: runs the forward pass under torch.inference_mode()
+    #   channels_last: uses the channels-last memory format
+    #   quantize: dynamic int8 quantization of the linear layers
+    #             (only alexnet and vgg16, where they dominate the cost)
+    #   compile: None, "jit" (traced and cached on disk) or "compile"
+    inference_options = {
+        "default": {
+            "inference_mode": True,
+            "channels_last": False,
+            "quantize": False,
+            "compile": None,
+        },
+    }
+    compiled_models_path = os.path.join(project_root, "compiled_models")
+    # torch intra-op and inter-op threads, None keeps the torch defaults
+    torch_num_threads = None
+    torch_interop_threads = None
+
+    # classification results cache
+    # results kept in memory, 0 disables the cache
+    result_cache_size = 4096
+    # SQLite file of the persistent tier, None keeps the results in memory only
+    result_cache_db_path = None
+
+    # predictions of the catalogue images computed by precompute_predictions.py
+    prediction_store_path = os.path.join(project_root, "predictions")
+    precompute_top_k = 10
+
+    # cache of the decoded and cropped catalogue images, stored as
+    # memory-mapped uint8 arrays, None disables it
+    tensor_cache_path = os.path.join(project_root, "tensor_cache")
+
+    # number of classification scores returned for each image
+    top_k = 5
+
+    # batch classification API
+    batch_chunk_size = 32
+    batch_max_images = 1000
+
+    # histograms memoized per image content
+    histogram_cache_size = 2048
+
+    # encoded transformation previews kept in memory
+    transformation_cache_mb = 64
+    transformation_jpeg_quality = 90
+
+    # scratch storage of the uploaded files
+    scratch_path = os.path.join(project_root, "static/uploads")
+    scratch_max_mb = 256
+    scratch_ttl_seconds = 300
+    scratch_sweep_interval_seconds = 10
+
+    # uploads
+    upload_max_mb = 20
+    # bytes of an uploaded file kept in memory before spilling to disk
+    upload_spool_mb = 1
+    # stores the uploaded files in the scratch storage to show them back
+    upload_persist = True
+
+    # catalogue index, rescanned for changes at this interval
+    catalogue_poll_seconds = 5
+    catalogue_page_size = 50
+
+    # rendered charts kept in memory
+    chart_cache_mb = 32
+
+    # results kept server-side and referenced by their id
+    result_store_size = 1024
+    result_ttl_seconds = 3600
+
+    # asynchronous jobs, kept in SQLite and run by a worker pool per lane;
+    # interactive jobs never wait behind the batch ones
+    jobs_db_path = os.path.join(project_root, "jobs.sqlite3")
+    job_workers = {"interactive": 4, "batch": 1}
+    job_timeout_seconds = 300
+    job_retention_seconds = 3600
+    job_poll_seconds = 1.0
+    job_max_queued = 1000
+    job_heartbeat_seconds = 15
+
+    # models served by dedicated inference processes, as model id ->
+    # number of replicas, e.g. {"vgg16": 2}; the others run in the web
+    # process. The tensors are exchanged through shared memory
+    model_worker_processes = {}
+    # Unix socket of the model server (`python -m app.model_server`), which
+    # runs the replicas above once for all the HTTP workers; None starts
+    # them in every HTTP worker instead
+    model_server_address = None
+    model_worker_max_batch = 32
+    model_worker_start_timeout_seconds = 300
+    model_worker_timeout_seconds = 60
+    model_worker_health_seconds = 5
+
+    # per-stage timings and the Prometheus /metrics endpoint; when
+    # disabled the instrumentation costs nothing
+    metrics_enabled = True
+
+    # inference backend of each model: "torch" (eager, with the inference
+    # options above), "torchscript" or "onnxruntime", the last two serving
+    # the graphs exported by `python -m app.export_models`
+    inference_backends = {}
+    exported_models_path = os.path.join(project_root, "exported_models")
+    # ONNX Runtime session settings, None keeps the runtime defaults
+    onnxruntime_intra_op_threads = None
+    onnxruntime_inter_op_threads = None
+    onnxruntime_graph_optimization = "all"
+
+    # nearest-neighbour search over the embeddings of the catalogue images,
+    # built by `python -m app.build_embedding_index`
+    embedding_index_path = os.path.join(project_root, "embeddings")
+    similar_images_k = 10
+    similar_images_max_k = 100
+    # catalogues from this size also get an IVF-PQ index, None disables it
+    embedding_ivf_min_images = 50000
+    # inverted lists of the IVF index, None uses about 4 * sqrt(images)
+    embedding_ivf_lists = None
+    # bytes of the product-quantized code of each image, it must divide
+    # the embedding size (512 to 4096 for the configured models)
+    embedding_pq_subvectors = 32
+    # lists scanned per query, 0 always searches exactly
+    embedding_ivf_probes = 16
+    # candidates of the IVF search re-ranked exactly, per requested result
+    embedding_rerank_factor = 10
+
+    # derivative images of the pages, as size bucket -> longest side in
+    # pixels, cached on disk per source content, size and format
+    thumbnail_sizes = {"small": 128, "medium": 256, "large": 512}
+    thumbnail_quality = 85
+    thumbnail_cache_path = os.path.join(project_root, "thumbnails")
+    thumbnail_cache_max_mb = 512
+    thumbnail_cache_ttl_seconds = 7 * 24 * 3600
+    thumbnail_sweep_interval_seconds = 600
+    # browser cache lifetime of the catalogue thumbnails, which are
+    # revalidated with their ETag; the others never change
+    thumbnail_max_age_seconds = 3600
@@ -0,0 +1,111 @@
+"""
+This is the execution layer that keeps the blocking work of the routes
+off the event loop. Torch and OpenCV release the GIL, so they run in a
+bounded thread pool, while the PIL-heavy work can optionally run in a
+process pool. When too many tasks are pending new ones are rejected,
+so that the server answers 503 instead of queuing without bounds.
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+
+class Overloaded(Exception):
+    """Raised when the server cannot accept more work."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = (
+            conf.retry_after_seconds if retry_after is None else retry_after
+        )
+
+
+class ExecutionLayer:
+    """Runs blocking functions in bounded worker pools."""
+
+    def __init__(self, thread_workers, process_workers=0, max_pending=32):
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.max_pending = max_pending
+        self._thread_pool = None
+        self._process_pool = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def thread_pool(self):
+        """Returns the thread pool, creating it on the first use."""
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.thread_workers, thread_name_prefix="worker"
+            )
+        return self._thread_pool
+
+    @property
+    def process_pool(self):
+        """Returns the process pool, creating it on the first use."""
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.process_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._process_pool
+
+    async def _submit(self, pool, fn, *args, **kwargs):
+        # the counter is only touched from the event loop, so it needs no lock
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded("Too many pending tasks")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                pool, functools.partial(fn, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs the function in the thread pool."""
+        return await self._submit(self.thread_pool, fn, *args, **kwargs)
+
+    async def run_process(self, fn, *args, **kwargs):
+        """Runs the function in the process pool, or in the thread pool
+        when the process pool is disabled. The function and its arguments
+        must be picklable."""
+        if self.process_workers <= 0:
+            return await self.run(fn, *args, **kwargs)
+        return await self._submit(self.process_pool, fn, *args, **kwargs)
+
+    def shutdown(self):
+        """Stops the worker pools."""
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = None
+
+    def stats(self):
+        """Returns the execution layer metrics."""
+        return {
+            "thread_workers": self.thread_workers,
+            "process_workers": self.process_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+executor = ExecutionLayer(
+    conf.thread_pool_workers, conf.process_pool_workers, conf.max_pending_tasks
+)
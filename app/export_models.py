@@ -0,0 +1,99 @@
+"""
+This exports the classification models to the graphs served by the
+"torchscript" and "onnxruntime" inference backends. The models are built
+from the locally cached torchvision weights, so run prepare_models.py
+first. The exported files are named after the weights, and a model is
+only exported again when they change or with --force. Run it from the
+repository root:
+
+    python -m app.export_models --backends onnxruntime torchscript
+"""
+import argparse
+import logging
+import os
+import tempfile
+
+import torch
+
+from app.config import Configuration
+from app.ml.backends import EXTENSIONS, exported_model_path
+from app.ml.inference_options import input_size
+from app.ml.model_registry import build_model
+
+
+conf = Configuration()
+
+
+def export_onnx(model, path, size, opset):
+    """Exports the model to ONNX with a dynamic batch dimension."""
+    torch.onnx.export(
+        model,
+        torch.zeros(1, 3, size, size),
+        path,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+        opset_version=opset,
+    )
+
+
+def export_torchscript(model, path, size):
+    """Exports the frozen TorchScript trace of the model."""
+    with torch.no_grad():
+        traced = torch.jit.freeze(
+            torch.jit.trace(model, torch.zeros(1, 3, size, size))
+        )
+    torch.jit.save(traced, path)
+
+
+def export_model(model_id, backends, args):
+    """Exports the model for each of the backends."""
+    todo = [
+        backend
+        for backend in backends
+        if args.force
+        or not os.path.exists(exported_model_path(model_id, backend, args.export_path))
+    ]
+    if not todo:
+        logging.info("{} is already exported".format(model_id))
+        return
+    model = build_model(model_id).eval()
+    size = input_size(model_id)
+    os.makedirs(args.export_path, exist_ok=True)
+    for backend in todo:
+        path = exported_model_path(model_id, backend, args.export_path)
+        # written aside and renamed, so the server never loads a partial file
+        fd, tmp_path = tempfile.mkstemp(
+            dir=args.export_path, prefix=".tmp-", suffix=EXTENSIONS[backend]
+        )
+        os.close(fd)
+        try:
+            if backend == "onnxruntime":
+                export_onnx(model, tmp_path, size, args.opset)
+            else:
+                export_torchscript(model, tmp_path, size)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logging.info("{} exported for {} to {}".format(model_id, backend, path))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Exports the models for the inference backends."
+    )
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=sorted(EXTENSIONS),
+        default=["onnxruntime", "torchscript"],
+    )
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--export-path", default=conf.exported_models_path)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    for model_id in args.models:
+        export_model(model_id, args.backends, args)
@@ -1,5 +1,8 @@
 from fastapi import Request
 
+from app.catalogue import catalogue
+from app.config import Configuration
+
 
 class ClassificationForm:
     def __init__(self, request: Request) -> None:
@@ -7,16 +10,21 @@ class ClassificationForm:
         self.errors: list = []
         self.image_id: str = ""
         self.model_id: str = ""
+        self.model_ids: list = []
+        self.ensemble: bool = False
 
     async def load_data(self):
         form = await self.request.form()
         self.image_id = form.get("image_id")
         self.model_id = form.get("model_id")
+        self.model_ids = form.getlist("model_ids")
+        self.ensemble = form.get("ensemble") is not None
 
     def is_valid(self):
-        if not self.image_id or not isinstance(self.image_id, str):
+        if not isinstance(self.image_id, str) or self.image_id not in catalogue:
             self.errors.append("A valid image id is required")
-        if not self.model_id or not isinstance(self.model_id, str):
+        model_ids = self.model_ids if len(self.model_ids) > 1 else [self.model_id]
+        if any(model_id not in Configuration.models for model_id in model_ids):
             self.errors.append("A valid model id is required")
         if not self.errors:
             return True
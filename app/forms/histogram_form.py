@@ -1,5 +1,7 @@
 from fastapi import Request
 
+from app.catalogue import catalogue
+
 
 class HistogramForm:
     def __init__(self, request: Request) -> None:
@@ -12,7 +14,7 @@ class HistogramForm:
         self.image_id = form.get("image_id")
 
     def is_valid(self):
-        if not self.image_id or not isinstance(self.image_id, str):
+        if not isinstance(self.image_id, str) or self.image_id not in catalogue:
             self.errors.append("A valid image id is required")
         if not self.errors:
             return True
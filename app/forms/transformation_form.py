@@ -1,5 +1,8 @@
 from fastapi import Request
 
+from app.catalogue import catalogue
+from app.config import Configuration
+
 
 class TransformationForm:
     def __init__(self, request: Request) -> None:
@@ -16,14 +19,23 @@ class TransformationForm:
         form = await self.request.form()
         self.image_id = form.get("image_id")
         self.model_id = form.get("model_id")
-        self.color = float(form.get("color"))
-        self.brightness = float(form.get("brightness"))
-        self.contrast = float(form.get("contrast"))
-        self.sharpness = float(form.get("sharpness"))
+        try:
+            self.color = float(form.get("color"))
+            self.brightness = float(form.get("brightness"))
+            self.contrast = float(form.get("contrast"))
+            self.sharpness = float(form.get("sharpness"))
+        except (TypeError, ValueError):
+            self.errors.append("The enhancement factors must be numbers")
 
     def is_valid(self):
-        if not self.image_id or not isinstance(self.image_id, str):
+        if not isinstance(self.image_id, str) or self.image_id not in catalogue:
             self.errors.append("A valid image id is required")
+        if self.model_id is not None and self.model_id not in Configuration.models:
+            self.errors.append("A valid model id is required")
+        factors = (self.color, self.brightness, self.contrast, self.sharpness)
+        # the comparisons also reject nan
+        if not all(0 <= factor <= 10 for factor in factors):
+            self.errors.append("The enhancement factors must be between 0 and 10")
         if not self.errors:
             return True
         return False
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+This registers the kinds of jobs run by the job queue: the classification
+of catalogue images, single or in batches, the classification of uploaded
+files and the image transformations. Each handler stores its outcome in
+the result store, so that the download endpoints serve it by result id.
+The outcome is recreated from the job once it has expired from the store
+or was lost in a restart, so its result id lasts as long as the job.
+"""
+import re
+
+from app.catalogue import catalogue
+from app.config import Configuration
+from app.executor import executor
+from app.job_queue import JobError, job_queue
+from app.ml.classification_service import (
+    classify_catalogue_chunk,
+    classify_catalogue_image,
+    classify_upload,
+)
+from app.ml.transformation_utils import transformation_bytes
+from app.result_store import result_store
+from app.scratch_store import SCRATCH_NAME, scratch_store
+from app.utils import file_content_hash
+
+
+conf = Configuration()
+
+FACTORS = ("color", "brightness", "contrast", "sharpness")
+SHA256 = re.compile(r"[0-9a-f]{64}")
+
+
+def check_model(params):
+    if params.get("model_id") not in conf.models:
+        raise JobError(f"Unknown model {params.get('model_id')}")
+
+
+def check_images(image_ids):
+    if not all(isinstance(image_id, str) for image_id in image_ids):
+        raise JobError("Image ids must be strings")
+    unknown = {image_id for image_id in image_ids if image_id not in catalogue}
+    if unknown:
+        raise JobError(f"Unknown images: {', '.join(sorted(map(str, unknown)))}")
+
+
+def validate_classification(params):
+    check_model(params)
+    check_images([params.get("image_id")])
+
+
+def validate_batch(params):
+    check_model(params)
+    image_ids = params.get("image_ids")
+    if not isinstance(image_ids, list) or not 0 < len(image_ids) <= conf.batch_max_images:
+        raise JobError(f"A batch must contain 1 to {conf.batch_max_images} images")
+    check_images(image_ids)
+
+
+def validate_upload(params):
+    check_model(params)
+    image_id, digest = params.get("image_id"), params.get("digest")
+    if not isinstance(image_id, str) or not isinstance(digest, str):
+        raise JobError("Missing uploaded file")
+    # the file must be the one stored in the scratch storage under the
+    # digest, which keys its result in the result cache
+    if (
+        not SCRATCH_NAME.fullmatch(image_id)
+        or not SHA256.fullmatch(digest)
+        or not image_id.startswith(digest[:32])
+    ):
+        raise JobError("Invalid uploaded file")
+
+
+def validate_transformation(params):
+    check_images([params.get("image_id")])
+    for factor in FACTORS:
+        value = params.get(factor, 1.0)
+        if not isinstance(value, (int, float)) or not 0 <= value <= 10:
+            raise JobError("Factors must be numbers between 0 and 10")
+
+
+def transformation_factors(params):
+    return {factor: float(params.get(factor, 1.0)) for factor in FACTORS}
+
+
+def classification_result(model_id, image_id, scores):
+    result_id = result_store.put(
+        "classification",
+        {"image_id": image_id, "model_id": model_id, "scores": scores},
+    )
+    return {"result_id": result_id, "scores": scores}
+
+
+@job_queue.handler("classification", validate_classification)
+async def run_classification(params, progress):
+    model_id, image_id = params["model_id"], params["image_id"]
+    scores = await classify_catalogue_image(model_id, image_id)
+    return classification_result(model_id, image_id, scores)
+
+
+@job_queue.handler("batch_classification", validate_batch)
+async def run_batch_classification(params, progress):
+    model_id, image_ids = params["model_id"], params["image_ids"]
+    size = conf.batch_chunk_size
+    results = []
+    for start in range(0, len(image_ids), size):
+        chunk = image_ids[start : start + size]
+        try:
+            scores = await executor.run(classify_catalogue_chunk, model_id, chunk)
+        except Exception as e:
+            scores = [e] * len(chunk)
+        for image_id, result in zip(chunk, scores):
+            if isinstance(result, Exception):
+                results.append({"image_id": image_id, "error": str(result)})
+            else:
+                results.append({"image_id": image_id, "scores": result})
+        await progress(len(results) / len(image_ids))
+    return {"model_id": model_id, "results": results}
+
+
+@job_queue.handler("upload_classification", validate_upload)
+async def run_upload_classification(params, progress):
+    model_id, image_id = params["model_id"], params["image_id"]
+    path = scratch_store.path(image_id)
+    # the upload waits in the scratch storage, which may have swept it
+    try:
+        # the digest keys the result cache, so it is computed from the file
+        digest = await executor.run(file_content_hash, path)
+        upload = open(path, "rb")
+    except FileNotFoundError:
+        raise FileNotFoundError("The uploaded file has expired")
+    if digest != params["digest"]:
+        upload.close()
+        raise JobError("The uploaded file does not match its digest")
+    with upload:
+        scores = await classify_upload(model_id, upload, digest)
+    return classification_result(model_id, image_id, scores)
+
+
+@job_queue.handler("transformation", validate_transformation)
+async def run_transformation(params, progress):
+    factors = transformation_factors(params)
+    await transformation_bytes(params["image_id"], **factors)
+    result_id = result_store.put(
+        "transformation", dict(factors, image_id=params["image_id"])
+    )
+    return {"result_id": result_id, "image_url": f"/download_image/{result_id}"}
+
+
+@result_store.loader
+def load_job_result(result_id):
+    """Returns the result stored by a finished job, recreated from its
+    parameters and its outcome, or None."""
+    job = job_queue.find_result(result_id)
+    if job is None:
+        return None
+    params = job["params"]
+    if job["kind"] == "transformation":
+        return "transformation", dict(
+            transformation_factors(params), image_id=params["image_id"]
+        )
+    return "classification", {
+        "image_id": params["image_id"],
+        "model_id": params["model_id"],
+        "scores": job["result"]["scores"],
+    }
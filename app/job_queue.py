@@ -0,0 +1,373 @@
+"""
+This is the queue of the long-running work. A job is submitted with a kind
+and its JSON parameters and gets an id immediately, while a pool of
+workers per priority lane runs it in the background. Jobs are kept in
+SQLite, so the queued ones survive a restart, and clients follow them by
+polling or through Server-Sent Events. Jobs can time out and be
+cancelled, and finished jobs are removed after a retention period.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from app.config import Configuration
+from app.executor import Overloaded
+from app.metrics import Histogram
+
+
+conf = Configuration()
+
+LANES = ("interactive", "batch")
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, TIMEOUT = (
+    "queued",
+    "running",
+    "done",
+    "failed",
+    "cancelled",
+    "timeout",
+)
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+COLUMNS = (
+    "id",
+    "kind",
+    "lane",
+    "priority",
+    "status",
+    "params",
+    "result",
+    "error",
+    "progress",
+    "timeout",
+    "created",
+    "started",
+    "finished",
+)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class JobError(Exception):
+    """Raised by a job handler when the parameters of a job are invalid."""
+
+
+class JobQueue:
+    """Persistent job queue with priority lanes and a worker pool."""
+
+    def __init__(
+        self, db_path, workers, timeout, retention, poll_interval, max_queued
+    ):
+        self.db_path = db_path
+        self.workers = dict(workers)
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self._db = None
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._running = {}
+        self._cancelling = set()
+        self._wakeup = {}
+        self._changed = None
+        self._loop = None
+        self.counters = {status: 0 for status in FINISHED}
+        self.wait_seconds = Histogram(WAIT_BUCKETS)
+        self.run_seconds = Histogram(WAIT_BUCKETS)
+
+    def handler(self, kind, validate=None):
+        """Registers the coroutine function running the jobs of a kind. It
+        is called with the parameters and an async progress(fraction)
+        callback and returns the JSON result. validate(params) checks the
+        parameters on submission and raises JobError when invalid."""
+
+        def register(fn):
+            self.handlers[kind] = (fn, validate)
+            return fn
+
+        return register
+
+    def _connection(self):
+        # the connection is shared by the event loop and the worker threads
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT, lane TEXT, priority INTEGER,
+                    status TEXT, params TEXT, result TEXT, error TEXT,
+                    progress REAL, timeout REAL, created REAL, started REAL,
+                    finished REAL)"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs "
+                "(lane, status, priority DESC, created)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_result ON jobs "
+                "(json_extract(result, '$.result_id'))"
+            )
+            self._db.commit()
+        return self._db
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            db = self._connection()
+            rows = db.execute(query, args).fetchall()
+            db.commit()
+            return rows
+
+    def _job(self, row):
+        job = dict(zip(COLUMNS, row))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def get(self, job_id):
+        """Returns the job as a dictionary, or None."""
+        rows = self._execute(
+            f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+        )
+        return self._job(rows[0]) if rows else None
+
+    def find_result(self, result_id):
+        """Returns the finished job whose result has the result id, or None."""
+        rows = self._execute(
+            f"SELECT {', '.join(COLUMNS)} FROM jobs "
+            "WHERE json_extract(result, '$.result_id') = ? AND status = ?",
+            (result_id, DONE),
+        )
+        return self._job(rows[0]) if rows else None
+
+    def depth(self):
+        """Returns the number of queued and running jobs per lane."""
+        depth = {lane: {QUEUED: 0, RUNNING: 0} for lane in LANES}
+        rows = self._execute(
+            "SELECT lane, status, COUNT(*) FROM jobs "
+            "WHERE status IN (?, ?) GROUP BY lane, status",
+            (QUEUED, RUNNING),
+        )
+        for lane, status, count in rows:
+            depth.setdefault(lane, {QUEUED: 0, RUNNING: 0})[status] = count
+        return depth
+
+    def submit(self, kind, params, lane="interactive", priority=0, timeout=None):
+        """Queues a job and returns its id. It raises JobError when the
+        kind, the lane or the parameters are invalid, and Overloaded when
+        too many jobs are queued."""
+        if kind not in self.handlers:
+            raise JobError(f"Unknown job kind {kind}")
+        if lane not in LANES:
+            raise JobError(f"Unknown lane {lane}")
+        validate = self.handlers[kind][1]
+        if validate is not None:
+            validate(params)
+        queued = self._execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,))
+        if queued[0][0] >= self.max_queued:
+            raise Overloaded("Too many queued jobs")
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, kind, lane, priority, status, params, "
+            "progress, timeout, created) VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+            (
+                job_id,
+                kind,
+                lane,
+                priority,
+                QUEUED,
+                json.dumps(params),
+                timeout or self.timeout,
+                time.time(),
+            ),
+        )
+        # it may be called from a worker thread
+        if lane in self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup[lane].set)
+        return job_id
+
+    def _claim(self, lane):
+        # the claim is a single statement, so two workers never get the same job
+        rows = self._execute(
+            f"""UPDATE jobs SET status = ?, started = ? WHERE id = (
+                SELECT id FROM jobs WHERE lane = ? AND status = ?
+                ORDER BY priority DESC, created LIMIT 1)
+            RETURNING {', '.join(COLUMNS)}""",
+            (RUNNING, time.time(), lane, QUEUED),
+        )
+        return self._job(rows[0]) if rows else None
+
+    def _finish(self, job_id, status, result=None, error=None):
+        # it blocks on SQLite, so it runs in a worker thread
+        rows = self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, "
+            "progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END "
+            "WHERE id = ? AND status IN (?, ?) RETURNING id",
+            (
+                status,
+                None if result is None else json.dumps(result),
+                error,
+                time.time(),
+                status,
+                job_id,
+                QUEUED,
+                RUNNING,
+            ),
+        )
+        return bool(rows)
+
+    async def _finished(self, job_id, status, result=None, error=None):
+        """Records the end of a job unless it already finished, and returns
+        whether it did."""
+        finished = await asyncio.to_thread(
+            self._finish, job_id, status, result, error
+        )
+        if finished:
+            self.counters[status] += 1
+        self._notify()
+        return finished
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    def next_change(self):
+        """Returns the event set on the next change of any job. Taking it
+        before reading a job ensures that no change is missed."""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    async def _run(self, job):
+        fn, _ = self.handlers[job["kind"]]
+        last_progress = [0.0]
+
+        async def progress(fraction):
+            # rate limited, so that chatty handlers do not hammer the database
+            if fraction - last_progress[0] >= 0.01 or fraction >= 1:
+                last_progress[0] = fraction
+                await asyncio.to_thread(
+                    self._execute,
+                    "UPDATE jobs SET progress = ? WHERE id = ?",
+                    (fraction, job["id"]),
+                )
+                self._notify()
+
+        self.wait_seconds.observe(job["started"] - job["created"])
+        task = asyncio.ensure_future(fn(job["params"], progress))
+        self._running[job["id"]] = task
+        try:
+            result = await asyncio.wait_for(task, job["timeout"])
+        except asyncio.TimeoutError:
+            await self._finished(job["id"], TIMEOUT, error="The job timed out")
+        except asyncio.CancelledError:
+            # a shutdown leaves the job running, so that it is requeued
+            if job["id"] not in self._cancelling:
+                raise
+            await self._finished(job["id"], CANCELLED, error="The job was cancelled")
+        except Exception as e:
+            logging.exception("Job %s failed", job["id"])
+            await self._finished(job["id"], FAILED, error=str(e))
+        else:
+            await self._finished(job["id"], DONE, result=result)
+        finally:
+            self._running.pop(job["id"], None)
+            self._cancelling.discard(job["id"])
+            self.run_seconds.observe(time.time() - job["started"])
+
+    async def _worker(self, lane):
+        wakeup = self._wakeup[lane]
+        while True:
+            job = await asyncio.to_thread(self._claim, lane)
+            if job is None:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._notify()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Job worker failed")
+
+    async def cancel(self, job_id):
+        """Cancels a queued or running job. It returns False when the job
+        is unknown or already finished. The blocking work already handed
+        to the worker pools runs to completion, but its result is
+        dropped."""
+        task = self._running.get(job_id)
+        if task is not None and not task.done():
+            self._cancelling.add(job_id)
+            task.cancel()
+            return True
+        return await self._finished(job_id, CANCELLED, error="The job was cancelled")
+
+    def purge(self):
+        """Removes the jobs finished before the retention period."""
+        self._execute(
+            f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED))}) "
+            "AND finished < ?",
+            (*FINISHED, time.time() - self.retention),
+        )
+
+    async def _run_purger(self):
+        while True:
+            await asyncio.sleep(min(self.retention, 60))
+            try:
+                await asyncio.to_thread(self.purge)
+            except Exception:
+                logging.exception("Job purge failed")
+
+    async def start(self):
+        """Requeues the jobs interrupted by a previous shutdown and starts
+        the workers."""
+        self._changed = asyncio.Event()
+        await asyncio.to_thread(self.purge)
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, started = NULL, progress = 0 "
+            "WHERE status = ?",
+            (QUEUED, RUNNING),
+        )
+        loop = self._loop = asyncio.get_running_loop()
+        for lane in LANES:
+            self._wakeup[lane] = asyncio.Event()
+            for _ in range(self.workers.get(lane, 0)):
+                self._tasks.append(loop.create_task(self._worker(lane)))
+        self._tasks.append(loop.create_task(self._run_purger()))
+
+    async def stop(self):
+        """Stops the workers. The running jobs are requeued on the next
+        start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = {}
+
+    def stats(self):
+        """Returns the queue metrics."""
+        return {
+            "depth": self.depth(),
+            "workers": self.workers,
+            "running": len(self._running),
+            "finished": dict(self.counters),
+            "wait_seconds": self.wait_seconds.snapshot(),
+            "run_seconds": self.run_seconds.snapshot(),
+        }
+
+
+job_queue = JobQueue(
+    conf.jobs_db_path,
+    conf.job_workers,
+    conf.job_timeout_seconds,
+    conf.job_retention_seconds,
+    conf.job_poll_seconds,
+    conf.job_max_queued,
+)
@@ -0,0 +1,296 @@
+"""
+This contains the metric types used to expose the runtime behaviour
+of the service, their Prometheus text rendering and the timing helper
+used to measure the stages of the pipelines. When the metrics are
+disabled in the configuration the helper does nothing.
+"""
+import bisect
+import functools
+import inspect
+import os
+import resource
+import sys
+import threading
+import time
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def process_rss_bytes():
+    """Returns the resident set size of the current process, or its peak
+    when the current one is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, Linux kilobytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Histogram:
+    """Counts the observed values in cumulative buckets, keeping also
+    their count and sum."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records a single value."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Returns the cumulative bucket counts together with the count
+        and the sum of the observed values."""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = {}
+        running = 0
+        for bound, value in zip(self.buckets, counts):
+            running += value
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = count
+        return {"buckets": cumulative, "count": count, "sum": total}
+
+
+def escape_label(value):
+    """Escapes a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    """Returns the labels in the Prometheus text format."""
+    if not labels:
+        return ""
+    pairs = (f'{name}="{escape_label(value)}"' for name, value in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+def render_histogram(name, histogram, labels=None):
+    """Returns the Prometheus samples of a histogram."""
+    labels = labels or {}
+    snapshot = histogram.snapshot()
+    lines = [
+        f"{name}_bucket{format_labels(dict(labels, le=bound))} {count}"
+        for bound, count in snapshot["buckets"].items()
+    ]
+    lines.append(f"{name}_sum{format_labels(labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{format_labels(labels)} {snapshot['count']}")
+    return lines
+
+
+class HistogramFamily:
+    """Histograms sharing a name and told apart by their label values."""
+
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Returns the histogram of the label values, creating it on the
+        first use."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.buckets))
+        return child
+
+    def render(self):
+        """Returns the family in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for values, child in sorted(self._children.items()):
+            lines += render_histogram(
+                self.name, child, dict(zip(self.label_names, values))
+            )
+        return lines
+
+
+class CounterFamily:
+    """Counters sharing a name and told apart by their label values."""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        """Increments the counter of the label values."""
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        """Returns the family in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            labels = dict(zip(self.label_names, label_values))
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+def render_gauge(name, description, samples):
+    """Returns a gauge in the Prometheus text format, given as a list of
+    (labels, value) samples."""
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {float(value)}")
+    return lines
+
+
+stage_seconds = HistogramFamily(
+    "stage_duration_seconds", "Duration of the pipeline stages.", ("stage",)
+)
+request_seconds = HistogramFamily(
+    "http_request_duration_seconds",
+    "Duration of the HTTP requests until the response starts.",
+    ("method", "route", "status"),
+)
+inferences = CounterFamily(
+    "model_inference_images_total", "Images run through each model.", ("model_id",)
+)
+
+
+class Timer:
+    """Records the duration of a block, or of every call of a decorated
+    function, in a histogram."""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+    def __call__(self, fn):
+        histogram = self.histogram
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def timed_coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+
+            return timed_coroutine
+
+        @functools.wraps(fn)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return timed_function
+
+
+class NullTimer:
+    """Stands for the timer when the metrics are disabled: the block runs
+    as is and decorated functions are returned unchanged."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    def __call__(self, fn):
+        return fn
+
+
+NULL_TIMER = NullTimer()
+
+
+def timed(stage):
+    """Returns a context manager, also usable as a decorator, recording
+    the duration of the stage."""
+    if not conf.metrics_enabled:
+        return NULL_TIMER
+    return Timer(stage_seconds.labels(stage))
+
+
+class RequestTimer:
+    """ASGI middleware recording the latency of the HTTP requests until
+    their response starts, labelled by route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        started = False
+
+        def observe(status):
+            # the router stores the matched route in the shared scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - start
+            )
+
+        async def timed_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except Exception:
+            if not started:
+                observe(500)
+            raise
@@ -0,0 +1,109 @@
+"""
+This contains the inference backends of the classification models. The
+default "torch" backend runs the eager torchvision models. The
+"torchscript" and "onnxruntime" backends serve the graphs exported ahead
+of time by `python -m app.export_models`, the latter on the CPU execution
+provider of ONNX Runtime, which is an optional dependency. Backends are
+selected per model in the configuration.
+"""
+import importlib
+import os
+
+import numpy as np
+
+from app.config import Configuration
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+BACKENDS = ("torch", "torchscript", "onnxruntime")
+EXTENSIONS = {"torchscript": ".pt", "onnxruntime": ".onnx"}
+GRAPH_OPTIMIZATIONS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def get_backend(model_id):
+    """Returns the name of the inference backend of the model."""
+    backend = conf.inference_backends.get(model_id, "torch")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown inference backend {}".format(backend))
+    return backend
+
+
+def weights_name(model_id):
+    """Returns the name of the default torchvision weights of the model."""
+    module = importlib.import_module("torchvision.models")
+    return str(module.get_model_weights(model_id).DEFAULT)
+
+
+def exported_model_path(model_id, backend, export_path=None):
+    """Returns the path of the graph of the model exported for the
+    backend. The name of the weights is part of it, so that a graph
+    exported from older weights is never served."""
+    return os.path.join(
+        export_path or conf.exported_models_path,
+        "{}-{}{}".format(model_id, weights_name(model_id), EXTENSIONS[backend]),
+    )
+
+
+def import_onnxruntime():
+    """Returns the onnxruntime module, which is an optional dependency."""
+    try:
+        return importlib.import_module("onnxruntime")
+    except ImportError as e:
+        raise ImportError(
+            "The onnxruntime backend needs ONNX Runtime: pip install onnxruntime"
+        ) from e
+
+
+class OnnxRuntimeModel:
+    """Runs an exported ONNX graph with the CPU execution provider, taking
+    and returning torch tensors like the eager models."""
+
+    def __init__(self, path):
+        ort = import_onnxruntime()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel,
+            GRAPH_OPTIMIZATIONS[conf.onnxruntime_graph_optimization],
+        )
+        options.intra_op_num_threads = (
+            conf.onnxruntime_intra_op_threads or conf.torch_num_threads or 0
+        )
+        if conf.onnxruntime_inter_op_threads:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = conf.onnxruntime_inter_op_threads
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        inputs = np.ascontiguousarray(batch.numpy(), dtype=np.float32)
+        (output,) = self.session.run(None, {self.input_name: inputs})
+        return torch.from_numpy(output)
+
+
+def load_exported(model_id, backend):
+    """Loads the exported graph of the model for the backend and returns
+    it with the size in bytes of its weights."""
+    path = exported_model_path(model_id, backend)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            "{} is not exported for {}, run python -m app.export_models".format(
+                model_id, backend
+            )
+        )
+    size = os.path.getsize(path)
+    if backend == "onnxruntime":
+        return OnnxRuntimeModel(path), size
+    model = torch.jit.load(path)
+    model.eval()
+    return model, size
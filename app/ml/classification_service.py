@@ -0,0 +1,159 @@
+"""
+This ties together the classification of catalogue images and uploaded
+files for the web routes. Catalogue images are answered from the
+precomputed predictions when they are up to date. Otherwise results are
+looked up in the result cache by the hash of the image content, and the
+missing ones are computed by sending the preprocessed images to the
+inference scheduler.
+"""
+import functools
+import json
+import os
+
+from app.config import Configuration
+from app.executor import executor
+from app.ml.classification_utils import classify_batch, preprocess_image
+from app.ml.inference_scheduler import scheduler
+from app.ml.prediction_store import prediction_store
+from app.ml.result_cache import result_cache
+from app.ml.upload_utils import preprocess_upload
+from app.utils import LazyModule, content_hash, file_content_hash
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+def cached_result(model_id, digest):
+    """Returns the cache key of the image content classified by the model
+    and its cached result, or None. The key names the model weights, which
+    imports torchvision, so it blocks and must run in a worker thread."""
+    key = result_cache.key(model_id, digest)
+    result = result_cache.get(key)
+    if result is None and result_cache.persistent:
+        result = result_cache.load(key)
+    return key, result
+
+
+async def cached_classification(model_id, digest, preprocess_fn, *args):
+    """Returns the cached top-5 classification scores of the image
+    content, computing and caching them on a miss."""
+    key, result = await executor.run(cached_result, model_id, digest)
+    if result is not None:
+        return result
+
+    preprocessed = await executor.run(preprocess_fn, *args, model_id)
+    result = await scheduler.classify(model_id, preprocessed)
+    result_cache.put(key, result)
+    if result_cache.persistent:
+        await executor.run(result_cache.store, key, result)
+    return result
+
+
+def lookup_precomputed(model_id, image_id):
+    """Returns the content hash of the catalogue image and its
+    precomputed top-5 classification scores, or None when stale."""
+    digest = file_content_hash(os.path.join(conf.image_folder_path, image_id))
+    return digest, prediction_store.lookup(model_id, image_id, digest)
+
+
+async def classify_catalogue_image(model_id, image_id):
+    """Returns the top-5 classification scores of a catalogue image."""
+    digest, result = await executor.run(lookup_precomputed, model_id, image_id)
+    if result is not None:
+        return result
+    return await cached_classification(model_id, digest, preprocess_image, image_id)
+
+
+async def classify_upload(model_id, upload, digest=None):
+    """Returns the top-5 classification scores of an uploaded image, given
+    as bytes or as the file object it was spooled to with its digest."""
+    if digest is None:
+        digest = content_hash(upload)
+    return await cached_classification(model_id, digest, preprocess_upload, upload)
+
+
+def classify_chunk(model_id, items):
+    """Returns the top-k classification scores of a chunk of images given
+    as (digest, loader) pairs, where loader(model_id) returns the
+    preprocessed image. The cached results are reused and the missing
+    ones are computed as a single tensor batch. An image that cannot be
+    preprocessed gets its exception in place of the scores. It blocks,
+    so it must run in a worker thread."""
+    results = [None] * len(items)
+    todo = []
+    for i, (digest, _) in enumerate(items):
+        _, result = cached_result(model_id, digest)
+        if result is None:
+            todo.append(i)
+        else:
+            results[i] = result
+
+    tensors = []
+    computed = []
+    for i in todo:
+        try:
+            tensors.append(items[i][1](model_id))
+            computed.append(i)
+        except Exception as e:
+            results[i] = e
+
+    if computed:
+        batch = torch.stack(tensors)
+        for i, result in zip(computed, classify_batch(model_id, batch)):
+            results[i] = result
+            key = result_cache.key(model_id, items[i][0])
+            result_cache.put(key, result)
+            if result_cache.persistent:
+                result_cache.store(key, result)
+    return results
+
+
+def classify_catalogue_chunk(model_id, image_ids):
+    """Returns the top-k classification scores of a chunk of catalogue
+    images, answering from the precomputed predictions when possible."""
+    results = [None] * len(image_ids)
+    todo = []
+    for i, image_id in enumerate(image_ids):
+        digest, results[i] = lookup_precomputed(model_id, image_id)
+        if results[i] is None:
+            todo.append((i, digest, functools.partial(preprocess_image, image_id)))
+    computed = classify_chunk(model_id, [(digest, loader) for _, digest, loader in todo])
+    for (i, _, _), result in zip(todo, computed):
+        results[i] = result
+    return results
+
+
+def classify_upload_chunk(model_id, uploads):
+    """Returns the top-k classification scores of a chunk of uploaded
+    images, given as ingested files."""
+    items = [
+        (upload.digest, functools.partial(preprocess_upload, upload.file))
+        for upload in uploads
+    ]
+    return classify_chunk(model_id, items)
+
+
+async def stream_batch(model_id, names, chunk_fn, inputs):
+    """Classifies the inputs in chunks of batch_chunk_size with
+    chunk_fn(model_id, chunk) and yields one NDJSON line per image as
+    soon as its chunk completes. Images that fail, alone or with their
+    whole chunk, yield an error line and the following ones are still
+    processed."""
+    size = conf.batch_chunk_size
+    for start in range(0, len(inputs), size):
+        chunk_names = names[start : start + size]
+        try:
+            results = await executor.run(chunk_fn, model_id, inputs[start : start + size])
+        except Exception as e:
+            results = [e] * len(chunk_names)
+        lines = []
+        for name, result in zip(chunk_names, results):
+            line = {"image_id": name, "model_id": model_id}
+            if isinstance(result, Exception):
+                line["error"] = str(result)
+            else:
+                line["scores"] = result
+            lines.append(json.dumps(line) + "\n")
+        yield "".join(lines)
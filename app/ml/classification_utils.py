@@ -2,19 +2,28 @@
 This is a simple classification service. It accepts an url of an
 image and returns the top-5 classification labels and scores.
 """
-import importlib
-import json
-import logging
 import os
-import torch
 from PIL import Image
-from torchvision import transforms
 
 from app.config import Configuration
+from app.metrics import inferences, timed
+from app.ml.inference_options import (
+    get_inference_options,
+    inference_context,
+    input_size,
+    prepare_batch,
+)
+from app.ml.model_registry import registry
+from app.ml.model_workers import model_workers
+from app.ml.postprocessing import label_table, top_k
+from app.ml.preprocessing import preprocess_file, preprocess_sizes, tensor_cache
+from app.utils import LazyModule
 
 
 conf = Configuration()
 
+torch = LazyModule("torch")
+
 
 def fetch_image(image_id):
     """Gets the image from the specified ID. It returns only images
@@ -27,59 +36,82 @@ def fetch_image(image_id):
 def get_labels():
     """Returns the labels of Imagenet dataset as a list, where
     the index of the list corresponds to the output class."""
-    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
-    with open(labels_path) as f:
-        labels = json.load(f)
-    return labels
+    return label_table().tolist()
 
 
 def get_model(model_id):
-    """Imports a pretrained model from the ones that are specified in
-    the configuration file. This is needed as we want to pre-download the
-    specified model in order to avoid unnecessary waits for the user."""
-    if model_id in conf.models:
-        try:
-            module = importlib.import_module("torchvision.models")
-            return module.__getattribute__(model_id)(weights="DEFAULT")
-        except ImportError:
-            logging.error("Model {} not found".format(model_id))
-    else:
-        raise ImportError
+    """Returns a pretrained model from the ones that are specified in
+    the configuration file. Models are loaded once and kept resident
+    by the model registry, already in eval mode."""
+    return registry.get(model_id)
 
 
-def classify_image(model_id, img_id):
-    """Returns the top-5 classification score output from the
-    model specified in model_id when it is fed with the
-    image corresponding to img_id."""
-    img = fetch_image(img_id)
+def preprocess_image(image_id, model_id):
+    """Returns the normalized tensor of the image corresponding to
+    image_id, as expected by the model and without the batch dimension.
+    Catalogue images are served from the tensor cache when enabled."""
+    size = input_size(model_id)
+    if tensor_cache is not None:
+        return tensor_cache.get(image_id, size)
+    return preprocess_file(os.path.join(conf.image_folder_path, image_id), size)
+
+
+def preprocess_image_sizes(image_id, sizes):
+    """Returns the normalized tensors of the image corresponding to
+    image_id for several input sizes, decoding it at most once."""
+    if tensor_cache is not None:
+        return {size: tensor_cache.get(image_id, size) for size in sizes}
+    return preprocess_sizes(os.path.join(conf.image_folder_path, image_id), sizes)
+
+
+def local_forward(model_id, batch):
+    """Returns the output of the model for the batch, computed in this
+    process without tracking the gradients."""
     model = get_model(model_id)
-    model.eval()
-    transform = transforms.Compose(
-        (
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        )
-    )
+    options = get_inference_options(model_id)
+    with inference_context(options):
+        return model(prepare_batch(batch, options))
 
-    # apply transform from torchvision
-    img = img.convert("RGB")
-    preprocessed = transform(img).unsqueeze(0)
 
-    # gets the output from the model
-    out = model(preprocessed)
-    _, indices = torch.sort(out, descending=True)
+def local_features(model_id, batch):
+    """Returns the penultimate-layer features of the model for the batch,
+    computed in this process by its feature extractor."""
+    with torch.inference_mode():
+        return registry.get(model_id, "features")(batch)
 
-    # transforms scores as percentages
-    percentage = torch.nn.functional.softmax(out, dim=1)[0] * 100
 
-    # gets the labels
-    labels = get_labels()
+def forward_features(model_id, batch):
+    """Returns the penultimate-layer features of the model for the batch,
+    computed by its inference processes when it has some."""
+    if model_workers.serves(model_id):
+        return model_workers.forward(model_id, batch, features=True)
+    return local_features(model_id, batch)
 
-    # takes the top-5 classification output and returns it
+
+@timed("forward")
+def forward(model_id, batch):
+    """Returns the output of the model for the batch, computed by its
+    inference processes when it has some."""
+    inferences.inc(model_id, amount=len(batch))
+    if model_workers.serves(model_id):
+        return model_workers.forward(model_id, batch)
+    return local_forward(model_id, batch)
+
+
+def classify_batch(model_id, batch):
+    """Returns the top-k classification scores for each image of the
+    batch, as a list of lists of (label_name, score)."""
+    out = forward(model_id, batch)
+
+    # takes the top-k classification output of each image and returns it
     # as a list of tuples (label_name, score)
-    output = [[labels[idx], percentage[idx].item()] for idx in indices[0][:5]]
+    return top_k(out)
+
 
-    img.close()
-    return output
+def classify_image(model_id, img_id):
+    """Returns the top-5 classification score output from the
+    model specified in model_id when it is fed with the
+    image corresponding to img_id."""
+    # apply transform from torchvision
+    preprocessed = preprocess_image(img_id, model_id).unsqueeze(0)
+    return classify_batch(model_id, preprocessed)[0]
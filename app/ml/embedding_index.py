@@ -0,0 +1,334 @@
+"""
+This is the index of the embeddings of the catalogue images, used to find
+the images similar to a catalogue image or to an uploaded file. The
+embeddings are the penultimate-layer features of a model, L2-normalized
+and stored per model as a memory-mapped float16 matrix, with a manifest
+mapping every image to its row like the prediction store. A query is
+answered by a matrix product with all the rows, or, for large catalogues,
+through an inverted-file index of product-quantized codes (IVF-PQ) whose
+best candidates are then re-ranked exactly.
+"""
+import os
+import threading
+
+import numpy as np
+
+from app.config import Configuration
+from app.executor import executor
+from app.metrics import timed
+from app.ml.backends import weights_name
+from app.ml.classification_utils import forward_features, preprocess_image
+from app.ml.model_registry import preprocessing_name
+from app.ml.prediction_store import MANIFEST, model_store_path, read_manifest
+from app.ml.upload_utils import preprocess_upload
+
+
+conf = Configuration()
+
+# rows multiplied at once, bounding the float32 copy of the float16 rows
+SEARCH_CHUNK_ROWS = 8192
+IVF_ARRAYS = ("ivf_centroids", "pq_codebooks", "ivf_offsets", "ivf_rows", "pq_codes")
+
+
+def embedding_version(model_id):
+    """Returns a string identifying the weights and the preprocessing the
+    embeddings of the model are computed with."""
+    return "{}+penultimate+{}".format(
+        weights_name(model_id), preprocessing_name(model_id)
+    )
+
+
+def normalize_rows(features):
+    """Returns the rows scaled to unit L2 norm."""
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-12)
+
+
+@timed("embed")
+def embed_batch(model_id, batch):
+    """Returns the normalized embeddings of a batch of preprocessed
+    images as a float32 array."""
+    features = forward_features(model_id, batch)
+    return normalize_rows(features.flatten(1).float().numpy())
+
+
+def embed_image(model_id, image_id):
+    """Returns the normalized embedding of a catalogue image."""
+    return embed_batch(model_id, preprocess_image(image_id, model_id).unsqueeze(0))[0]
+
+
+def embed_upload(model_id, upload):
+    """Returns the normalized embedding of an uploaded image, given as
+    bytes or as the file object it was spooled to."""
+    return embed_batch(model_id, preprocess_upload(upload, model_id).unsqueeze(0))[0]
+
+
+def nearest(points, centroids):
+    """Returns the index of the centroid closest to each point."""
+    squared_norms = (centroids**2).sum(axis=1)
+    assignment = np.empty(len(points), dtype=np.int32)
+    for start in range(0, len(points), SEARCH_CHUNK_ROWS):
+        chunk = points[start : start + SEARCH_CHUNK_ROWS]
+        distances = squared_norms - 2 * chunk @ centroids.T
+        assignment[start : start + len(chunk)] = distances.argmin(axis=1)
+    return assignment
+
+
+def kmeans(points, k, iterations=20, seed=0):
+    """Returns k centroids of the points found by Lloyd's algorithm. The
+    clusters left empty are reseeded with random points."""
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(points, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        centroids[~filled] = points[rng.choice(len(points), (~filled).sum())]
+    return centroids
+
+
+def train_quantizer(embeddings, lists, subvectors, sample_size=25600, seed=0):
+    """Trains the coarse centroids of the inverted lists and the product
+    quantization codebooks of the residuals on a sample of the rows. It
+    returns the centroids (lists, dim) and the codebooks (subvectors,
+    codes, dim / subvectors)."""
+    count, dim = embeddings.shape
+    if dim % subvectors:
+        raise ValueError(
+            "{} subvectors do not divide the dimension {}".format(subvectors, dim)
+        )
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(count, min(count, sample_size), replace=False))
+    points = np.asarray(embeddings[sample], dtype=np.float32)
+    centroids = kmeans(points, min(lists, len(points)), seed=seed)
+    residuals = points - centroids[nearest(points, centroids)]
+    residuals = residuals.reshape(len(points), subvectors, dim // subvectors)
+    codes = min(256, len(points))
+    codebooks = np.stack(
+        [kmeans(residuals[:, j], codes, seed=seed) for j in range(subvectors)]
+    )
+    return centroids, codebooks
+
+
+def build_ivf(embeddings, centroids, codebooks):
+    """Assigns every row to its inverted list and encodes its residual.
+    The rows are stored grouped by list: the rows of list l are
+    ivf_rows[ivf_offsets[l]:ivf_offsets[l + 1]], and pq_codes holds their
+    codes in the same order."""
+    count, dim = embeddings.shape
+    subvectors = len(codebooks)
+    lists = np.empty(count, dtype=np.int32)
+    codes = np.empty((count, subvectors), dtype=np.uint8)
+    for start in range(0, count, SEARCH_CHUNK_ROWS):
+        chunk = np.asarray(embeddings[start : start + SEARCH_CHUNK_ROWS], np.float32)
+        stop = start + len(chunk)
+        lists[start:stop] = nearest(chunk, centroids)
+        residuals = (chunk - centroids[lists[start:stop]]).reshape(
+            len(chunk), subvectors, dim // subvectors
+        )
+        for j in range(subvectors):
+            codes[start:stop, j] = nearest(residuals[:, j], codebooks[j])
+    rows = np.argsort(lists, kind="stable").astype(np.int32)
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lists, minlength=len(centroids)), out=offsets[1:])
+    return {
+        "ivf_centroids": centroids.astype(np.float32),
+        "pq_codebooks": codebooks.astype(np.float32),
+        "ivf_offsets": offsets,
+        "ivf_rows": rows,
+        "pq_codes": codes[rows],
+    }
+
+
+def best(rows, scores, k):
+    """Returns the k (row, score) pairs with the highest scores."""
+    if len(scores) > k:
+        selected = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[selected], scores[selected]
+    order = np.argsort(-scores, kind="stable")
+    return rows[order], scores[order]
+
+
+class EmbeddingIndex:
+    """Serves the nearest-neighbour queries over the catalogue embeddings,
+    reloading a model directory when the build job updates it."""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._models = {}
+        self._lock = threading.Lock()
+        self.exact_queries = 0
+        self.ivf_queries = 0
+        self.stale = 0
+        self.missing = 0
+
+    def _load(self, model_id):
+        model_path = model_store_path(model_id, self.store_path)
+        try:
+            mtime = os.stat(os.path.join(model_path, MANIFEST)).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            loaded = self._models.get(model_id)
+            if loaded is not None and loaded["mtime"] == mtime:
+                return loaded
+            manifest = read_manifest(model_path)
+            if manifest is None:
+                return None
+            names = ("embeddings",) + (IVF_ARRAYS if manifest.get("ivf") else ())
+            loaded = {
+                name: np.load(
+                    os.path.join(
+                        model_path, "{}-{}.npy".format(name, manifest["generation"])
+                    ),
+                    mmap_mode="r",
+                )
+                for name in names
+            }
+            loaded.update(
+                mtime=mtime,
+                manifest=manifest,
+                image_ids=sorted(
+                    manifest["images"], key=lambda image_id: manifest["images"][image_id][0]
+                ),
+            )
+            self._models[model_id] = loaded
+        return loaded
+
+    def _current(self, model_id):
+        """Returns the loaded index of the model, or None when it was not
+        built or was built with other weights."""
+        loaded = self._load(model_id)
+        if loaded is None:
+            self.missing += 1
+            return None
+        if loaded["manifest"]["weights_version"] != embedding_version(model_id):
+            self.stale += 1
+            return None
+        return loaded
+
+    def load(self, model_ids):
+        """Opens the indexes of the models, e.g. at startup. The matrices
+        are memory-mapped, so only the manifests are read."""
+        for model_id in model_ids:
+            self._load(model_id)
+
+    def available(self, model_id):
+        """Tells whether the index of the model is built and current."""
+        return self._current(model_id) is not None
+
+    def vector(self, model_id, image_id, digest):
+        """Returns the stored embedding of a catalogue image, or None when
+        it is not indexed or was computed from other content."""
+        loaded = self._current(model_id)
+        entry = None if loaded is None else loaded["manifest"]["images"].get(image_id)
+        if entry is None or entry[1] != digest:
+            return None
+        return np.asarray(loaded["embeddings"][entry[0]], dtype=np.float32)
+
+    def _exact(self, loaded, query):
+        embeddings = loaded["embeddings"]
+        scores = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), SEARCH_CHUNK_ROWS):
+            chunk = embeddings[start : start + SEARCH_CHUNK_ROWS]
+            scores[start : start + len(chunk)] = chunk.astype(np.float32) @ query
+        return np.arange(len(embeddings)), scores
+
+    def _ivf(self, loaded, query, k):
+        centroids = loaded["ivf_centroids"]
+        codebooks = loaded["pq_codebooks"]
+        offsets = loaded["ivf_offsets"]
+        subvectors, codes, width = codebooks.shape
+        coarse = np.asarray(centroids) @ query
+        probes = min(conf.embedding_ivf_probes, len(centroids))
+        probed = np.argpartition(-coarse, probes - 1)[:probes]
+        # the inner product with a row is the one with its list centroid
+        # plus the one with its residual, read from the table of the
+        # query against every codeword
+        table = np.einsum("jcw,jw->jc", codebooks, query.reshape(subvectors, width))
+        rows = []
+        scores = []
+        for list_id in probed:
+            start, stop = offsets[list_id], offsets[list_id + 1]
+            list_codes = loaded["pq_codes"][start:stop]
+            rows.append(loaded["ivf_rows"][start:stop])
+            scores.append(
+                coarse[list_id] + table[np.arange(subvectors), list_codes].sum(axis=1)
+            )
+        rows, scores = best(
+            np.concatenate(rows), np.concatenate(scores), k * conf.embedding_rerank_factor
+        )
+        rows = np.sort(rows)
+        return rows, loaded["embeddings"][rows].astype(np.float32) @ query
+
+    @timed("similarity_search")
+    def search(self, model_id, query, k, exclude=None):
+        """Returns the k catalogue images most similar to the normalized
+        query embedding as a list of (image_id, cosine similarity), or
+        None when the index of the model is not available. The image
+        named by exclude, usually the query itself, is left out."""
+        loaded = self._current(model_id)
+        if loaded is None:
+            return None
+        query = np.asarray(query, dtype=np.float32)
+        excluded = loaded["manifest"]["images"].get(exclude, [None])[0]
+        wanted = k if excluded is None else k + 1
+        if loaded["manifest"].get("ivf") and conf.embedding_ivf_probes:
+            self.ivf_queries += 1
+            rows, scores = self._ivf(loaded, query, wanted)
+        else:
+            self.exact_queries += 1
+            rows, scores = self._exact(loaded, query)
+        rows, scores = best(rows, scores, wanted)
+        image_ids = loaded["image_ids"]
+        return [
+            (image_ids[row], float(score))
+            for row, score in zip(rows, scores)
+            if row != excluded
+        ][:k]
+
+    def stats(self):
+        """Returns the index metrics."""
+        return {
+            "loaded_models": {
+                model_id: {
+                    "images": len(loaded["image_ids"]),
+                    "dim": loaded["embeddings"].shape[1],
+                    "ivf": bool(loaded["manifest"].get("ivf")),
+                }
+                for model_id, loaded in self._models.items()
+            },
+            "exact_queries": self.exact_queries,
+            "ivf_queries": self.ivf_queries,
+            "stale": self.stale,
+            "missing": self.missing,
+        }
+
+
+embedding_index = EmbeddingIndex(conf.embedding_index_path)
+
+
+async def similar_to_catalogue_image(model_id, image_id, digest, k):
+    """Returns the catalogue images most similar to a catalogue image,
+    using its stored embedding when it is up to date, or None when the
+    index of the model is not available."""
+    # the index is loaded and checked against the weights of the model,
+    # which imports torchvision, in a worker thread
+    if not await executor.run(embedding_index.available, model_id):
+        return None
+    query = await executor.run(embedding_index.vector, model_id, image_id, digest)
+    if query is None:
+        query = await executor.run(embed_image, model_id, image_id)
+    return await executor.run(embedding_index.search, model_id, query, k, image_id)
+
+
+async def similar_to_upload(model_id, upload, k):
+    """Returns the catalogue images most similar to an uploaded image, or
+    None when the index of the model is not available."""
+    if not await executor.run(embedding_index.available, model_id):
+        return None
+    query = await executor.run(embed_upload, model_id, upload)
+    return await executor.run(embedding_index.search, model_id, query, k)
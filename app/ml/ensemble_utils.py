@@ -0,0 +1,62 @@
+"""
+This classifies an image with several models in a single pass. The image
+is decoded once and the shared tensors are fanned out to the models,
+which run concurrently in the worker threads. The per-model scores are
+returned with their latency, together with the optional ensemble scores
+obtained by averaging the class probabilities of the models.
+"""
+import asyncio
+import time
+
+from app.config import Configuration
+from app.executor import executor
+from app.ml.classification_utils import forward, preprocess_image_sizes
+from app.ml.inference_options import input_size
+from app.ml.postprocessing import percentages, top_k_percentages
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+def timed_percentages(model_id, tensor):
+    """Returns the class percentages of a single image and the latency
+    of the forward pass in milliseconds."""
+    start = time.perf_counter()
+    out = forward(model_id, tensor.unsqueeze(0))
+    latency = (time.perf_counter() - start) * 1000
+    return percentages(out), latency
+
+
+async def classify_ensemble(model_ids, image_id, ensemble=True):
+    """Returns the top-k classification scores of the catalogue image
+    for each model, with the latency of its forward pass, and optionally
+    the scores of the models ensemble."""
+    for model_id in model_ids:
+        if model_id not in conf.models:
+            raise ImportError("Model {} is not available".format(model_id))
+    sizes = sorted({input_size(model_id) for model_id in model_ids})
+    tensors = await executor.run(preprocess_image_sizes, image_id, sizes)
+
+    outputs = await asyncio.gather(
+        *(
+            executor.run(timed_percentages, model_id, tensors[input_size(model_id)])
+            for model_id in model_ids
+        )
+    )
+    response = {
+        "image_id": image_id,
+        "models": {
+            model_id: {
+                "scores": top_k_percentages(percentage)[0],
+                "latency_ms": latency,
+            }
+            for model_id, (percentage, latency) in zip(model_ids, outputs)
+        },
+    }
+    if ensemble:
+        mean = torch.stack([percentage for percentage, _ in outputs]).mean(dim=0)
+        response["ensemble"] = top_k_percentages(mean)[0]
+    return response
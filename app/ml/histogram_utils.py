@@ -1,33 +1,46 @@
 """
-This generates the three color histograms of an image. It accepts an url of an
-image and returns the three histograms.
+This generates the color histograms of the images. All the channels are
+counted in one pass with a single np.bincount over the binned pixels,
+offset by channel. Histograms support a configurable number of bins, the
+BGR, HSV and luma color spaces and normalized or cumulative modes, and
+can be aggregated over a list of images. The counts are memoized per
+image content hash.
 """
-import importlib
-import json
-import logging
 import os
-import torch
-from PIL import Image
-from torchvision import transforms
-import cv2 as cv
+import threading
+from collections import OrderedDict
+
+import numpy as np
 
 from app.config import Configuration
+from app.metrics import timed
+from app.utils import LazyModule, file_content_hash
 
 
 conf = Configuration()
 
+cv = LazyModule("cv2")
 
-def fetch_image(image_id):
-    """Gets the image from the specified ID. It returns only images
-    downloaded in the folder specified in the configuration object."""
-    image_path = os.path.join(conf.image_folder_path, image_id)
-    img = Image.open(image_path)
-    return img
+# channel names and value ranges of the supported color spaces, in the
+# order of the OpenCV channels
+COLOR_SPACES = {
+    "rgb": (("blue", "green", "red"), (256, 256, 256)),
+    "hsv": (("hue", "saturation", "value"), (180, 256, 256)),
+    "luma": (("luma",), (256,)),
+}
 
 
-def histogram(img_id):
-    """Return the histograms for the three color (R, G, B) channel of the image."""
-    img_path = f'app/static/imagenet_subset/{img_id}'
+def image_path(img_id):
+    """Returns the path of a catalogue image, refusing ids that point
+    outside of the image folder."""
+    if os.path.basename(img_id) != img_id:
+        raise ValueError(f"Invalid image id: {img_id}")
+    return os.path.join(conf.image_folder_path, img_id)
+
+
+@timed("histogram_decode")
+def read_image(img_path):
+    """Reads the image in BGR order."""
     img = cv.imread(img_path)
 
     if img is None:
@@ -36,11 +49,119 @@ def histogram(img_id):
     if img.size == 0:
         raise ValueError(f"The image at path: {img_path} is empty or invalid")
 
-    histr_r = cv.calcHist([img], [2], None, [256], [0, 256])
-    histr_r = histr_r.flatten().tolist()
-    histr_g = cv.calcHist([img], [1], None, [256], [0, 256])
-    histr_g = histr_g.flatten().tolist()
-    histr_b = cv.calcHist([img], [0], None, [256], [0, 256])
-    histr_b = histr_b.flatten().tolist()
+    return img
+
+
+@timed("histogram_count")
+def channel_counts(img, bins=256, space="rgb"):
+    """Returns the histograms of all the channels of a BGR image as a
+    (channels, bins) uint32 array, computed in a single pass."""
+    if space not in COLOR_SPACES:
+        raise ValueError(f"Unknown color space: {space}")
+    if not 1 <= bins <= 256:
+        raise ValueError("The number of bins must be between 1 and 256")
+    _, ranges = COLOR_SPACES[space]
+    if space == "hsv":
+        img = cv.cvtColor(img, cv.COLOR_BGR2HSV)
+    elif space == "luma":
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+    channels = len(ranges)
+    pixels = img.reshape(-1, channels)
+    if all(value_range == bins for value_range in ranges):
+        binned = pixels.astype(np.uint32)
+    else:
+        binned = pixels.astype(np.uint32) * bins // np.array(ranges, dtype=np.uint32)
+    binned += np.arange(channels, dtype=np.uint32) * bins
+    counts = np.bincount(binned.ravel(), minlength=channels * bins)
+    return counts.reshape(channels, bins).astype(np.uint32)
+
+
+def apply_mode(counts, normalized=False, cumulative=False):
+    """Returns the histograms as raw counts, or normalized to fractions of
+    the pixels, optionally cumulative."""
+    if cumulative:
+        counts = np.cumsum(counts, axis=1)
+    if normalized:
+        totals = counts[:, -1:] if cumulative else counts.sum(axis=1, keepdims=True)
+        return counts / np.maximum(totals, 1)
+    return counts
+
+
+def histogram_payload(histograms, space):
+    """Returns the histograms as a JSON-serializable dictionary."""
+    names, _ = COLOR_SPACES[space]
+    return {
+        "space": space,
+        "bins": histograms.shape[1],
+        "histograms": dict(zip(names, histograms.tolist())),
+    }
 
-    return histr_b, histr_g, histr_r
+
+def histogram_bytes(histograms):
+    """Returns the histograms as compact little-endian binary data: uint32
+    counts, or float32 fractions for the normalized ones, channel after
+    channel."""
+    if np.issubdtype(histograms.dtype, np.integer):
+        return histograms.astype("<u4").tobytes()
+    return histograms.astype("<f4").tobytes()
+
+
+class HistogramEngine:
+    """Computes the histograms of the catalogue images, memoizing the
+    counts per content hash, number of bins and color space."""
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def counts(self, img_id, bins=256, space="rgb"):
+        """Returns the (channels, bins) uint32 histograms of the image."""
+        img_path = image_path(img_id)
+        key = (file_content_hash(img_path), bins, space)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return counts
+            self.misses += 1
+
+        counts = channel_counts(read_image(img_path), bins, space)
+        counts.setflags(write=False)
+        with self._lock:
+            self._counts[key] = counts
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return counts
+
+    def aggregate(self, img_ids, bins=256, space="rgb"):
+        """Returns the histograms summed over all the images, as a
+        (channels, bins) uint64 array."""
+        _, ranges = COLOR_SPACES[space]
+        total = np.zeros((len(ranges), bins), dtype=np.uint64)
+        for img_id in img_ids:
+            total += self.counts(img_id, bins, space)
+        return total
+
+    def stats(self):
+        """Returns the engine metrics."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+histogram_engine = HistogramEngine(conf.histogram_cache_size)
+
+
+def histogram(img_id):
+    """Return the histograms for the three color (R, G, B) channel of the image."""
+    hist_b, hist_g, hist_r = histogram_engine.counts(img_id).tolist()
+    return hist_b, hist_g, hist_r
@@ -0,0 +1,109 @@
+"""
+This applies the inference options of the configuration to the models:
+inference mode, thread settings, channels-last memory format, dynamic
+int8 quantization and tracing or compilation.
+"""
+import logging
+import os
+
+from app.config import Configuration
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+# models whose cost is dominated by the fully connected layers
+QUANTIZABLE_MODELS = ("alexnet", "vgg16")
+
+
+def input_size(model_id):
+    """Returns the spatial input size expected by the model."""
+    return 299 if model_id == "inception_v3" else 224
+
+
+def get_inference_options(model_id):
+    """Returns the inference options of the model, merging the default
+    ones with the model-specific ones."""
+    options = dict(conf.inference_options.get("default", {}))
+    options.update(conf.inference_options.get(model_id, {}))
+    return options
+
+
+def options_fingerprint(options):
+    """Returns a short string identifying the options that change the
+    model graph or its outputs."""
+    return "q{}-cl{}-{}".format(
+        int(bool(options.get("quantize"))),
+        int(bool(options.get("channels_last"))),
+        options.get("compile") or "eager",
+    )
+
+
+def configure_threads():
+    """Applies the torch thread settings of the configuration. The
+    inter-op threads can only be set before any parallel work starts."""
+    if conf.torch_num_threads:
+        torch.set_num_threads(conf.torch_num_threads)
+    if conf.torch_interop_threads:
+        try:
+            torch.set_num_interop_threads(conf.torch_interop_threads)
+        except RuntimeError:
+            logging.warning("The torch inter-op threads are already set")
+
+
+def optimize_model(model_id, model, options=None):
+    """Returns the model prepared for inference with the given options,
+    or the configured ones."""
+    options = get_inference_options(model_id) if options is None else options
+    model.eval()
+    if options.get("quantize"):
+        if model_id in QUANTIZABLE_MODELS:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        else:
+            logging.warning("Quantization is not supported for {}".format(model_id))
+    if options.get("channels_last"):
+        model = model.to(memory_format=torch.channels_last)
+
+    if options.get("compile") == "jit":
+        model = trace_model(model_id, model, input_size(model_id), options)
+    elif options.get("compile") == "compile":
+        model = torch.compile(model)
+    return model
+
+
+def trace_model(model_id, model, size, options):
+    """Returns the TorchScript trace of the model, cached on disk."""
+    trace_path = os.path.join(
+        conf.compiled_models_path,
+        "{}-{}-torch{}.pt".format(
+            model_id, options_fingerprint(options), torch.__version__
+        ),
+    )
+    if os.path.exists(trace_path):
+        return torch.jit.load(trace_path)
+
+    example = prepare_batch(torch.zeros(1, 3, size, size), options)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    os.makedirs(conf.compiled_models_path, exist_ok=True)
+    torch.jit.save(traced, trace_path)
+    return traced
+
+
+def prepare_batch(batch, options):
+    """Converts the input batch to the memory format of the model."""
+    if options.get("channels_last"):
+        return batch.contiguous(memory_format=torch.channels_last)
+    return batch
+
+
+def inference_context(options):
+    """Returns the context manager that disables autograd for the
+    forward pass."""
+    if options.get("inference_mode", True):
+        return torch.inference_mode()
+    return torch.no_grad()
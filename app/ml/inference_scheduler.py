@@ -0,0 +1,133 @@
+"""
+This is the micro-batching inference scheduler. Preprocessed tensors are
+queued per model and flushed as a single batched forward pass when the
+maximum batch size or the maximum wait is reached.
+"""
+import asyncio
+import time
+
+from app.config import Configuration
+from app.executor import Overloaded, executor
+from app.metrics import Histogram
+from app.ml.classification_utils import classify_batch
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+class SchedulerOverloaded(Overloaded):
+    """Raised when the queue of a model is full."""
+
+
+class InferenceScheduler:
+    """Groups the concurrent classification requests in batches."""
+
+    def __init__(self, max_batch_size=8, max_wait_ms=5.0, queue_depth=64):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue_depth = queue_depth
+        self._loop = None
+        self._queues = {}
+        self._workers = {}
+        self.queue_wait = Histogram(
+            (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+        )
+        self.batch_size = Histogram((1, 2, 4, 8, 16, 32, 64))
+
+    async def classify(self, model_id, tensor):
+        """Returns the top-5 classification scores of a single
+        preprocessed image, once its batch has been computed."""
+        if model_id not in conf.models:
+            raise ImportError("Model {} is not available".format(model_id))
+        queue = self._queue(model_id)
+        future = self._loop.create_future()
+        try:
+            queue.put_nowait((tensor, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise SchedulerOverloaded(
+                "Too many pending requests for model {}".format(model_id)
+            )
+        return await future
+
+    def _queue(self, model_id):
+        """Returns the queue of the model, starting its worker on the
+        first use within the running event loop."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._queues = {}
+            self._workers = {}
+        if model_id not in self._queues:
+            queue = asyncio.Queue(maxsize=self.queue_depth)
+            self._queues[model_id] = queue
+            self._workers[model_id] = loop.create_task(self._worker(model_id, queue))
+        return self._queues[model_id]
+
+    async def _collect(self, queue):
+        """Waits for the first request, then gathers the following ones
+        until the batch is full or the wait budget is spent."""
+        batch = [await queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self, model_id, queue):
+        """Runs the batched forward passes of a single model."""
+        while True:
+            batch = await self._collect(queue)
+            now = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.queue_wait.observe(now - enqueued)
+            self.batch_size.observe(len(batch))
+
+            try:
+                tensors = torch.stack([tensor for tensor, _, _ in batch])
+                # the queue depth already bounds the work, so the batch
+                # goes straight to the thread pool
+                outputs = await self._loop.run_in_executor(
+                    executor.thread_pool, classify_batch, model_id, tensors
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), output in zip(batch, outputs):
+                    if not future.done():
+                        future.set_result(output)
+
+    async def close(self):
+        """Stops the workers of the running event loop."""
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._queues = {}
+        self._workers = {}
+
+    def stats(self):
+        """Returns the scheduler metrics."""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self.queue_depth,
+            "queued": {
+                model_id: queue.qsize() for model_id, queue in self._queues.items()
+            },
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "batch_size": self.batch_size.snapshot(),
+        }
+
+
+scheduler = InferenceScheduler(
+    conf.batch_max_size, conf.batch_max_wait_ms, conf.batch_queue_depth
+)
@@ -0,0 +1,222 @@
+"""
+This is a process-wide registry of the classification models. Models are
+loaded once, put in eval mode and kept resident, evicting the least
+recently used ones when the configured memory budget is exceeded.
+"""
+import functools
+import importlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import Configuration
+from app.metrics import stage_seconds
+from app.ml.backends import get_backend, load_exported, weights_name
+from app.ml.inference_options import (
+    get_inference_options,
+    inference_context,
+    input_size,
+    optimize_model,
+    options_fingerprint,
+    prepare_batch,
+)
+from app.ml.preprocessing import resize_size
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+def model_size(model):
+    """Returns the memory (in bytes) held by the parameters and buffers
+    of the model."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def build_model(model_id):
+    """Builds the pretrained eager model from torchvision. Only the
+    models specified in the configuration are allowed."""
+    if model_id not in conf.models:
+        raise ImportError("Model {} is not available".format(model_id))
+    module = importlib.import_module("torchvision.models")
+    return module.__getattribute__(model_id)(weights="DEFAULT")
+
+
+@functools.lru_cache(maxsize=None)
+def preprocessing_name(model_id):
+    """Returns a string identifying the preprocessing of the model inputs."""
+    return "resize{}".format(resize_size(input_size(model_id)))
+
+
+def weights_version(model_id):
+    """Returns a string identifying the weights of the model and the
+    backend, inference options and preprocessing that change its outputs."""
+    if model_id not in conf.models:
+        raise ImportError("Model {} is not available".format(model_id))
+    backend = get_backend(model_id)
+    if backend == "torch":
+        fingerprint = options_fingerprint(get_inference_options(model_id))
+    else:
+        fingerprint = backend
+    return "{}+{}+{}".format(
+        weights_name(model_id), fingerprint, preprocessing_name(model_id)
+    )
+
+
+def load_model(model_id, options=None):
+    """Builds the pretrained model and prepares it for inference with
+    the given options, or the configured ones."""
+    return optimize_model(model_id, build_model(model_id), options)
+
+
+def load_serving_model(model_id):
+    """Loads the model with its configured backend and returns it with
+    the memory held by its weights."""
+    backend = get_backend(model_id)
+    if backend != "torch":
+        return load_exported(model_id, backend)
+    model = build_model(model_id)
+    # quantized and traced models hide their weights, so the size of the
+    # eager model is used as a conservative estimate
+    size = model_size(model)
+    return optimize_model(model_id, model), size
+
+
+def feature_extractor(model):
+    """Replaces the last linear layer of the model, its classifier, by an
+    identity, so that the model returns its penultimate-layer features."""
+    parent_name, _, name = [
+        module_name
+        for module_name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+    ][-1].rpartition(".")
+    parent = model.get_submodule(parent_name)
+    if isinstance(parent, torch.nn.Sequential):
+        parent[int(name)] = torch.nn.Identity()
+    else:
+        setattr(parent, name, torch.nn.Identity())
+    return model.eval()
+
+
+def load_feature_extractor(model_id):
+    """Loads the eager model returning the penultimate-layer features,
+    whatever the inference backend, with the memory held by its weights."""
+    model = feature_extractor(build_model(model_id))
+    return model, model_size(model)
+
+
+# the loaders of the variants of a model kept by the registry
+VARIANTS = {"serving": load_serving_model, "features": load_feature_extractor}
+
+
+class ModelRegistry:
+    """Keeps the loaded models resident in memory with LRU eviction."""
+
+    def __init__(self, memory_budget_mb=None):
+        self.memory_budget = (
+            None if memory_budget_mb is None else memory_budget_mb * 1024 * 1024
+        )
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {model_id: threading.Lock() for model_id in conf.models}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = {}
+
+    def get(self, model_id, variant="serving"):
+        """Returns the resident model, loading it on the first use. The
+        "features" variant is the feature extractor of the model, which
+        shares the memory budget with the served models."""
+        key = model_id if variant == "serving" else "{}:{}".format(model_id, variant)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+        if model_id not in self._load_locks:
+            raise ImportError("Model {} is not available".format(model_id))
+
+        # a per-model lock makes concurrent requests wait for a single load
+        with self._load_locks[model_id]:
+            with self._lock:
+                model = self._models.get(key)
+                if model is not None:
+                    self._models.move_to_end(key)
+                    return model
+            start = time.perf_counter()
+            model, size = VARIANTS[variant](model_id)
+            self.load_times[key] = time.perf_counter() - start
+            stage_seconds.labels("model_load").observe(self.load_times[key])
+            logging.info(
+                "Model {} loaded with the {} backend in {:.2f}s".format(
+                    key,
+                    get_backend(model_id) if variant == "serving" else "torch",
+                    self.load_times[key],
+                )
+            )
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                self._evict()
+        return model
+
+    def _evict(self):
+        """Drops the least recently used models until the resident ones
+        fit the memory budget. The most recent model is always kept."""
+        if self.memory_budget is None:
+            return
+        while len(self._models) > 1 and self.resident_bytes() > self.memory_budget:
+            model_id, _ = self._models.popitem(last=False)
+            del self._sizes[model_id]
+            self.evictions += 1
+            logging.info("Model {} evicted from the registry".format(model_id))
+
+    def resident_bytes(self):
+        """Returns the memory held by the resident models."""
+        return sum(self._sizes.values())
+
+    def warm_up(self, model_ids):
+        """Loads the models and runs a dummy forward pass on each of them,
+        so that the first request does not pay for lazy initializations."""
+        for model_id in model_ids:
+            model = self.get(model_id)
+            size = input_size(model_id)
+            options = get_inference_options(model_id)
+            with inference_context(options):
+                model(prepare_batch(torch.zeros(1, 3, size, size), options))
+
+    def clear(self):
+        """Removes all the resident models."""
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        """Returns the registry metrics."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "resident_models": list(self._models),
+                "resident_mb": self.resident_bytes() / (1024 * 1024),
+                "memory_budget_mb": (
+                    None
+                    if self.memory_budget is None
+                    else self.memory_budget / (1024 * 1024)
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "load_time_seconds": dict(self.load_times),
+            }
+
+
+registry = ModelRegistry(conf.model_memory_budget_mb)
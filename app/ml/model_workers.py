@@ -0,0 +1,497 @@
+"""
+This is the optional serving topology where a model lives in dedicated
+inference processes instead of the web process. Each replica is a long
+lived process that loads a single model. Batches are handed over through
+a shared memory buffer owned by the replica, which is reused for the
+outputs, and only the shapes go through the pipe. Replicas are health
+checked in the background and respawned when they die or hang.
+
+The replicas are started either by the web process itself, which gives
+every HTTP worker its own set, or once by the model server
+(`python -m app.model_server`), whose Unix socket the HTTP workers
+connect to, so that the memory scales with the models and not with the
+HTTP workers. Each connection to the server has its own shared memory
+buffer, created by the web process.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client
+
+import numpy as np
+
+from app.config import Configuration
+from app.ml.inference_options import input_size
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+def serve(model_id, conn, buffer_name):
+    """Runs in the replica process: loads the model, then answers the
+    forward and features requests of the web process until it is told to
+    stop."""
+    from app.ml.classification_utils import local_features, local_forward
+    from app.ml.inference_options import configure_threads
+    from app.ml.model_registry import registry
+
+    configure_threads()
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    try:
+        registry.warm_up([model_id])
+        conn.send(("ready",))
+        while True:
+            message = conn.recv()
+            if message[0] == "stop":
+                break
+            if message[0] == "ping":
+                conn.send(("pong",))
+                continue
+            try:
+                shape = message[1]
+                batch = torch.from_numpy(
+                    np.ndarray(shape, dtype=np.float32, buffer=buffer.buf)
+                )
+                if message[0] == "features":
+                    out = local_features(model_id, batch)
+                else:
+                    out = local_forward(model_id, batch)
+                # the input is no longer needed, so the outputs overwrite it
+                output = np.ndarray(out.shape, dtype=np.float32, buffer=buffer.buf)
+                output[...] = out.numpy()
+                del batch, output
+                conn.send(("ok", tuple(out.shape)))
+            except Exception as e:
+                conn.send(("error", "{}: {}".format(type(e).__name__, e)))
+    finally:
+        buffer.close()
+
+
+class ModelWorker:
+    """A single inference process serving one model."""
+
+    def __init__(self, model_id, index, capacity):
+        self.model_id = model_id
+        self.index = index
+        self.capacity = capacity
+        size = input_size(model_id)
+        self.buffer_bytes = capacity * 3 * size * size * 4
+        self.lock = threading.Lock()
+        self._context = multiprocessing.get_context("spawn")
+        self._buffer = None
+        self._process = None
+        self._conn = None
+        self.restarts = -1
+        self.requests = 0
+        self.last_ping_ms = None
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        """Starts the process and waits until its model is loaded. The
+        lock must be held, or the worker not yet shared."""
+        if self._buffer is None:
+            self._buffer = shared_memory.SharedMemory(
+                create=True, size=self.buffer_bytes
+            )
+        parent_conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+            target=serve,
+            args=(self.model_id, child_conn, self._buffer.name),
+            name="model-{}-{}".format(self.model_id, self.index),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self.restarts += 1
+        if not self._conn.poll(conf.model_worker_start_timeout_seconds):
+            self._kill()
+            raise RuntimeError("Model worker {} did not start".format(self.name))
+        self._conn.recv()
+        logging.info("Model worker %s started, pid %s", self.name, self._process.pid)
+
+    @property
+    def name(self):
+        return "{}-{}".format(self.model_id, self.index)
+
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._process = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _restart(self):
+        logging.warning("Respawning model worker %s", self.name)
+        self._kill()
+        self.start()
+
+    def _request(self, message, timeout):
+        """Sends the message and returns the answer, or raises
+        ConnectionError when the process is dead or does not answer."""
+        try:
+            self._conn.send(message)
+            if not self._conn.poll(timeout):
+                raise ConnectionError("Model worker {} timed out".format(self.name))
+            return self._conn.recv()
+        except (EOFError, OSError) as e:
+            raise ConnectionError("Model worker {} died".format(self.name)) from e
+
+    def forward(self, batch, features=False):
+        """Returns the output of the model, or its penultimate-layer
+        features, for a batch of at most capacity images. A dead or hung
+        process is respawned and the batch retried once."""
+        with self.lock:
+            view = np.ndarray(batch.shape, dtype=np.float32, buffer=self._buffer.buf)
+            for attempt in range(2):
+                if not self.alive:
+                    self._restart()
+                view[...] = batch.numpy()
+                try:
+                    answer = self._request(
+                        ("features" if features else "forward", tuple(batch.shape)),
+                        conf.model_worker_timeout_seconds,
+                    )
+                    break
+                except ConnectionError:
+                    self._kill()
+                    if attempt:
+                        raise
+            self.requests += 1
+            if answer[0] == "error":
+                raise RuntimeError(answer[1])
+            output = np.ndarray(answer[1], dtype=np.float32, buffer=self._buffer.buf)
+            return torch.from_numpy(output.copy())
+
+    def check(self):
+        """Pings the process, respawning it when it is dead or hung. A
+        busy process is skipped, since it is answering requests."""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            start = time.perf_counter()
+            try:
+                if not self.alive:
+                    raise ConnectionError("Model worker {} died".format(self.name))
+                self._request(("ping",), conf.model_worker_timeout_seconds)
+                self.last_ping_ms = (time.perf_counter() - start) * 1000
+            except ConnectionError:
+                self._restart()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Stops the process and releases the shared memory."""
+        with self.lock:
+            if self.alive:
+                try:
+                    self._conn.send(("stop",))
+                    self._process.join(5)
+                except OSError:
+                    pass
+            self._kill()
+            if self._buffer is not None:
+                self._buffer.close()
+                self._buffer.unlink()
+                self._buffer = None
+
+    def stats(self):
+        """Returns the replica metrics."""
+        return {
+            "pid": self._process.pid if self._process is not None else None,
+            "alive": self.alive,
+            "busy": self.lock.locked(),
+            "requests": self.requests,
+            "restarts": max(self.restarts, 0),
+            "last_ping_ms": self.last_ping_ms,
+            "buffer_mb": self.buffer_bytes / (1024 * 1024),
+        }
+
+
+class ModelWorkerPool:
+    """Dispatches the forward passes of the served models to their
+    replicas."""
+
+    def __init__(self, replicas, capacity, health_interval):
+        self.replicas = {
+            model_id: count for model_id, count in replicas.items() if count > 0
+        }
+        self.capacity = capacity
+        self.health_interval = health_interval
+        self._workers = {}
+        self._next = {}
+        self._checker = None
+
+    def serves(self, model_id):
+        """Tells whether the model runs in the inference processes."""
+        return model_id in self._workers
+
+    def _pick(self, model_id):
+        """Returns an idle replica of the model, or the next one in turn."""
+        workers = self._workers[model_id]
+        for worker in workers:
+            if not worker.lock.locked():
+                return worker
+        return workers[next(self._next[model_id]) % len(workers)]
+
+    def forward(self, model_id, batch, features=False):
+        """Returns the output of the model for the batch, or its
+        penultimate-layer features, computed by the replicas. It blocks,
+        so it must run in a worker thread."""
+        batch = batch.float().contiguous()
+        outputs = [
+            self._pick(model_id).forward(
+                batch[start : start + self.capacity], features
+            )
+            for start in range(0, len(batch), self.capacity)
+        ]
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+
+    def start_workers(self):
+        """Starts the replicas of the configured models. It blocks until
+        their models are loaded. When one of them does not start, the
+        others are stopped and their shared memory released."""
+        workers = {
+            model_id: [
+                ModelWorker(model_id, index, self.capacity) for index in range(count)
+            ]
+            for model_id, count in self.replicas.items()
+        }
+
+        def start(worker):
+            try:
+                worker.start()
+            except Exception:
+                logging.exception("Cannot start model worker %s", worker.name)
+
+        threads = [
+            threading.Thread(target=start, args=(worker,))
+            for replicas in workers.values()
+            for worker in replicas
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [
+            model_id
+            for model_id, replicas in workers.items()
+            if not all(worker.alive for worker in replicas)
+        ]
+        if failed:
+            for replicas in workers.values():
+                for worker in replicas:
+                    worker.stop()
+            raise RuntimeError("The workers of {} did not start".format(failed[0]))
+        for model_id in workers:
+            self._next[model_id] = itertools.count()
+        self._workers = workers
+
+    def check(self):
+        """Health checks every replica."""
+        for replicas in self._workers.values():
+            for worker in replicas:
+                try:
+                    worker.check()
+                except Exception:
+                    logging.exception("Cannot respawn model worker %s", worker.name)
+
+    async def _run_checker(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.to_thread(self.check)
+
+    async def start(self):
+        """Starts the replicas and their health checks."""
+        if not self.replicas:
+            return
+        await asyncio.to_thread(self.start_workers)
+        self._checker = asyncio.get_running_loop().create_task(self._run_checker())
+
+    async def stop(self):
+        """Stops the health checks and the replicas."""
+        if self._checker is not None:
+            self._checker.cancel()
+            await asyncio.gather(self._checker, return_exceptions=True)
+            self._checker = None
+        await asyncio.to_thread(self.stop_workers)
+
+    def stop_workers(self):
+        """Stops the replicas."""
+        workers, self._workers = self._workers, {}
+        for replicas in workers.values():
+            for worker in replicas:
+                worker.stop()
+
+    def stats(self):
+        """Returns the metrics of the replicas."""
+        return {
+            model_id: [worker.stats() for worker in replicas]
+            for model_id, replicas in self._workers.items()
+        }
+
+
+class ServerConnection:
+    """A connection of the web process to the model server, with the
+    shared memory buffer its batches and outputs go through."""
+
+    def __init__(self, address):
+        try:
+            self._conn = Client(address, family="AF_UNIX")
+        except OSError as e:
+            raise ConnectionError("Cannot reach the model server") from e
+        self._buffer = None
+
+    def request(self, message, timeout):
+        """Sends the message and returns the answer. It raises
+        ConnectionError when the server is gone or does not answer, and
+        RuntimeError when the request failed."""
+        try:
+            self._conn.send(message)
+            if not self._conn.poll(timeout):
+                raise ConnectionError("The model server timed out")
+            answer = self._conn.recv()
+        except (EOFError, OSError) as e:
+            raise ConnectionError("The model server closed the connection") from e
+        if answer[0] == "error":
+            raise RuntimeError(answer[1])
+        return answer
+
+    def forward(self, model_id, batch, features=False):
+        """Returns the output of the model for the batch, or its
+        penultimate-layer features, growing the buffer of the connection
+        when the batch does not fit."""
+        if self._buffer is None or self._buffer.size < batch.numel() * 4:
+            self._release_buffer()
+            self._buffer = shared_memory.SharedMemory(
+                create=True, size=batch.numel() * 4
+            )
+            self.request(("buffer", self._buffer.name), conf.model_worker_timeout_seconds)
+        view = np.ndarray(batch.shape, dtype=np.float32, buffer=self._buffer.buf)
+        view[...] = batch.numpy()
+        del view
+        answer = self.request(
+            ("features" if features else "forward", model_id, tuple(batch.shape)),
+            conf.model_worker_timeout_seconds,
+        )
+        output = np.ndarray(answer[1], dtype=np.float32, buffer=self._buffer.buf)
+        result = torch.from_numpy(output.copy())
+        del output
+        return result
+
+    def _release_buffer(self):
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer.unlink()
+            self._buffer = None
+
+    def close(self):
+        """Closes the connection and releases its buffer."""
+        self._conn.close()
+        self._release_buffer()
+
+
+class ModelServerClient:
+    """Dispatches the forward passes of the served models to the model
+    server, through a pool of connections reused across threads."""
+
+    def __init__(self, address):
+        self.address = address
+        self.models = ()
+        self._idle = []
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reconnects = 0
+
+    def serves(self, model_id):
+        """Tells whether the model runs in the model server."""
+        return model_id in self.models
+
+    def forward(self, model_id, batch, features=False):
+        """Returns the output of the model for the batch, or its
+        penultimate-layer features, computed by the model server. A broken
+        connection is replaced and the batch retried once. It blocks, so it
+        must run in a worker thread."""
+        batch = batch.float().contiguous()
+        for attempt in range(2):
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = ServerConnection(self.address)
+                output = connection.forward(model_id, batch, features)
+            except ConnectionError:
+                if connection is not None:
+                    connection.close()
+                if attempt:
+                    raise
+                self.reconnects += 1
+                continue
+            except Exception:
+                with self._lock:
+                    self._idle.append(connection)
+                raise
+            with self._lock:
+                self._idle.append(connection)
+                self.requests += 1
+            return output
+
+    def connect(self):
+        """Waits for the model server and asks for the models it serves."""
+        deadline = time.monotonic() + conf.model_worker_start_timeout_seconds
+        while True:
+            try:
+                connection = ServerConnection(self.address)
+                break
+            except ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        self.models = tuple(
+            connection.request(("models",), conf.model_worker_timeout_seconds)[1]
+        )
+        self._idle.append(connection)
+        logging.info("Model server at %s serves %s", self.address, self.models)
+
+    async def start(self):
+        """Connects to the model server."""
+        await asyncio.to_thread(self.connect)
+
+    async def stop(self):
+        """Closes the connections."""
+        with self._lock:
+            connections, self._idle = self._idle, []
+        for connection in connections:
+            connection.close()
+
+    def stats(self):
+        """Returns the client metrics."""
+        return {
+            "address": self.address,
+            "models": list(self.models),
+            "idle_connections": len(self._idle),
+            "requests": self.requests,
+            "reconnects": self.reconnects,
+        }
+
+
+if conf.model_server_address is not None:
+    model_workers = ModelServerClient(conf.model_server_address)
+else:
+    model_workers = ModelWorkerPool(
+        conf.model_worker_processes,
+        conf.model_worker_max_batch,
+        conf.model_worker_health_seconds,
+    )
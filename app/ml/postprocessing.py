@@ -0,0 +1,60 @@
+"""
+This turns the model outputs into the classification scores returned to
+the users. The Imagenet labels are loaded once into a NumPy table, and the
+top-k scores of a whole batch are computed in one vectorized step.
+"""
+import functools
+import json
+import os
+
+import numpy as np
+
+from app.config import Configuration
+from app.metrics import timed
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+@functools.lru_cache(maxsize=1)
+def label_table():
+    """Returns the labels of Imagenet dataset as a NumPy array, where
+    the index corresponds to the output class. It is loaded only once."""
+    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
+    with open(labels_path) as f:
+        return np.array(json.load(f), dtype=object)
+
+
+@timed("softmax")
+def percentages(out):
+    """Returns the class probabilities of the model output as percentages."""
+    return torch.nn.functional.softmax(out, dim=1) * 100
+
+
+def top_k(out, k=None):
+    """Returns the top-k classification scores of each image of the
+    batch, as a list of lists of (label_name, score) with the scores
+    as percentages."""
+    return top_k_percentages(percentages(out), k)
+
+
+@timed("top_k")
+def top_k_percentages(percentage, k=None):
+    """Returns the top-k classification scores of each image of a batch
+    of class percentages."""
+    k = conf.top_k if k is None else k
+    scores, indices = torch.topk(percentage, k, dim=1)
+    return labelled_scores(indices.numpy(), scores.tolist())
+
+
+@timed("label_lookup")
+def labelled_scores(indices, scores):
+    """Pairs the class indices of a batch with their labels and scores."""
+    names = label_table()[indices].tolist()
+    return [
+        [list(pair) for pair in zip(row_names, row_scores)]
+        for row_names, row_scores in zip(names, scores)
+    ]
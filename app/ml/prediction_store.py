@@ -0,0 +1,140 @@
+"""
+This is the store of the precomputed predictions of the catalogue images.
+Each model has its own directory with two columnar arrays, the top-k class
+indices (int16) and scores (float32), and a manifest mapping every image
+to its row together with the hash of the content it was computed from.
+The arrays are memory-mapped, so a lookup costs a few microseconds.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from app.config import Configuration
+from app.ml.model_registry import weights_version
+from app.ml.postprocessing import labelled_scores
+
+
+conf = Configuration()
+
+MANIFEST = "manifest.json"
+
+
+def model_store_path(model_id, store_path=None):
+    """Returns the directory of the precomputed predictions of the model."""
+    return os.path.join(store_path or conf.prediction_store_path, model_id)
+
+
+def read_manifest(model_path):
+    """Returns the manifest of the model directory, or None."""
+    try:
+        with open(os.path.join(model_path, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_store(model_path, manifest, **arrays):
+    """Writes a new generation of the arrays, then atomically replaces the
+    manifest and removes the previous generation. A reader or an
+    interrupted job never sees a manifest pointing to partial arrays."""
+    os.makedirs(model_path, exist_ok=True)
+    previous = read_manifest(model_path)
+    generation = (previous or {}).get("generation", 0) + 1
+    for name, array in arrays.items():
+        np.save(os.path.join(model_path, "{}-{}.npy".format(name, generation)), array)
+
+    manifest = dict(manifest, generation=generation)
+    tmp_path = os.path.join(model_path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(model_path, MANIFEST))
+
+    if previous is not None:
+        suffix = "-{}.npy".format(previous["generation"])
+        for file_name in os.listdir(model_path):
+            if file_name.endswith(suffix):
+                os.remove(os.path.join(model_path, file_name))
+
+
+class PredictionStore:
+    """Serves the precomputed predictions, reloading a model directory
+    when the precompute job updates it."""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._models = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale = 0
+        self.missing = 0
+
+    def _load(self, model_id):
+        model_path = model_store_path(model_id, self.store_path)
+        try:
+            mtime = os.stat(os.path.join(model_path, MANIFEST)).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            loaded = self._models.get(model_id)
+            if loaded is not None and loaded["mtime"] == mtime:
+                return loaded
+            manifest = read_manifest(model_path)
+            if manifest is None:
+                return None
+            generation = manifest["generation"]
+            loaded = {
+                "mtime": mtime,
+                "manifest": manifest,
+                "indices": np.load(
+                    os.path.join(model_path, "indices-{}.npy".format(generation)),
+                    mmap_mode="r",
+                ),
+                "scores": np.load(
+                    os.path.join(model_path, "scores-{}.npy".format(generation)),
+                    mmap_mode="r",
+                ),
+            }
+            self._models[model_id] = loaded
+        return loaded
+
+    def lookup(self, model_id, image_id, digest, top_k=None):
+        """Returns the top-k classification scores of the image as a list
+        of (label_name, score), or None when the image was not precomputed
+        or the store is stale for its content or the model weights."""
+        top_k = conf.top_k if top_k is None else top_k
+        loaded = self._load(model_id)
+        if loaded is None:
+            self.missing += 1
+            return None
+        manifest = loaded["manifest"]
+        entry = manifest["images"].get(image_id)
+        if entry is None:
+            self.missing += 1
+            return None
+        row, stored_digest = entry
+        if (
+            stored_digest != digest
+            or manifest["weights_version"] != weights_version(model_id)
+            or manifest["top_k"] < top_k
+        ):
+            self.stale += 1
+            return None
+
+        self.hits += 1
+        indices = loaded["indices"][row : row + 1, :top_k]
+        scores = loaded["scores"][row : row + 1, :top_k].tolist()
+        return labelled_scores(indices, scores)[0]
+
+    def stats(self):
+        """Returns the store metrics."""
+        return {
+            "loaded_models": list(self._models),
+            "hits": self.hits,
+            "stale": self.stale,
+            "missing": self.missing,
+        }
+
+
+prediction_store = PredictionStore(conf.prediction_store_path)
@@ -0,0 +1,202 @@
+"""
+This is the shared preprocessing pipeline of the classification models.
+JPEG images are decoded in draft mode, i.e. at the smallest DCT scale
+still larger than the resize target, then resized and center cropped to
+the input size of the model (224, or 299 for inception_v3) and normalized.
+The cropped uint8 pixels of the catalogue images are cached in
+memory-mapped arrays, so repeated requests skip decoding entirely.
+"""
+import functools
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from app.config import Configuration
+from app.metrics import timed
+from app.utils import LazyModule, list_images
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+transforms = LazyModule("torchvision.transforms")
+
+
+@functools.lru_cache(maxsize=1)
+def normalization():
+    """Returns the Imagenet mean and standard deviation tensors, created
+    on the first use so that torch is imported lazily."""
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+    return mean, std
+
+
+# size of the shorter side before the center crop, per input size, as in
+# the torchvision reference pipelines of the models
+RESIZE_SIZES = {224: 256, 299: 342}
+
+
+def resize_size(size):
+    """Returns the size of the shorter side before the center crop, with
+    the 256/224 ratio for the input sizes not listed above."""
+    return RESIZE_SIZES.get(size, round(size * 256 / 224))
+
+
+@functools.lru_cache(maxsize=None)
+def crop_transform(size):
+    """Returns the resize and center crop transform, built once per size."""
+    return transforms.Compose(
+        (transforms.Resize(resize_size(size)), transforms.CenterCrop(size))
+    )
+
+
+@timed("decode")
+def decode(source, size):
+    """Opens the image from a path or a file object and converts it to
+    RGB. JPEG images are decoded directly at a reduced scale when they
+    are much larger than needed."""
+    with Image.open(source) as img:
+        target = resize_size(size)
+        img.draft("RGB", (target, target))
+        return img.convert("RGB")
+
+
+@timed("crop")
+def crop(img, size):
+    """Returns the resized and center cropped pixels of the image as a
+    (size, size, 3) uint8 array."""
+    return np.asarray(crop_transform(size)(img), dtype=np.uint8)
+
+
+@timed("normalize")
+def normalize(pixels):
+    """Converts the uint8 pixels to the normalized tensor expected by the
+    models, without the batch dimension."""
+    tensor = torch.from_numpy(np.array(pixels, dtype=np.uint8))
+    tensor = tensor.permute(2, 0, 1).float().div_(255)
+    mean, std = normalization()
+    return tensor.sub_(mean).div_(std)
+
+
+def preprocess(img, size):
+    """Returns the normalized tensor of an already opened image."""
+    return normalize(crop(img.convert("RGB"), size))
+
+
+def preprocess_file(source, size):
+    """Decodes the image from a path or a file object and returns its
+    normalized tensor."""
+    with decode(source, size) as img:
+        return normalize(crop(img, size))
+
+
+def preprocess_sizes(source, sizes):
+    """Decodes the image once, at the scale needed by the largest size,
+    and returns its normalized tensor for each of the input sizes."""
+    with decode(source, max(sizes)) as img:
+        return {size: normalize(crop(img, size)) for size in sizes}
+
+
+class TensorCache:
+    """Caches the cropped pixels of the catalogue images in one
+    memory-mapped array of N rows per input size. Each row holds the
+    pixels with the modification time and size of the file they were
+    computed from, so changed images are decoded again. The file is named
+    after the list of images it indexes and written whole before being
+    moved into place, so the other processes mapping the previous one keep
+    reading it unchanged."""
+
+    def __init__(self, cache_path, image_folder_path):
+        self.cache_path = cache_path
+        self.image_folder_path = image_folder_path
+        self._arrays = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _open(self, size):
+        """Returns the row index and the rows of the given input size,
+        creating them when the catalogue changed."""
+        with self._lock:
+            if size in self._arrays:
+                return self._arrays[size]
+            image_ids = sorted(list_images())
+            digest = hashlib.sha256(json.dumps(image_ids).encode()).hexdigest()[:16]
+            # named after the resize too, so that a change of it starts over
+            prefix = "catalogue-{}-{}-".format(resize_size(size), size)
+            file_name = prefix + digest + ".u8"
+            path = os.path.join(self.cache_path, file_name)
+            dtype = np.dtype(
+                [("signature", np.int64, (2,)), ("pixels", np.uint8, (size, size, 3))]
+            )
+            os.makedirs(self.cache_path, exist_ok=True)
+            if not os.path.exists(path):
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                # the zero signatures match no file, so every row is a miss
+                rows = np.memmap(
+                    tmp_path, dtype=dtype, mode="w+", shape=(len(image_ids),)
+                )
+                rows.flush()
+                del rows
+                os.replace(tmp_path, path)
+                # the processes still mapping the previous files keep them
+                # until they unmap them
+                for previous in os.listdir(self.cache_path):
+                    if (
+                        previous.startswith(prefix)
+                        and previous.endswith(".u8")
+                        and previous != file_name
+                    ):
+                        os.remove(os.path.join(self.cache_path, previous))
+            rows = np.memmap(path, dtype=dtype, mode="r+", shape=(len(image_ids),))
+            index = {image_id: row for row, image_id in enumerate(image_ids)}
+            self._arrays[size] = (index, rows)
+            return self._arrays[size]
+
+    def get(self, image_id, size):
+        """Returns the normalized tensor of the catalogue image."""
+        image_path = os.path.join(self.image_folder_path, image_id)
+        index, rows = self._open(size)
+        row = index.get(image_id)
+        if row is None:
+            # added after the cache was built
+            return preprocess_file(image_path, size)
+
+        stat = os.stat(image_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            hit = tuple(rows["signature"][row]) == signature
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            return normalize(rows["pixels"][row])
+
+        with decode(image_path, size) as img:
+            cropped = crop(img, size)
+        # the pixels are written before the signature that validates them
+        rows["pixels"][row] = cropped
+        rows["signature"][row] = signature
+        return normalize(cropped)
+
+    def stats(self):
+        """Returns the cache metrics."""
+        lookups = self.hits + self.misses
+        return {
+            "sizes": list(self._arrays),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+tensor_cache = (
+    TensorCache(conf.tensor_cache_path, conf.image_folder_path)
+    if conf.tensor_cache_path
+    else None
+)
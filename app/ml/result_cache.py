@@ -0,0 +1,128 @@
+"""
+This is the cache of the classification results. Results are keyed on the
+model id, the version of its weights and the hash of the image content, so
+that a changed image or model never returns a stale result. Results are
+kept in an in-memory LRU tier and optionally in a persistent SQLite tier
+that survives restarts.
+"""
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from app.config import Configuration
+from app.ml.model_registry import weights_version
+
+
+conf = Configuration()
+
+
+class ResultCache:
+    """Two-tier cache of the classification results."""
+
+    def __init__(self, max_entries, db_path=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @property
+    def persistent(self):
+        return self.enabled and self.db_path is not None
+
+    def key(self, model_id, digest):
+        """Returns the cache key of the image content classified by the
+        model."""
+        return "{}:{}:top{}:{}".format(
+            model_id, weights_version(model_id), conf.top_k, digest
+        )
+
+    def get(self, key):
+        """Returns the result from the memory tier, or None."""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+            elif not self.persistent:
+                self.misses += 1
+        return result
+
+    def put(self, key, result):
+        """Stores the result in the memory tier."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _connection(self):
+        # the connection is shared by the worker threads under the lock
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._db.commit()
+        return self._db
+
+    def load(self, key):
+        """Returns the result from the persistent tier, promoting it to
+        the memory tier, or None. It blocks on disk I/O."""
+        with self._lock:
+            row = (
+                self._connection()
+                .execute("SELECT value FROM results WHERE key = ?", (key,))
+                .fetchone()
+            )
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        result = json.loads(row[0])
+        self.put(key, result)
+        return result
+
+    def store(self, key, result):
+        """Stores the result in the persistent tier. It blocks on disk I/O."""
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                (key, json.dumps(result)),
+            )
+            db.commit()
+
+    def clear(self):
+        """Removes the results from the memory tier."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache metrics."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": self.persistent,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+
+result_cache = ResultCache(conf.result_cache_size, conf.result_cache_db_path)
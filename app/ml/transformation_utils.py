@@ -1,22 +1,38 @@
 """
-This generates the enhanced image from an image ID.
+This generates the enhanced image from an image ID. The ImageEnhance
+passes of PIL are reproduced with OpenCV: the color and brightness
+enhancements in a single saturating weighted sum, the contrast around the
+mean luma of that clipped result with a lookup table, and the sharpness
+with a single 3x3 convolution that leaves the border pixels unchanged,
+like PIL. The values PIL truncates between its passes are only rounded
+once here, so the pixels can differ by a few levels, more where a strong
+contrast or sharpness amplifies the difference; benchmarks/enhancement.py
+checks the parity. The encoded images are returned directly and kept in
+an in-memory LRU, without writing any file.
 """
-import importlib
-import json
-import logging
 import os
+from io import BytesIO
 
-import PIL.ImageEnhance
-import torch
+import numpy as np
 from PIL import Image
-from torchvision import transforms
-from PIL import ImageEnhance
-from datetime import datetime
+
 from app.config import Configuration
+from app.executor import executor
+from app.metrics import timed
+from app.utils import ByteLRUCache, LazyModule, file_content_hash
 
 
 conf = Configuration()
 
+cv = LazyModule("cv2")
+
+# kernel of ImageFilter.SMOOTH, the degenerate image of ImageEnhance.Sharpness
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+# PIL truncates the blended values, which OpenCV rounds
+TRUNCATE = -0.499
+
+MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
 
 def fetch_image(image_id):
     """Gets the image from the specified ID. It returns only images
@@ -25,36 +41,104 @@ def fetch_image(image_id):
     img = Image.open(image_path)
     return img
 
+
+def blend_table(degenerate, factor):
+    """Returns the lookup table of Image.blend from a uniform degenerate
+    value to the pixel values, clipped and truncated like PIL."""
+    values = degenerate + factor * (np.arange(256) - degenerate)
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+@timed("transformation_enhance")
+def enhance_pixels(pixels, color_factor, brightness_factor, contrast_factor, sharpness_factor):
+    '''This function enhances an RGB uint8 array with the specified factors'''
+    # PIL clips the colors before the brightness, which only matters when
+    # the color is extrapolated and then darkened
+    clipped_brightness = 1
+    if color_factor > 1 and brightness_factor < 1:
+        brightness_factor, clipped_brightness = 1, brightness_factor
+    if color_factor != 1 or brightness_factor != 1:
+        gray = cv.cvtColor(cv.cvtColor(pixels, cv.COLOR_RGB2GRAY), cv.COLOR_GRAY2RGB)
+        pixels = cv.addWeighted(
+            pixels,
+            brightness_factor * color_factor,
+            gray,
+            brightness_factor * (1 - color_factor),
+            TRUNCATE,
+        )
+    if clipped_brightness != 1:
+        pixels = cv.LUT(pixels, blend_table(0, clipped_brightness))
+
+    if contrast_factor != 1:
+        # the contrast pivots around the mean luma of the brightened image
+        mean = int(cv.cvtColor(pixels, cv.COLOR_RGB2GRAY).mean() + 0.5)
+        pixels = cv.LUT(pixels, blend_table(mean, contrast_factor))
+
+    if sharpness_factor != 1:
+        kernel = (1 - sharpness_factor) * SMOOTH_KERNEL
+        kernel[1, 1] += sharpness_factor
+        sharpened = cv.filter2D(pixels, -1, kernel)
+        # PIL does not filter the border pixels
+        sharpened[[0, -1]] = pixels[[0, -1]]
+        sharpened[:, [0, -1]] = pixels[:, [0, -1]]
+        pixels = sharpened
+    return pixels
+
+
 def enhance_image(image, color_factor,brightness_factor, contrast_factor, sharpness_factor):
     '''This function enhances the image with the specified factors'''
-    enhancer = ImageEnhance.Color(image)
-    image = enhancer.enhance(color_factor)
+    pixels = np.asarray(image.convert("RGB"))
+    pixels = enhance_pixels(
+        pixels, color_factor, brightness_factor, contrast_factor, sharpness_factor
+    )
+    return Image.fromarray(pixels)
+
+
+@timed("transformation_decode")
+def load_pixels(img_id, max_size=None):
+    """Returns the RGB pixels of the image, downscaled to fit max_size
+    when given. JPEG images are decoded directly at a reduced scale."""
+    with fetch_image(img_id) as img:
+        if max_size:
+            img.draft("RGB", (max_size, max_size))
+        img = img.convert("RGB")
+    if max_size:
+        img.thumbnail((max_size, max_size))
+    return np.asarray(img)
 
-    enhancer = ImageEnhance.Brightness(image)
-    image = enhancer.enhance(brightness_factor)
 
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(contrast_factor)
+def render_transformation(img_id, color, brightness, contrast, sharpness, max_size=None, image_format="JPEG"):
+    '''This function enhances the image with the specified factors and returns it encoded'''
+    pixels = load_pixels(img_id, max_size)
+    pixels = enhance_pixels(pixels, color, brightness, contrast, sharpness)
+    buffer = BytesIO()
+    options = {"quality": conf.transformation_jpeg_quality} if image_format != "PNG" else {}
+    Image.fromarray(pixels).save(buffer, format=image_format, **options)
+    return buffer.getvalue()
 
-    enhancer = ImageEnhance.Sharpness(image)
-    image = enhancer.enhance(sharpness_factor)
 
-    return image
+def transformation_key(img_id, color, brightness, contrast, sharpness, max_size, image_format):
+    """Returns the cache key of a transformation, based on the content
+    of the image rather than on its name."""
+    image_path = os.path.join(conf.image_folder_path, img_id)
+    factors = tuple(round(factor, 3) for factor in (color, brightness, contrast, sharpness))
+    return (file_content_hash(image_path), factors, max_size, image_format)
 
-def transform_image(img_id,color,brightness,contrast,sharpness):
-    '''This function enhances and saves the image with the specified factors'''
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    enhanced_image_path = f"app/static/enhanced_images"
-    os.makedirs(enhanced_image_path, exist_ok=True)
-    img = fetch_image(img_id)
-    try:
-        new_img = enhance_image(img, color, brightness, contrast, sharpness)
-        image_enhanced_id=f"{img_id}_{timestamp}.jpg"
-        new_img.save(os.path.join(enhanced_image_path, image_enhanced_id))
-        return image_enhanced_id
-    except Exception as e:
-        print(f"Error during image enhancement: {e}")
-        raise e
 
+transformation_cache = ByteLRUCache(conf.transformation_cache_mb)
 
 
+async def transformation_bytes(
+    image_id, color, brightness, contrast, sharpness, size=None, image_format="JPEG"
+):
+    """Returns the encoded transformation of the image, from the cache
+    when possible."""
+    args = (image_id, color, brightness, contrast, sharpness, size, image_format)
+    key = await executor.run(transformation_key, *args)
+    data = transformation_cache.get(key)
+    if data is None:
+        # rendered in the process pool when enabled, so it is timed here
+        with timed("transformation_render"):
+            data = await executor.run_process(render_transformation, *args)
+        transformation_cache.put(key, data)
+    return data
@@ -3,55 +3,43 @@ This is the upload_utils module, which contains
 utility functions for the upload route.
 """
 
-import importlib
-import json
-import logging
-import os
-import torch
-from PIL import Image
-from torchvision import transforms
 from io import BytesIO
-from .classification_utils import get_model, get_labels
 
-from app.config import Configuration
+from PIL import UnidentifiedImageError
 
-conf = Configuration()
+from .classification_utils import classify_batch
+from .inference_options import input_size
+from .preprocessing import preprocess_file
 
+from app.config import Configuration
+from app.metrics import timed
 
-def uploaded_image(model_id, img_data):
-    """ This is a function take the uploaded image and classify it using the model"""
-    # Load the image
-    img = Image.open(BytesIO(img_data))
-
-    # Load the model
-    model = get_model(model_id)
-    model.eval()
-
-    # Image transformation
-    transform = transforms.Compose(
-        [
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-            ),
-        ]
-    )
+conf = Configuration()
 
-    # Prepare the image for the model
-    img = img.convert("RGB")  # Convert the image in RGB
-    preprocessed = transform(img).unsqueeze(0)
 
-    out = model(preprocessed)
-    _, indices = torch.sort(out, descending=True)
+class UnsupportedImage(Exception):
+    """Raised when an uploaded file cannot be decoded as an image."""
 
-    percentage = torch.nn.functional.softmax(out, dim=1)[0] * 100
 
-    labels = get_labels()
+@timed("upload_preprocess")
+def preprocess_upload(upload, model_id):
+    """Decodes the uploaded bytes, or the file object they were spooled
+    to, into the normalized tensor expected by the model. It raises
+    UnsupportedImage when PIL cannot decode them."""
+    if isinstance(upload, (bytes, bytearray)):
+        upload = BytesIO(upload)
+    else:
+        upload.seek(0)
+    try:
+        return preprocess_file(upload, input_size(model_id))
+    except (UnidentifiedImageError, OSError) as e:
+        # e.g. a truncated file whose header passed the format sniffing
+        raise UnsupportedImage(str(e)) from e
 
-    output = [[labels[idx], percentage[idx].item()] for idx in indices[0][:5]]
 
-    img.close()
+def uploaded_image(model_id, img_data):
+    """ This is a function take the uploaded image and classify it using the model"""
+    # Prepare the image for the model
+    preprocessed = preprocess_upload(img_data, model_id).unsqueeze(0)
 
-    return output
+    return classify_batch(model_id, preprocessed)[0]
@@ -0,0 +1,135 @@
+"""
+This is the model server: it starts the replicas of the models listed in
+`model_worker_processes` once, and serves their forward passes to every
+HTTP worker over a Unix socket. Each connection hands over its batches
+through a shared memory buffer created by the web process. Start it
+before the web server, with `model_server_address` set to the same path:
+
+    python -m app.model_server
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Listener
+
+import numpy as np
+
+from app.config import Configuration
+from app.ml.model_workers import ModelWorkerPool
+from app.utils import LazyModule
+
+
+conf = Configuration()
+
+torch = LazyModule("torch")
+
+
+def attach_buffer(name):
+    """Attaches the shared memory buffer of a web process. It is
+    unregistered from the resource tracker of this process, which would
+    otherwise unlink it when the server exits; its owner does that."""
+    buffer = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(buffer._name, "shared_memory")
+    return buffer
+
+
+def handle(conn, pool):
+    """Answers the requests of a connection until the web process closes
+    it."""
+    buffer = None
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                if message[0] == "models":
+                    conn.send(("ok", sorted(pool.replicas)))
+                elif message[0] == "buffer":
+                    if buffer is not None:
+                        buffer.close()
+                    buffer = attach_buffer(message[1])
+                    conn.send(("ok",))
+                elif message[0] in ("forward", "features"):
+                    kind, model_id, shape = message
+                    if not pool.serves(model_id):
+                        raise ValueError("Model {} is not served".format(model_id))
+                    batch = np.ndarray(shape, dtype=np.float32, buffer=buffer.buf)
+                    out = pool.forward(
+                        model_id, torch.from_numpy(batch), kind == "features"
+                    )
+                    # the replica copied the batch, so the output overwrites it
+                    output = np.ndarray(out.shape, dtype=np.float32, buffer=buffer.buf)
+                    output[...] = out.numpy()
+                    del batch, output
+                    conn.send(("ok", tuple(out.shape)))
+                else:
+                    raise ValueError("Unknown request {}".format(message[0]))
+            except Exception as e:
+                conn.send(("error", "{}: {}".format(type(e).__name__, e)))
+    finally:
+        conn.close()
+        if buffer is not None:
+            buffer.close()
+
+
+def check_health(pool, interval):
+    """Health checks the replicas at the interval."""
+    while True:
+        time.sleep(interval)
+        pool.check()
+
+
+def serve_models(args):
+    """Starts the replicas and accepts the connections of the web
+    processes until the server is stopped."""
+    pool = ModelWorkerPool(
+        conf.model_worker_processes,
+        conf.model_worker_max_batch,
+        conf.model_worker_health_seconds,
+    )
+    if not pool.replicas:
+        raise SystemExit("No model is listed in model_worker_processes")
+    pool.start_workers()
+    threading.Thread(
+        target=check_health, args=(pool, pool.health_interval), daemon=True
+    ).start()
+
+    # a socket left by a previous run is replaced
+    if os.path.exists(args.address):
+        os.remove(args.address)
+    listener = Listener(args.address, family="AF_UNIX")
+    # SIGTERM stops the server like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info("Serving %s on %s", sorted(pool.replicas), args.address)
+    try:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=handle, args=(conn, pool), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # a second signal must not interrupt the release of the replicas
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        listener.close()
+        pool.stop_workers()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Serves the model replicas to the HTTP workers."
+    )
+    parser.add_argument(
+        "--address",
+        default=conf.model_server_address,
+        required=conf.model_server_address is None,
+        help="path of the Unix socket, model_server_address by default",
+    )
+    serve_models(parser.parse_args())
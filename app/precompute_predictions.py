@@ -0,0 +1,149 @@
+"""
+This precomputes the predictions of every model on every catalogue image
+and stores the top-k scores in the prediction store, so that the
+classification route can answer without running the models.
+
+The job is incremental and resumable: only the images that are new or
+whose content changed since the last run are processed, and the progress
+is checkpointed while the job runs. Run it from the repository root:
+
+    python -m app.precompute_predictions
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from app.config import Configuration
+from app.ml.classification_utils import preprocess_image
+from app.ml.inference_options import (
+    get_inference_options,
+    inference_context,
+    prepare_batch,
+)
+from app.ml.model_registry import load_serving_model, weights_version
+from app.ml.prediction_store import model_store_path, read_manifest, write_store
+from app.utils import file_content_hash, list_images
+
+
+conf = Configuration()
+
+
+class CatalogueDataset(Dataset):
+    """Loads and preprocesses the catalogue images for a model."""
+
+    def __init__(self, image_ids, model_id):
+        self.image_ids = image_ids
+        self.model_id = model_id
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, index):
+        return preprocess_image(self.image_ids[index], self.model_id)
+
+
+def load_previous(model_path, version, top_k):
+    """Returns the predictions of the previous run, as a dictionary
+    image_id -> (digest, indices, scores). They are discarded when the
+    model weights or the number of stored scores changed."""
+    manifest = read_manifest(model_path)
+    if (
+        manifest is None
+        or manifest["weights_version"] != version
+        or manifest["top_k"] != top_k
+    ):
+        return {}
+    generation = manifest["generation"]
+    indices = np.load(os.path.join(model_path, "indices-{}.npy".format(generation)))
+    scores = np.load(os.path.join(model_path, "scores-{}.npy".format(generation)))
+    return {
+        image_id: (digest, indices[row], scores[row])
+        for image_id, (row, digest) in manifest["images"].items()
+    }
+
+
+def save(model_path, version, top_k, predictions):
+    """Writes the predictions to the store."""
+    image_ids = sorted(predictions)
+    indices = np.zeros((len(image_ids), top_k), dtype=np.int16)
+    scores = np.zeros((len(image_ids), top_k), dtype=np.float32)
+    images = {}
+    for row, image_id in enumerate(image_ids):
+        digest, indices[row], scores[row] = predictions[image_id]
+        images[image_id] = [row, digest]
+    manifest = {"weights_version": version, "top_k": top_k, "images": images}
+    write_store(model_path, manifest, indices=indices, scores=scores)
+
+
+def precompute_model(model_id, image_ids, digests, args):
+    """Precomputes the predictions of a model on the new or changed
+    images."""
+    model_path = model_store_path(model_id, args.store_path)
+    version = weights_version(model_id)
+    previous = load_previous(model_path, version, args.top_k)
+    # the images removed from the catalogue are dropped
+    predictions = {
+        image_id: previous[image_id] for image_id in image_ids if image_id in previous
+    }
+    todo = [
+        image_id
+        for image_id in image_ids
+        if image_id not in predictions or predictions[image_id][0] != digests[image_id]
+    ]
+    if not todo and len(predictions) == len(previous):
+        logging.info("Predictions of {} are up to date".format(model_id))
+        return
+    logging.info("Precomputing {} images with {}".format(len(todo), model_id))
+
+    model, _ = load_serving_model(model_id)
+    options = get_inference_options(model_id)
+    loader = DataLoader(
+        CatalogueDataset(todo, model_id), batch_size=args.batch_size, num_workers=args.workers
+    )
+    done = 0
+    with inference_context(options):
+        for batch_number, batch in enumerate(loader, start=1):
+            out = model(prepare_batch(batch, options))
+            percentage = torch.nn.functional.softmax(out, dim=1) * 100
+            scores, indices = torch.topk(percentage, args.top_k, dim=1)
+            for image_id, row_indices, row_scores in zip(
+                todo[done : done + len(batch)], indices.numpy(), scores.numpy()
+            ):
+                predictions[image_id] = (digests[image_id], row_indices, row_scores)
+            done += len(batch)
+            if batch_number % args.checkpoint_every == 0:
+                save(model_path, version, args.top_k, predictions)
+                logging.info("{}: {}/{} images".format(model_id, done, len(todo)))
+    save(model_path, version, args.top_k, predictions)
+    logging.info("Predictions of {} stored in {}".format(model_id, model_path))
+
+
+def precompute_predictions(args):
+    """Precomputes the predictions of the selected models."""
+    image_ids = sorted(list_images())
+    digests = {
+        image_id: file_content_hash(os.path.join(conf.image_folder_path, image_id))
+        for image_id in image_ids
+    }
+    for model_id in args.models:
+        precompute_model(model_id, image_ids, digests, args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Precomputes the predictions of the catalogue images."
+    )
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--top-k", type=int, default=max(conf.precompute_top_k, conf.top_k)
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=4)
+    parser.add_argument("--store-path", default=conf.prediction_store_path)
+    precompute_predictions(parser.parse_args())
@@ -48,6 +48,24 @@ def prepare_labels():
     logging.info(f"Labels downloaded and stored in {labels_path}.")
 
 
+def prepare_wnids():
+    """Saves a JSON file containing the WordNet ids of the Imagenet
+    classes as a list where the index is the label ID of the class."""
+    img_folder = Configuration().image_folder_path
+    wnids_path = os.path.join(img_folder, "imagenet_wnids.json")
+    class_index_path = (
+        "https://storage.googleapis.com/"
+        "download.tensorflow.org/data/imagenet_class_index.json"
+    )
+    r = requests.get(class_index_path)
+    data = r.json()
+    wnids = [data[str(label_id)][0] for label_id in range(len(data))]
+    with open(wnids_path, "w") as f:
+        json.dump(wnids, f)
+    logging.info(f"WordNet ids downloaded and stored in {wnids_path}.")
+
+
 if __name__ == "__main__":
     prepare_images()
     prepare_labels()
+    prepare_wnids()
@@ -0,0 +1,93 @@
+"""
+This keeps the results of the classifications, histograms and
+transformations on the server under a short random id. The result pages,
+the download endpoints and the JSON API reference the id instead of
+sending the whole payload back and forth. The store is bounded by its
+number of entries and every entry expires after a time to live. Results
+that are kept elsewhere, like those of the jobs, are recreated on a miss
+by the loaders registered for them.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+Result = namedtuple("Result", ["kind", "payload"])
+
+
+class ResultStore:
+    """Bounded in-memory store of results with a time to live."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaders = []
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.recreated = 0
+
+    def loader(self, fn):
+        """Registers fn(result_id), which returns the (kind, payload) of a
+        result missing from the store, or None."""
+        self._loaders.append(fn)
+        return fn
+
+    def _insert(self, result_id, kind, payload):
+        with self._lock:
+            self._entries[result_id] = (time.monotonic() + self.ttl, kind, payload)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, kind, payload):
+        """Stores the result and returns its id."""
+        result_id = secrets.token_urlsafe(9)
+        self._insert(result_id, kind, payload)
+        return result_id
+
+    def get(self, result_id):
+        """Returns the result, or None if it is unknown or expired."""
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[result_id]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return Result(entry[1], entry[2])
+
+    def recreate(self, result_id):
+        """Recreates a result missing from the store with the loaders and
+        stores it again, or returns None. It blocks on their I/O."""
+        for fn in self._loaders:
+            loaded = fn(result_id)
+            if loaded is not None:
+                self._insert(result_id, *loaded)
+                self.recreated += 1
+                return Result(*loaded)
+        return None
+
+    def stats(self):
+        """Returns the store metrics."""
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "recreated": self.recreated,
+        }
+
+
+result_store = ResultStore(conf.result_store_size, conf.result_ttl_seconds)
@@ -0,0 +1,33 @@
+"""
+This contains the request bodies of the JSON API.
+"""
+from pydantic import BaseModel
+
+
+class BatchClassificationRequest(BaseModel):
+    model_id: str
+    image_ids: list[str]
+
+
+class EnsembleClassificationRequest(BaseModel):
+    image_id: str
+    model_ids: list[str]
+    ensemble: bool = True
+
+
+class AggregateHistogramRequest(BaseModel):
+    # None aggregates the whole catalogue
+    image_ids: list[str] | None = None
+    bins: int = 256
+    space: str = "rgb"
+    normalized: bool = False
+    cumulative: bool = False
+
+
+class JobRequest(BaseModel):
+    kind: str
+    params: dict
+    # interactive or batch
+    lane: str = "interactive"
+    priority: int = 0
+    timeout: float | None = None
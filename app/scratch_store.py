@@ -0,0 +1,171 @@
+"""
+This is the scratch storage of the files that are only needed for a short
+time, such as the uploaded images shown on the result pages. Files are
+named after the hash of their content, so concurrent requests never
+overwrite each other, and are written atomically. A single background
+sweeper evicts them by age and by total size, and the same sweep runs on
+startup to remove the orphans left by a previous run.
+"""
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from app.config import Configuration
+from app.utils import content_hash
+
+
+conf = Configuration()
+
+# names of the stored files: the start of their SHA-256 and a suffix
+SCRATCH_NAME = re.compile(r"[0-9a-f]{32}\.[a-z]+")
+
+
+class ScratchStore:
+    """Size and TTL bounded directory of content-addressed files."""
+
+    def __init__(self, root, max_mb, ttl_seconds, sweep_interval):
+        self.root = root
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._files = 0
+        self._sweeper = None
+        self.evicted = 0
+
+    def path(self, name):
+        """Returns the path of a stored file."""
+        return os.path.join(self.root, name)
+
+    def put(self, data, suffix=""):
+        """Stores the bytes and returns the name of the file. Storing the
+        same content again only refreshes its age. It blocks on disk I/O."""
+        return self._store(content_hash(data), suffix, lambda f: f.write(data))
+
+    def put_file(self, source, digest, suffix=""):
+        """Stores the content of a file object, whose SHA-256 is already
+        known, and returns the name of the file. It blocks on disk I/O."""
+
+        def copy(f):
+            source.seek(0)
+            shutil.copyfileobj(source, f)
+
+        return self._store(digest, suffix, copy)
+
+    def put_keyed(self, key, data, suffix=""):
+        """Stores the bytes under a key, such as the hash of the inputs
+        they were derived from, and returns the name of the file. It
+        blocks on disk I/O."""
+        return self._store(key, suffix, lambda f: f.write(data))
+
+    def get(self, name):
+        """Returns the content of a stored file, refreshing its age so
+        that the files in use are evicted last, or None. It blocks on
+        disk I/O."""
+        path = self.path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _store(self, digest, suffix, write):
+        name = digest[:32] + suffix
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path)
+            return name
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes += size
+            self._files += 1
+            over_budget = self._bytes > self.max_bytes
+        if over_budget:
+            self.sweep()
+        return name
+
+    def sweep(self):
+        """Removes the expired files, then the oldest ones until the total
+        size fits the budget. It blocks on disk I/O."""
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        kept = len(files)
+        for mtime, size, path in files:
+            if now - mtime <= self.ttl and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            kept -= 1
+            self.evicted += 1
+        with self._lock:
+            self._bytes = total
+            self._files = kept
+
+    async def _run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception:
+                logging.exception("Scratch storage sweep failed")
+
+    async def start(self):
+        """Removes the orphaned files and starts the background sweeper."""
+        await asyncio.to_thread(self.sweep)
+        self._sweeper = asyncio.get_running_loop().create_task(self._run_sweeper())
+
+    async def stop(self):
+        """Stops the background sweeper."""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def stats(self):
+        """Returns the storage metrics."""
+        with self._lock:
+            return {
+                "files": self._files,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "evicted": self.evicted,
+            }
+
+
+scratch_store = ScratchStore(
+    conf.scratch_path,
+    conf.scratch_max_mb,
+    conf.scratch_ttl_seconds,
+    conf.scratch_sweep_interval_seconds,
+)
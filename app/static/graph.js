@@ -1,14 +1,15 @@
 
 
 $(document).ready(function () {
+    // The scores are kept on the server and fetched by result id
     var scripts = document.getElementById('makeGraph');
-    var classification_scores = scripts.getAttribute('classification_scores');
-    makeGraph(classification_scores);
+    var resultId = scripts.getAttribute('result_id');
+    $.getJSON('/api/results/' + encodeURIComponent(resultId), function (result) {
+        makeGraph(result.scores);
+    });
 });
 
 function makeGraph(results) {
-    console.log(results);
-    results = JSON.parse(results);
     var ctx = document.getElementById("classificationOutput").getContext('2d');
     var myChart = new Chart(ctx, {
         type: 'horizontalBar',
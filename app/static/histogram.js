@@ -1,10 +1,15 @@
-window.onload = function() {
+window.onload = async function() {
     // Prepare the histogram for the GUI
 
+    // The histograms are fetched as binary uint32 counts, channel after channel
     const scriptTag = document.getElementById('drawHistogram');
-    const dataBlue = JSON.parse(scriptTag.getAttribute('histogram_blue'));
-    const dataGreen = JSON.parse(scriptTag.getAttribute('histogram_green'));
-    const dataRed = JSON.parse(scriptTag.getAttribute('histogram_red'));
+    const imageId = scriptTag.getAttribute('image_id');
+    const response = await fetch('/api/histograms/' + encodeURIComponent(imageId) + '?format=binary');
+    const bins = parseInt(response.headers.get('X-Histogram-Bins'));
+    const counts = new Uint32Array(await response.arrayBuffer());
+    const dataBlue = Array.from(counts.subarray(0, bins));
+    const dataGreen = Array.from(counts.subarray(bins, 2 * bins));
+    const dataRed = Array.from(counts.subarray(2 * bins, 3 * bins));
 
     const canvas = document.getElementById('rgbHistogramCanvas');
     const ctx = canvas.getContext('2d');
@@ -17,7 +22,7 @@ window.onload = function() {
     new Chart(ctx, {
         type: 'bar',
         data: {
-            labels: Array.from({ length: 256 }, (_, i) => i),
+            labels: Array.from({ length: bins }, (_, i) => i),
             datasets: [
                 {
                     label: 'Blue',
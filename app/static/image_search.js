@@ -0,0 +1,29 @@
+// Fills the image suggestions with a page of the catalogue matching the typed prefix
+
+(function () {
+    const input = document.getElementById('image_id');
+    const options = document.getElementById('image_options');
+    let pending = null;
+
+    async function search() {
+        const params = new URLSearchParams({prefix: input.value, limit: 20});
+        const response = await fetch('/api/images?' + params);
+        const page = await response.json();
+        options.innerHTML = '';
+        for (const image of page.images) {
+            const option = document.createElement('option');
+            option.value = image.image_id;
+            options.appendChild(option);
+        }
+        if (!input.value && page.images.length) {
+            input.value = page.images[0].image_id;
+            input.dispatchEvent(new Event('change', {bubbles: true}));
+        }
+    }
+
+    input.addEventListener('input', function () {
+        clearTimeout(pending);
+        pending = setTimeout(search, 150);
+    });
+    search();
+})();
@@ -0,0 +1,239 @@
+"""
+This produces the derivative images shown on the pages: size-bucketed
+thumbnails of the catalogue images, of the uploaded files and of the
+transformation results, encoded as JPEG or WebP. They are cached on disk
+under the hash of their source content, size and format, which is also
+their strong ETag, so a revalidation is answered without any I/O.
+
+The catalogue set can be generated ahead of time, in parallel, from the
+repository root:
+
+    python -m app.thumbnails --formats jpeg webp
+"""
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from app.catalogue import catalogue
+from app.config import Configuration
+from app.executor import executor
+from app.metrics import timed
+from app.ml.transformation_utils import render_transformation
+from app.result_store import result_store
+from app.scratch_store import SCRATCH_NAME, ScratchStore, scratch_store
+from app.utils import file_content_hash, list_images
+
+
+conf = Configuration()
+
+MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+SUFFIXES = {"jpeg": ".jpg", "webp": ".webp"}
+FACTORS = ("color", "brightness", "contrast", "sharpness")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# the source of a derivative: the hash identifying its content, the
+# function rendering it, called as render(*args, size, image_format), and
+# the Cache-Control header of its derivatives
+Source = namedtuple("Source", ["digest", "render", "args", "cache_control"])
+
+
+def render_thumbnail(path, size, image_format):
+    """Returns the image file downscaled to fit size and encoded. JPEG
+    images are decoded directly at a reduced scale."""
+    with Image.open(path) as img:
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+    img.thumbnail((size, size))
+    buffer = BytesIO()
+    img.save(buffer, format=image_format.upper(), quality=conf.thumbnail_quality)
+    return buffer.getvalue()
+
+
+def render_transformation_thumbnail(
+    image_id, color, brightness, contrast, sharpness, size, image_format
+):
+    """Returns the transformation of a catalogue image downscaled to fit
+    size and encoded."""
+    return render_transformation(
+        image_id, color, brightness, contrast, sharpness, size, image_format.upper()
+    )
+
+
+def catalogue_source(image_id):
+    """Returns the source of a catalogue image, or None."""
+    metadata = catalogue.metadata(image_id)
+    if metadata is None:
+        return None
+    return Source(
+        metadata["sha256"],
+        render_thumbnail,
+        (os.path.join(conf.image_folder_path, image_id),),
+        "public, max-age={}".format(conf.thumbnail_max_age_seconds),
+    )
+
+
+def upload_source(name):
+    """Returns the source of an uploaded file, or None. The uploads are
+    named after their content, so the name is enough to identify it."""
+    if not SCRATCH_NAME.fullmatch(name):
+        return None
+    return Source(
+        name.split(".")[0], render_thumbnail, (scratch_store.path(name),), IMMUTABLE
+    )
+
+
+def result_source(result_id):
+    """Returns the source of a transformation result, or None."""
+    result = result_store.get(result_id)
+    if result is None or result.kind != "transformation":
+        return None
+    metadata = catalogue.metadata(result.payload["image_id"])
+    if metadata is None:
+        return None
+    factors = [float(result.payload[name]) for name in FACTORS]
+    digest = ":".join(
+        [metadata["sha256"]] + ["{:.3f}".format(factor) for factor in factors]
+    )
+    return Source(
+        digest,
+        render_transformation_thumbnail,
+        (result.payload["image_id"], *factors),
+        IMMUTABLE,
+    )
+
+
+SOURCES = {
+    "catalogue": catalogue_source,
+    "uploads": upload_source,
+    "results": result_source,
+}
+
+
+def thumbnail_key(digest, size, image_format):
+    """Returns the hash identifying a derivative."""
+    key = "{}:{}:{}:{}".format(digest, size, image_format, conf.thumbnail_quality)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ThumbnailService:
+    """Serves the derivatives from the disk cache, rendering the missing
+    ones in the worker pools."""
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def etag(self, source, size_name, image_format):
+        """Returns the strong ETag of a derivative."""
+        size = conf.thumbnail_sizes[size_name]
+        return '"{}"'.format(thumbnail_key(source.digest, size, image_format)[:32])
+
+    def revalidated(self, etag, if_none_match):
+        """Tells whether the client already has the derivative."""
+        if etag in if_none_match:
+            self.not_modified += 1
+            return True
+        return False
+
+    async def get(self, source, size_name, image_format):
+        """Returns the encoded derivative, or None when its source is gone."""
+        size = conf.thumbnail_sizes[size_name]
+        key = thumbnail_key(source.digest, size, image_format)
+        suffix = SUFFIXES[image_format]
+        data = await executor.run(self.store.get, key[:32] + suffix)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        try:
+            # rendered in the process pool when enabled, so it is timed here
+            with timed("thumbnail_render"):
+                data = await executor.run_process(
+                    source.render, *source.args, size, image_format
+                )
+        except FileNotFoundError:
+            return None
+        await executor.run(self.store.put_keyed, key, data, suffix)
+        return data
+
+    def stats(self):
+        """Returns the service metrics."""
+        return dict(
+            self.store.stats(),
+            hits=self.hits,
+            misses=self.misses,
+            not_modified=self.not_modified,
+        )
+
+
+thumbnail_store = ScratchStore(
+    conf.thumbnail_cache_path,
+    conf.thumbnail_cache_max_mb,
+    conf.thumbnail_cache_ttl_seconds,
+    conf.thumbnail_sweep_interval_seconds,
+)
+thumbnails = ThumbnailService(thumbnail_store)
+
+
+def generate_catalogue_thumbnail(task):
+    """Renders and stores a derivative of a catalogue image unless it is
+    already cached, returning whether it was rendered. It runs in the
+    pre-pass workers."""
+    image_id, size_name, image_format = task
+    path = os.path.join(conf.image_folder_path, image_id)
+    size = conf.thumbnail_sizes[size_name]
+    key = thumbnail_key(file_content_hash(path), size, image_format)
+    suffix = SUFFIXES[image_format]
+    if os.path.exists(thumbnail_store.path(key[:32] + suffix)):
+        return False
+    thumbnail_store.put_keyed(key, render_thumbnail(path, size, image_format), suffix)
+    return True
+
+
+def generate_catalogue(args):
+    """Generates the missing derivatives of the catalogue images."""
+    tasks = [
+        (image_id, size_name, image_format)
+        for image_id in sorted(list_images())
+        for size_name in args.sizes
+        for image_format in args.formats
+    ]
+    logging.info("Checking {} derivatives".format(len(tasks)))
+    rendered = 0
+    with multiprocessing.Pool(args.workers) as pool:
+        for done, generated in enumerate(
+            pool.imap_unordered(generate_catalogue_thumbnail, tasks, chunksize=16),
+            start=1,
+        ):
+            rendered += generated
+            if done % 1000 == 0:
+                logging.info("{}/{} derivatives".format(done, len(tasks)))
+    logging.info(
+        "Rendered {} derivatives in {}".format(rendered, conf.thumbnail_cache_path)
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Generates the thumbnails of the catalogue images."
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(conf.thumbnail_sizes),
+        default=list(conf.thumbnail_sizes),
+    )
+    parser.add_argument(
+        "--formats", nargs="+", choices=list(MEDIA_TYPES), default=["jpeg"]
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    generate_catalogue(parser.parse_args())
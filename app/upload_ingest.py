@@ -0,0 +1,213 @@
+"""
+This is the streaming ingestion of the multipart uploads. The request body
+is parsed chunk by chunk as it arrives: every file is spooled (in memory
+up to upload_spool_mb, then on disk) and hashed incrementally, and the
+request is rejected as soon as a file exceeds upload_max_mb or its first
+bytes show that it is not an image, before the rest is received.
+"""
+import hashlib
+import tempfile
+
+from fastapi import HTTPException, Request
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # older python-multipart releases
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+# magic numbers of the accepted image formats
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+SNIFF_BYTES = 12
+
+
+def sniff_image(head):
+    """Returns the image format from the first bytes of a file, or None."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+class IngestedFile:
+    """An uploaded file spooled while it was received, with its SHA-256."""
+
+    def __init__(self, field_name, filename):
+        self.field_name = field_name
+        self.filename = filename
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=conf.upload_spool_mb * 1024 * 1024
+        )
+        self.size = 0
+        self.digest = None
+        self.image_format = None
+        self._hash = hashlib.sha256()
+        self._head = b""
+
+    def write(self, data, max_bytes):
+        self.size += len(data)
+        if self.size > max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{self.filename} exceeds {max_bytes // (1024 * 1024)} MB",
+            )
+        if self.image_format is None:
+            self._head += data[: SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self._check_format()
+        self._hash.update(data)
+        self.file.write(data)
+
+    def _check_format(self):
+        self.image_format = sniff_image(self._head)
+        if self.image_format is None:
+            raise HTTPException(
+                status_code=415, detail=f"{self.filename} is not a supported image"
+            )
+
+    def finish(self):
+        if self.image_format is None and self.size:
+            self._check_format()
+        self.digest = self._hash.hexdigest()
+        self.file.seek(0)
+
+    def read(self):
+        """Returns the whole content of the file."""
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+class UploadParser:
+    """Collects the form fields and the spooled files of a multipart body."""
+
+    def __init__(self, boundary, max_bytes, max_files):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fields = {}
+        self.files = []
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._current = None
+        self._value = b""
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def write(self, chunk):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._current = None
+        self._value = b""
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(
+            self._headers.get(b"content-disposition", b"")
+        )
+        name = options.get(b"name", b"").decode("latin-1")
+        if b"filename" in options:
+            if len(self.files) >= self.max_files:
+                raise HTTPException(
+                    status_code=413, detail=f"At most {self.max_files} files"
+                )
+            filename = options[b"filename"].decode("utf-8", "replace")
+            self._current = IngestedFile(name, filename)
+            self.files.append(self._current)
+        else:
+            self._current = name
+
+    def _on_part_data(self, data, start, end):
+        if isinstance(self._current, IngestedFile):
+            self._current.write(data[start:end], self.max_bytes)
+        else:
+            self._value += data[start:end]
+            if len(self._value) > 64 * 1024:
+                raise HTTPException(status_code=413, detail="Form field too large")
+
+    def _on_part_end(self):
+        if isinstance(self._current, IngestedFile):
+            self._current.finish()
+        elif self._current is not None:
+            self.fields.setdefault(self._current, []).append(
+                self._value.decode("utf-8", "replace")
+            )
+
+
+async def ingest_upload(request: Request, max_files=1):
+    """Parses the multipart body of the request while it is received and
+    returns its form fields, as lists of values, and its uploaded files.
+    Files that are empty (no file selected in the form) are dropped."""
+    content_type, options = parse_options_header(
+        request.headers.get("content-type", "")
+    )
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart form")
+
+    max_bytes = conf.upload_max_mb * 1024 * 1024
+    declared = request.headers.get("content-length")
+    # the body also contains the part headers and the form fields
+    if declared and declared.isdigit() and int(declared) > max_files * max_bytes + 65536:
+        raise HTTPException(status_code=413, detail="Request body too large")
+
+    parser = UploadParser(options[b"boundary"], max_bytes, max_files)
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except Exception:
+        for ingested in parser.files:
+            ingested.close()
+        raise
+    files = []
+    for ingested in parser.files:
+        if ingested.size:
+            files.append(ingested)
+        else:
+            ingested.close()
+    return parser.fields, files
+
+
+def close_files(files):
+    """Releases the spooled files."""
+    for ingested in files:
+        ingested.close()
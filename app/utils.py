@@ -1,9 +1,49 @@
+import hashlib
+import importlib
 import os
+import threading
+import time
+from collections import OrderedDict
 
 from app.config import Configuration
 
 conf = Configuration()
 
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+class LazyModule:
+    """Stands for a heavy module, such as torch or cv2, which is only
+    imported when one of its attributes is first used. This keeps the
+    start of the web process fast when the module is not needed."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            # the import lock makes concurrent first uses safe
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module {} ({})>".format(self._name, state)
+
+
+def preload_modules(names):
+    """Imports the modules ahead of their first use and returns the
+    seconds spent on each of them."""
+    timings = {}
+    for name in names:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = time.perf_counter() - start
+    return timings
+
 
 def list_images():
     """Returns the list of available images."""
@@ -11,3 +51,78 @@ def list_images():
         lambda x: x.endswith(".JPEG"), os.listdir(conf.image_folder_path)
     )
     return list(img_names)
+
+
+def content_hash(data):
+    """Returns the SHA-256 hex digest of the bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_content_hash(path):
+    """Returns the SHA-256 hex digest of the file content. The digest is
+    memoized until the size or the modification time of the file change."""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        cached = _file_hashes.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    with _file_hashes_lock:
+        _file_hashes[path] = (signature, digest)
+    return digest
+
+
+class ByteLRUCache:
+    """Keeps encoded payloads in memory within a byte budget, evicting
+    the least recently used ones."""
+
+    def __init__(self, max_mb):
+        self.max_bytes = max_mb * 1024 * 1024
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the payload, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Stores the payload."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        """Returns the cache metrics."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,130 @@
+"""
+This checks the exported inference backends against the eager torch
+models on the bundled imagenet_subset images. For every model and backend
+it reports the top-1 agreement with eager torch and the largest
+difference of the class probabilities (parity), together with the
+latency per image of a batch and of single images. It exits with status
+1 when a backend does not reach the required parity.
+
+Export the models first, then run it from the repository root:
+
+    python -m app.export_models --models resnet18
+    python -m benchmarks.backends --models resnet18 --limit 100
+"""
+import argparse
+import json
+import sys
+import time
+
+import torch
+
+from app.catalogue import catalogue
+from app.config import Configuration
+from app.ml.backends import EXTENSIONS, load_exported
+from app.ml.classification_utils import preprocess_image
+from app.ml.model_registry import build_model
+from app.ml.postprocessing import percentages
+from benchmarks.report import summarize
+
+
+conf = Configuration()
+
+
+def run(model, batches):
+    """Returns the outputs of the model for the batches and the latency
+    of each batch."""
+    outputs = []
+    latencies = []
+    with torch.inference_mode():
+        # the first pass is a warm-up and is not measured
+        model(batches[0][:1])
+        for batch in batches:
+            start = time.perf_counter()
+            outputs.append(model(batch))
+            latencies.append(time.perf_counter() - start)
+    return torch.cat(outputs), latencies
+
+
+def single_latency(model, tensor, iterations):
+    """Returns the latency summary of single image inferences."""
+    latencies = []
+    with torch.inference_mode():
+        for _ in range(iterations):
+            start = time.perf_counter()
+            model(tensor.unsqueeze(0))
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def compare_backend(model, reference, batches, args):
+    """Returns the parity and latency report of a model against the
+    eager reference outputs."""
+    outputs, latencies = run(model, batches)
+    expected = percentages(reference)
+    actual = percentages(outputs)
+    images = sum(len(batch) for batch in batches)
+    return {
+        "top1_agreement": (
+            (actual.argmax(dim=1) == expected.argmax(dim=1)).float().mean().item()
+        ),
+        "max_probability_diff": (actual - expected).abs().max().item() / 100,
+        "batch_ms_per_image": sum(latencies) * 1000 / images,
+        "single_image": single_latency(model, batches[0][0], args.iterations),
+    }
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+        conf.onnxruntime_intra_op_threads = args.threads
+    image_ids = catalogue.images()[: args.limit]
+    report = {}
+    failed = False
+    for model_id in args.models:
+        tensors = [preprocess_image(image_id, model_id) for image_id in image_ids]
+        batches = [
+            torch.stack(tensors[start : start + args.batch_size])
+            for start in range(0, len(tensors), args.batch_size)
+        ]
+        eager = build_model(model_id).eval()
+        reference, _ = run(eager, batches)
+        report[model_id] = {
+            "torch": compare_backend(eager, reference, batches, args)
+        }
+        del eager
+        for backend in args.backends:
+            try:
+                model, _ = load_exported(model_id, backend)
+            except (FileNotFoundError, ImportError) as e:
+                report[model_id][backend] = {"skipped": str(e)}
+                continue
+            result = compare_backend(model, reference, batches, args)
+            result["parity"] = (
+                result["top1_agreement"] >= args.min_agreement
+                and result["max_probability_diff"] <= args.max_diff
+            )
+            failed = failed or not result["parity"]
+            report[model_id][backend] = result
+            del model
+    print(json.dumps(report, indent=2))
+    return int(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument(
+        "--backends", nargs="+", choices=sorted(EXTENSIONS), default=sorted(EXTENSIONS)
+    )
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--min-agreement", type=float, default=0.99)
+    parser.add_argument(
+        "--max-diff",
+        type=float,
+        default=1e-3,
+        help="largest allowed difference of a class probability",
+    )
+    sys.exit(main(parser.parse_args()))
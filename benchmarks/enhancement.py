@@ -0,0 +1,112 @@
+"""
+This checks the OpenCV enhancement of the transformations against the
+sequential ImageEnhance passes of PIL it replaces, on the bundled
+imagenet_subset images and a grid of factors. For every combination it
+reports the largest difference of the pixel values and the share of the
+pixels differing by more than one level, together with the latency of
+both implementations. It exits with status 1 when a difference exceeds
+the tolerance.
+
+Run it from the repository root:
+
+    python -m benchmarks.enhancement --limit 6
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+from PIL import ImageEnhance
+
+from app.catalogue import catalogue
+from app.ml.transformation_utils import enhance_pixels, fetch_image
+from benchmarks.report import summarize
+
+
+ENHANCERS = (
+    ImageEnhance.Color,
+    ImageEnhance.Brightness,
+    ImageEnhance.Contrast,
+    ImageEnhance.Sharpness,
+)
+
+
+def pil_enhance(image, factors):
+    """Returns the pixels enhanced by the ImageEnhance passes."""
+    for enhancer, factor in zip(ENHANCERS, factors):
+        image = enhancer(image).enhance(factor)
+    return np.asarray(image)
+
+
+def timed_call(function, *args):
+    """Returns the result of the call and its latency."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def compare(images, args):
+    """Returns the parity and latency report over the grid of factors."""
+    grid = list(
+        itertools.product(args.color, args.brightness, args.contrast, args.sharpness)
+    )
+    failures = []
+    worst = {"max_diff": 0, "off_by_more_than_one": 0.0}
+    pil_latencies = []
+    latencies = []
+    for image_id, image in images:
+        pixels = np.asarray(image)
+        for factors in grid:
+            expected, elapsed = timed_call(pil_enhance, image, factors)
+            pil_latencies.append(elapsed)
+            actual, elapsed = timed_call(enhance_pixels, pixels, *factors)
+            latencies.append(elapsed)
+            diff = np.abs(expected.astype(np.int16) - actual.astype(np.int16))
+            max_diff = int(diff.max())
+            worst["max_diff"] = max(worst["max_diff"], max_diff)
+            worst["off_by_more_than_one"] = max(
+                worst["off_by_more_than_one"], float((diff > 1).mean())
+            )
+            if max_diff > args.tolerance:
+                failures.append(
+                    {"image_id": image_id, "factors": factors, "max_diff": max_diff}
+                )
+    return {
+        "combinations": len(images) * len(grid),
+        "parity": worst,
+        "failures": failures,
+        "pil": summarize(pil_latencies),
+        "opencv": summarize(latencies),
+    }
+
+
+def main(args):
+    """Runs the comparison and exits with status 1 on a parity failure."""
+    images = []
+    for image_id in catalogue.images()[: args.limit]:
+        with fetch_image(image_id) as img:
+            images.append((image_id, img.convert("RGB")))
+    report = compare(images, args)
+    print(json.dumps(report, indent=2))
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks the transformations against ImageEnhance."
+    )
+    parser.add_argument("--limit", type=int, default=6)
+    parser.add_argument("--color", nargs="+", type=float, default=[0.0, 0.5, 1.0, 1.6])
+    parser.add_argument("--brightness", nargs="+", type=float, default=[0.7, 1.0, 1.5])
+    parser.add_argument("--contrast", nargs="+", type=float, default=[0.6, 1.0, 1.8])
+    parser.add_argument("--sharpness", nargs="+", type=float, default=[0.5, 1.0, 2.0])
+    parser.add_argument(
+        "--tolerance",
+        type=int,
+        default=4,
+        help="largest difference of a pixel value allowed, in levels",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+"""
+This compares the inference options of the classification models on the
+bundled imagenet_subset images. For every variant it reports the top-1
+agreement with the eager fp32 model and the top-1 accuracy (accuracy
+drift), together with the latency per image and the RSS growth of the
+loaded model.
+
+Run it from the repository root:
+
+    python -m benchmarks.inference_options --models alexnet vgg16 --limit 200
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+
+import torch
+
+from app.catalogue import catalogue
+from app.config import Configuration
+from app.metrics import process_rss_bytes
+from app.ml.classification_utils import preprocess_image
+from app.ml.inference_options import inference_context, prepare_batch
+from app.ml.model_registry import load_model
+
+
+conf = Configuration()
+
+BASELINE = {"inference_mode": False, "channels_last": False, "quantize": False}
+
+VARIANTS = {
+    "inference_mode": {"inference_mode": True},
+    "channels_last": {"inference_mode": True, "channels_last": True},
+    "quantize": {"inference_mode": True, "quantize": True},
+    "jit": {"inference_mode": True, "compile": "jit"},
+    "quantize_jit": {"inference_mode": True, "quantize": True, "compile": "jit"},
+}
+
+
+def true_labels(image_ids):
+    """Returns the class index of the images, parsed from their names by
+    the catalogue index."""
+    return torch.tensor(
+        [catalogue.metadata(image_id)["label_id"] for image_id in image_ids]
+    )
+
+
+def run(model_id, options, batches):
+    """Returns the top-1 predictions, the latency per image and the RSS
+    growth of the model loaded with the given options."""
+    gc.collect()
+    rss_before = process_rss_bytes()
+    model = load_model(model_id, dict(BASELINE, **options))
+    rss = process_rss_bytes() - rss_before
+
+    predictions = []
+    elapsed = 0.0
+    with inference_context(options):
+        # the first pass is a warm-up and is not measured
+        model(prepare_batch(batches[0][:1], options))
+        for batch in batches:
+            start = time.perf_counter()
+            out = model(prepare_batch(batch, options))
+            elapsed += time.perf_counter() - start
+            predictions.append(out.argmax(dim=1))
+    del model
+    predictions = torch.cat(predictions)
+    return predictions, elapsed / len(predictions), rss
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # the accuracy is measured on the images whose class is known
+    image_ids = [
+        image_id
+        for image_id in catalogue.images()
+        if catalogue.metadata(image_id)["label_id"] is not None
+    ][: args.limit]
+    if not image_ids:
+        sys.exit("No image has a known label id, run app/prepare_images.py")
+    labels = true_labels(image_ids)
+
+    report = {}
+    for model_id in args.models:
+        tensors = [preprocess_image(image_id, model_id) for image_id in image_ids]
+        batches = [
+            torch.stack(tensors[i : i + args.batch_size])
+            for i in range(0, len(tensors), args.batch_size)
+        ]
+        reference, latency, rss = run(model_id, BASELINE, batches)
+        results = {
+            "eager": {
+                "top1_accuracy": (reference == labels).float().mean().item(),
+                "latency_ms": latency * 1000,
+                "rss_mb": rss / (1024 * 1024),
+            }
+        }
+        for name in args.variants:
+            predictions, latency, rss = run(model_id, VARIANTS[name], batches)
+            results[name] = {
+                "top1_accuracy": (predictions == labels).float().mean().item(),
+                "top1_agreement": (predictions == reference).float().mean().item(),
+                "latency_ms": latency * 1000,
+                "rss_mb": rss / (1024 * 1024),
+            }
+        report[model_id] = results
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the inference options of the models."
+    )
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument(
+        "--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS)
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""
+This is a load test that saturates the classification endpoint and
+measures meanwhile the latency of the cheap /info endpoint, which must
+stay low when the blocking work runs off the event loop.
+
+Run it from the repository root:
+
+    python -m benchmarks.info_latency --model resnet18 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from app.utils import list_images
+from benchmarks.report import percentile
+from main import app
+
+
+async def saturate(client, model_id, image_id, stop, statuses):
+    """Keeps posting classification requests until stopped."""
+    while not stop.is_set():
+        response = await client.post(
+            "/classifications", data={"image_id": image_id, "model_id": model_id}
+        )
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if response.status_code == 503:
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)) / 10)
+
+
+async def probe(client, duration, interval):
+    """Measures the latency of /info for the given duration."""
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        await client.get("/info")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def main(args):
+    image_id = list_images()[0]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # loads the model before measuring
+        await client.post(
+            "/classifications", data={"image_id": image_id, "model_id": args.model}
+        )
+        baseline = await probe(client, args.duration / 4, args.interval)
+
+        stop = asyncio.Event()
+        statuses = {}
+        load = [
+            asyncio.create_task(saturate(client, args.model, image_id, stop, statuses))
+            for _ in range(args.concurrency)
+        ]
+        await asyncio.sleep(0.5)
+        loaded = await probe(client, args.duration, args.interval)
+        stop.set()
+        await asyncio.gather(*load)
+
+    report = {}
+    for name, latencies in (("idle", baseline), ("saturated", loaded)):
+        report[name] = {
+            "requests": len(latencies),
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+    report["classification_statuses"] = statuses
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model", default="resnet18")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--interval", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,187 @@
+"""
+This is an in-process load generator for the web endpoints. It drives the
+FastAPI app through the ASGI transport, without any network, with a
+number of concurrent clients, and reports for every scenario the
+throughput, the latency percentiles, the status codes and the peak
+resident memory.
+
+Run it from the repository root:
+
+    python -m benchmarks.load --concurrency 8 --requests 200 --output base.json
+    python -m benchmarks.load --concurrency 8 --requests 200 --baseline base.json
+"""
+import argparse
+import asyncio
+import random
+import re
+import sys
+import time
+
+import httpx
+
+from app.config import Configuration
+from benchmarks.report import PeakRSS, add_report_arguments, finish, summarize
+
+
+SCENARIOS = ("classifications", "upload", "histogram", "transformation", "download_graph")
+
+
+def disable_caches():
+    """Turns off the result caches, so that every request does the work.
+    It must run before the app is imported. The precomputed predictions,
+    when present, are still used."""
+    Configuration.result_cache_size = 0
+    Configuration.histogram_cache_size = 0
+    Configuration.transformation_cache_mb = 0
+    Configuration.chart_cache_mb = 0
+    Configuration.tensor_cache_path = None
+
+
+async def scenario_request(name, client, args, image_ids, context):
+    """Returns the coroutine function sending the i-th request of the
+    scenario."""
+    rng = random.Random(0)
+
+    async def classification(i):
+        return await client.post(
+            "/classifications",
+            data={"image_id": image_ids[i % len(image_ids)], "model_id": args.model},
+        )
+
+    async def upload(i):
+        name, data = context["uploads"][i % len(context["uploads"])]
+        return await client.post(
+            "/upload",
+            data={"model_id": args.model},
+            files={"file_image": (name, data, "image/jpeg")},
+        )
+
+    async def histogram(i):
+        return await client.post(
+            "/histogram", data={"image_id": image_ids[i % len(image_ids)]}
+        )
+
+    async def transformation(i):
+        # random factors, so that the renders are not all served from the cache
+        factors = {
+            factor: round(rng.uniform(0.5, 2.0), 2)
+            for factor in ("color", "brightness", "contrast", "sharpness")
+        }
+        return await client.post(
+            "/transformation",
+            data=dict(factors, image_id=image_ids[i % len(image_ids)]),
+        )
+
+    async def download_graph(i):
+        result_ids = context["result_ids"]
+        return await client.get(
+            f"/download_graph/{result_ids[i % len(result_ids)]}",
+            params={"format": args.chart_format},
+        )
+
+    if name == "upload" and "uploads" not in context:
+        from app.ml.histogram_utils import image_path
+
+        context["uploads"] = []
+        for image_id in image_ids[:16]:
+            with open(image_path(image_id), "rb") as f:
+                context["uploads"].append((image_id, f.read()))
+    if name == "download_graph" and "result_ids" not in context:
+        context["result_ids"] = []
+        for i in range(min(len(image_ids), 16)):
+            page = (await classification(i)).text
+            context["result_ids"].append(
+                re.search(r"/download_graph/([\w-]+)", page).group(1)
+            )
+    return {
+        "classifications": classification,
+        "upload": upload,
+        "histogram": histogram,
+        "transformation": transformation,
+        "download_graph": download_graph,
+    }[name]
+
+
+async def run_scenario(send, concurrency, requests, duration):
+    """Sends the requests with concurrent clients until the number of
+    requests or the duration is reached. It returns the latencies, the
+    status codes, the wall clock time and the peak memory."""
+    latencies = []
+    statuses = {}
+    counter = iter(range(requests))
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def client():
+        for i in counter:
+            if deadline is not None and time.perf_counter() > deadline:
+                return
+            start = time.perf_counter()
+            try:
+                status = (await send(i)).status_code
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    async with PeakRSS() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, statuses, elapsed, rss.peak_mb
+
+
+async def main(args):
+    if args.disable_caches:
+        disable_caches()
+    from main import app
+    from app.catalogue import catalogue
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            image_ids = catalogue.images()[: args.images]
+            context = {}
+            for name in args.scenarios:
+                send = await scenario_request(name, client, args, image_ids, context)
+                # the first requests load the models and fill the pools
+                for i in range(args.warmup):
+                    await send(i)
+                latencies, statuses, elapsed, peak_mb = await run_scenario(
+                    send, args.concurrency, args.requests, args.duration
+                )
+                results[name] = dict(
+                    summarize(latencies, elapsed),
+                    statuses=statuses,
+                    peak_rss_mb=peak_mb,
+                )
+    return finish(
+        results,
+        args,
+        concurrency=args.concurrency,
+        model=args.model,
+        caches=not args.disable_caches,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--model", default="resnet18")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--duration", type=float, help="stops each scenario after these seconds"
+    )
+    parser.add_argument("--warmup", type=int, default=4)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--chart-format", default="png", choices=("png", "svg"))
+    parser.add_argument(
+        "--disable-caches",
+        action="store_true",
+        help="turns off the caches, so that the computation is measured",
+    )
+    add_report_arguments(parser)
+    sys.exit(asyncio.run(main(parser.parse_args())))
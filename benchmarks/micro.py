@@ -0,0 +1,147 @@
+"""
+This micro-benchmarks the functions of the ML pipelines one by one: the
+decoding and preprocessing of images of several sizes, the forward pass
+and the classification of each model, the histograms, the enhancement
+and the charts. Images of the requested sizes are synthesized, so the
+results do not depend on the catalogue.
+
+Run it from the repository root:
+
+    python -m benchmarks.micro --models resnet18 --sizes 256 1024 --output base.json
+    python -m benchmarks.micro --models resnet18 --sizes 256 1024 --baseline base.json
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from app.charts import render_histogram_chart, render_scores_chart
+from app.config import Configuration
+from app.ml.classification_utils import local_forward
+from app.ml.histogram_utils import channel_counts, read_image
+from app.ml.inference_options import input_size
+from app.ml.postprocessing import top_k
+from app.ml.preprocessing import crop, decode, normalize, preprocess_file
+from app.ml.transformation_utils import enhance_pixels
+from app.ml.upload_utils import uploaded_image
+from benchmarks.report import add_report_arguments, finish, summarize
+
+
+conf = Configuration()
+
+
+def synthetic_image(width, seed=0):
+    """Returns the JPEG bytes of a smooth image with some noise, whose
+    compression ratio is close to the one of a photograph."""
+    rng = np.random.default_rng(seed)
+    height = width * 3 // 4
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack(
+        (x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)),
+        axis=-1,
+    ).astype(np.int16)
+    pixels += rng.integers(-20, 20, pixels.shape, dtype=np.int16)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(
+        buffer, format="JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+def measure(fn, *args, iterations=20, warmup=2):
+    """Returns the latency summary of the function over the iterations."""
+    for _ in range(warmup):
+        fn(*args)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def cases(args, folder):
+    """Yields the name, the function and the arguments of each case."""
+    sizes = sorted({input_size(model_id) for model_id in args.models})
+    for width in args.sizes:
+        data = synthetic_image(width)
+        path = os.path.join(folder, "{}.jpg".format(width))
+        with open(path, "wb") as f:
+            f.write(data)
+        for size in sizes:
+            yield f"decode[{width}px,{size}]", decode, (path, size)
+            with decode(path, size) as img:
+                yield f"crop[{width}px,{size}]", crop, (img.copy(), size)
+            yield f"preprocess_file[{width}px,{size}]", preprocess_file, (path, size)
+        yield f"histogram_read_image[{width}px]", read_image, (path,)
+        img = read_image(path)
+        for space in ("rgb", "hsv", "luma"):
+            yield f"channel_counts[{width}px,{space}]", channel_counts, (img, 256, space)
+        pixels = np.asarray(Image.open(path).convert("RGB"))
+        yield f"enhance_pixels[{width}px]", enhance_pixels, (pixels, 1.3, 1.1, 1.2, 1.5)
+        for model_id in args.models:
+            yield f"uploaded_image[{model_id},{width}px]", uploaded_image, (
+                model_id,
+                data,
+            )
+
+    for size in sizes:
+        pixels = np.zeros((size, size, 3), dtype=np.uint8)
+        yield f"normalize[{size}]", normalize, (pixels,)
+    for model_id in args.models:
+        size = input_size(model_id)
+        for batch_size in args.batch_sizes:
+            batch = torch.randn(batch_size, 3, size, size)
+            yield f"forward[{model_id},batch={batch_size}]", local_forward, (
+                model_id,
+                batch,
+            )
+    for batch_size in args.batch_sizes:
+        yield f"top_k[batch={batch_size}]", top_k, (torch.randn(batch_size, 1000),)
+
+    scores = [["label {}".format(i), 50.0 / (i + 1)] for i in range(conf.top_k)]
+    histograms = {"blue": [1] * 256, "green": [2] * 256, "red": [3] * 256}
+    for image_format in ("png", "svg"):
+        yield f"scores_chart[{image_format}]", render_scores_chart, (
+            scores,
+            image_format,
+        )
+        yield f"histogram_chart[{image_format}]", render_histogram_chart, (
+            histograms,
+            image_format,
+        )
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, fn, fn_args in cases(args, folder):
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            results[name] = measure(
+                fn, *fn_args, iterations=args.iterations, warmup=args.warmup
+            )
+    return finish(results, args, torch_threads=torch.get_num_threads())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--models", nargs="+", default=list(conf.models))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 1024, 2048])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument(
+        "--only", nargs="+", help="runs the cases whose name contains a pattern"
+    )
+    add_report_arguments(parser)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,130 @@
+"""
+This contains the helpers shared by the benchmarks: latency summaries,
+peak memory sampling, and saving a report as a baseline to compare the
+following runs against.
+"""
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from app.metrics import process_rss_bytes
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of the values."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, round(q / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(latencies, elapsed=None):
+    """Returns the throughput and the latency percentiles, in ms, of the
+    measured latencies in seconds. The throughput is computed over the
+    wall clock time when given, since concurrent requests overlap."""
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    return {
+        "count": len(latencies),
+        "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+class PeakRSS:
+    """Samples the resident memory of the process in the background of
+    an asyncio block and keeps its peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_rss_bytes())
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self.peak = process_rss_bytes()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.peak = max(self.peak, process_rss_bytes())
+
+    @property
+    def peak_mb(self):
+        return self.peak / (1024 * 1024)
+
+
+def environment():
+    """Returns the description of the machine the benchmark ran on."""
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compares the results with the baseline, case by case. A case
+    regresses when its p50 latency grows, or its throughput drops, by
+    more than the tolerance."""
+    comparison = {}
+    for case, current in results.items():
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        p50 = current["p50_ms"] / previous["p50_ms"] - 1 if previous["p50_ms"] else 0.0
+        throughput = (
+            current["throughput_per_s"] / previous["throughput_per_s"] - 1
+            if previous["throughput_per_s"]
+            else 0.0
+        )
+        comparison[case] = {
+            "p50_change": p50,
+            "throughput_change": throughput,
+            "regression": p50 > tolerance or throughput < -tolerance,
+        }
+    return comparison
+
+
+def add_report_arguments(parser):
+    """Adds the options to save the report and compare it to a baseline."""
+    parser.add_argument("--output", help="saves the JSON report to this file")
+    parser.add_argument("--baseline", help="compares with a previous JSON report")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative change of p50 or throughput reported as a regression",
+    )
+
+
+def finish(results, args, **extra):
+    """Prints the report, saves it and compares it with the baseline. It
+    returns the exit status, 1 when a case regressed."""
+    report = dict(environment=environment(), results=results, **extra)
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        report["comparison"] = compare(results, baseline, args.tolerance)
+        status = int(any(case["regression"] for case in report["comparison"].values()))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return status
@@ -0,0 +1,77 @@
+"""
+This reports the cold start cost of the web process: the import time and
+the resident memory added by importing main and each heavy subsystem,
+every one measured in a fresh interpreter.
+
+Run it from the repository root:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --preload torch cv2
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ("torch", "torchvision", "cv2", "matplotlib")
+TARGETS = (
+    "main",
+    "app.ml.classification_service",
+    "app.ml.histogram_utils",
+    "app.ml.transformation_utils",
+    "app.charts",
+    "torch",
+    "torchvision",
+    "cv2",
+    "matplotlib.figure",
+)
+
+# runs in the fresh interpreter: imports the modules given as arguments
+MEASURE = """
+import importlib, json, sys, time
+from app.metrics import process_rss_bytes
+rss = process_rss_bytes()
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "rss_mb": (process_rss_bytes() - rss) / (1024 * 1024),
+    "heavy_modules": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure(modules, repeat):
+    """Returns the median import time and memory of the modules, over
+    several fresh interpreters."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE, *modules],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    runs.sort(key=lambda run: run["seconds"])
+    return runs[len(runs) // 2]
+
+
+def main(args):
+    report = {}
+    for target in args.targets:
+        report[target] = measure([target], args.repeat)
+    if args.preload:
+        report["main+preload"] = measure(["main", *args.preload], args.repeat)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS))
+    parser.add_argument(
+        "--preload", nargs="*", help="modules preloaded after importing main"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
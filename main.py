@@ -1,43 +1,275 @@
 import json
+import logging
 import os
-from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse
+import sys
+from fastapi import FastAPI, Request, Response, HTTPException
+import hashlib
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from datetime import datetime
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
 
+from app.catalogue import catalogue
+from app.charts import MEDIA_TYPES as CHART_MEDIA_TYPES, chart_cache, render_chart
 from app.config import Configuration
+from app.executor import Overloaded, executor
+from app.metrics import (
+    RequestTimer,
+    inferences,
+    process_rss_bytes,
+    render_gauge,
+    render_histogram,
+    request_seconds,
+    stage_seconds,
+    timed,
+)
+from app.job_handlers import job_queue
+from app.job_queue import FINISHED, JobError
 from app.forms.classification_form import ClassificationForm
-from app.ml.classification_utils import classify_image
-from app.utils import list_images
+from app.ml.classification_service import (
+    classify_catalogue_chunk,
+    classify_catalogue_image,
+    classify_upload,
+    classify_upload_chunk,
+    stream_batch,
+)
+from app.ml.embedding_index import (
+    embedding_index,
+    similar_to_catalogue_image,
+    similar_to_upload,
+)
+from app.ml.ensemble_utils import classify_ensemble
+from app.ml.inference_options import configure_threads
+from app.ml.inference_scheduler import scheduler
+from app.ml.model_registry import registry
+from app.ml.model_workers import model_workers
+from app.ml.postprocessing import label_table
+from app.ml.prediction_store import prediction_store
+from app.ml.preprocessing import tensor_cache
+from app.ml.result_cache import result_cache
+from app.ml.upload_utils import UnsupportedImage
+from app.scratch_store import scratch_store
+from app.result_store import result_store
+from app.thumbnails import (
+    MEDIA_TYPES as THUMBNAIL_MEDIA_TYPES,
+    SOURCES as THUMBNAIL_SOURCES,
+    thumbnail_store,
+    thumbnails,
+)
+from app.upload_ingest import close_files, ingest_upload
+from app.utils import preload_modules
+from app.schemas import (
+    AggregateHistogramRequest,
+    BatchClassificationRequest,
+    EnsembleClassificationRequest,
+    JobRequest,
+)
 from app.forms.histogram_form import HistogramForm
 from app.forms.transformation_form import TransformationForm
-from app.ml.histogram_utils import histogram
-from app.ml.transformation_utils import transform_image
-from app.ml.upload_utils import uploaded_image
-from fastapi.responses import JSONResponse, FileResponse
-import matplotlib.pyplot as plt
-import io
+from app.ml.histogram_utils import (
+    COLOR_SPACES,
+    apply_mode,
+    histogram_bytes,
+    histogram_engine,
+    histogram_payload,
+)
+from app.ml.transformation_utils import (
+    MEDIA_TYPES,
+    transformation_bytes,
+    transformation_cache,
+)
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 import asyncio
 
 
-app = FastAPI()
 config = Configuration()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Prepares the shared resources when the server starts."""
+    configure_threads()
+    if os.path.exists(os.path.join(config.image_folder_path, "imagenet_labels.json")):
+        label_table()
+    if config.preload_modules:
+        timings = await asyncio.to_thread(preload_modules, config.preload_modules)
+        logging.info("Preloaded modules in %.2fs", sum(timings.values()))
+    # the models served by inference processes, started here or by the
+    # model server, are never loaded here
+    await model_workers.start()
+    warmup_models = [
+        model_id
+        for model_id in config.warmup_models
+        if not model_workers.serves(model_id)
+    ]
+    if warmup_models:
+        await asyncio.to_thread(registry.warm_up, warmup_models)
+    await scratch_store.start()
+    await thumbnail_store.start()
+    await catalogue.start()
+    # the embedding matrices are memory-mapped, only the manifests are read
+    await asyncio.to_thread(embedding_index.load, config.models)
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await catalogue.stop()
+    await thumbnail_store.stop()
+    await scratch_store.stop()
+    await scheduler.close()
+    await model_workers.stop()
+    executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+if config.metrics_enabled:
+    app.add_middleware(RequestTimer)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """Asks the client to retry later when the server is saturated."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
-templates = Jinja2Templates(directory="app/templates")
+
+
+class TimedTemplates(Jinja2Templates):
+    """Records the rendering time of the pages."""
+
+    def TemplateResponse(self, *args, **kwargs):
+        with timed("render_template"):
+            return super().TemplateResponse(*args, **kwargs)
+
+
+templates = TimedTemplates(directory="app/templates")
 
 
 @app.get("/info")
 def info() -> dict[str, list[str]]:
     """Returns a dictionary with the list of models and
     the list of available image files."""
-    list_of_images = list_images()
+    list_of_images = catalogue.images()
     list_of_models = Configuration.models
     data = {"models": list_of_models, "images": list_of_images}
     return data
 
 
+@app.get("/stats")
+def stats() -> dict:
+    """Returns the runtime metrics of the service."""
+    return {
+        "models": registry.stats(),
+        "model_workers": model_workers.stats(),
+        "scheduler": scheduler.stats(),
+        "executor": executor.stats(),
+        "result_cache": result_cache.stats(),
+        "prediction_store": prediction_store.stats(),
+        "tensor_cache": tensor_cache.stats() if tensor_cache is not None else None,
+        "histograms": histogram_engine.stats(),
+        "transformations": transformation_cache.stats(),
+        "scratch_store": scratch_store.stats(),
+        "thumbnails": thumbnails.stats(),
+        "catalogue": catalogue.stats(),
+        "embeddings": embedding_index.stats(),
+        "charts": chart_cache.stats(),
+        "results": result_store.stats(),
+        "jobs": job_queue.stats(),
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    """Returns the metrics of the service in the Prometheus text format."""
+    if not config.metrics_enabled:
+        raise HTTPException(status_code=404, detail="The metrics are disabled")
+    lines = stage_seconds.render() + request_seconds.render() + inferences.render()
+    for name, description, histogram in (
+        (
+            "scheduler_queue_wait_seconds",
+            "Time spent by the images waiting for their batch.",
+            scheduler.queue_wait,
+        ),
+        ("scheduler_batch_size", "Size of the inference batches.", scheduler.batch_size),
+        ("job_wait_seconds", "Time spent by the jobs in the queue.", job_queue.wait_seconds),
+        ("job_run_seconds", "Duration of the jobs.", job_queue.run_seconds),
+    ):
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        lines += render_histogram(name, histogram)
+
+    caches = {
+        "models": registry.stats(),
+        "result_cache": result_cache.stats(),
+        "tensor_cache": tensor_cache.stats() if tensor_cache is not None else {},
+        "histograms": histogram_engine.stats(),
+        "transformations": transformation_cache.stats(),
+        "charts": chart_cache.stats(),
+    }
+    lines += render_gauge(
+        "cache_hit_ratio",
+        "Hit ratio of the caches since the start.",
+        [({"cache": name}, stats["hit_rate"]) for name, stats in caches.items() if stats],
+    )
+    queues = [
+        ({"queue": "scheduler", "model_id": model_id}, depth)
+        for model_id, depth in scheduler.stats()["queued"].items()
+    ]
+    queues.append(({"queue": "executor"}, executor.pending))
+    for lane, depth in job_queue.depth().items():
+        queues.append(({"queue": f"jobs_{lane}"}, depth["queued"]))
+    lines += render_gauge("queue_depth", "Work waiting in the queues.", queues)
+    lines += render_gauge(
+        "process_resident_memory_bytes",
+        "Resident memory of the web process.",
+        [({}, process_rss_bytes())],
+    )
+    lines += render_gauge(
+        "model_resident_bytes",
+        "Memory held by the models loaded in the web process.",
+        [({}, registry.resident_bytes())],
+    )
+    # torch is imported lazily, and not only to report its threads
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        lines += render_gauge(
+            "torch_threads",
+            "Threads used by torch.",
+            [
+                ({"kind": "intra_op"}, torch.get_num_threads()),
+                ({"kind": "inter_op"}, torch.get_num_interop_threads()),
+            ],
+        )
+    return PlainTextResponse(
+        "\n".join(lines) + "\n", media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/api/images")
+def search_images(
+    request: Request, prefix: str = "", offset: int = 0, limit: int | None = None
+):
+    """Returns a page of the catalogue images whose id starts with the
+    prefix, with their metadata. The ETag changes with the catalogue, so
+    clients can revalidate cheaply."""
+    limit = config.catalogue_page_size if limit is None else limit
+    if offset < 0 or not 0 < limit <= 1000:
+        raise HTTPException(status_code=400, detail="Invalid offset or limit")
+    total, page = catalogue.search(prefix, offset, limit)
+    query = f"{catalogue.version}:{prefix}:{offset}:{limit}"
+    etag = '"' + hashlib.sha256(query.encode()).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(
+        content={"total": total, "offset": offset, "limit": limit, "images": page},
+        headers=headers,
+    )
+
+
 @app.get("/", response_class=HTMLResponse)
 def home(request: Request):
     """The home page of the service."""
@@ -52,7 +284,6 @@ def create_classify(request: Request):
         "classification_select.html",
         {
             "request": request,
-            "images": list_images(),
             "models": Configuration.models,
             "active_page": "classifications",
         },
@@ -63,27 +294,324 @@ def create_classify(request: Request):
 async def request_classification(request: Request):
     form = ClassificationForm(request)
     await form.load_data()
+    if not form.is_valid():
+        return templates.TemplateResponse(
+            "classification_select.html",
+            {
+                "request": request,
+                "errors": form.errors,
+                "models": Configuration.models,
+                "active_page": "classifications",
+            },
+        )
     image_id = form.image_id
     model_id = form.model_id
-    classification_scores = classify_image(model_id=model_id, img_id=image_id)
+    if len(form.model_ids) > 1:
+        # fan-out mode: the image is classified by all the selected models
+        result = await classify_ensemble(form.model_ids, image_id, form.ensemble)
+        result["result_id"] = result_store.put("ensemble", result)
+        return templates.TemplateResponse(
+            "ensemble_output.html",
+            {
+                "request": request,
+                "image_id": image_id,
+                "result": result,
+                "active_page": "classifications",
+            },
+        )
+    classification_scores = await classify_catalogue_image(model_id, image_id)
+    result_id = result_store.put(
+        "classification",
+        {"image_id": image_id, "model_id": model_id, "scores": classification_scores},
+    )
     return templates.TemplateResponse(
         "classification_output.html",
         {
             "request": request,
             "image_id": image_id,
-            "classification_scores": json.dumps(classification_scores),
+            "result_id": result_id,
             "active_page": "classifications",
         },
     )
 
 
+def validate_batch(model_id, count):
+    """Checks the model and the size of a batch classification request."""
+    if model_id not in Configuration.models:
+        raise HTTPException(status_code=400, detail=f"Unknown model {model_id}")
+    if not 0 < count <= config.batch_max_images:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch must contain 1 to {config.batch_max_images} images",
+        )
+
+
+@app.post("/api/classifications/batch")
+async def batch_classification(body: BatchClassificationRequest):
+    """Classifies a list of catalogue images with a model, streaming one
+    NDJSON line per image as each chunk of images completes."""
+    validate_batch(body.model_id, len(body.image_ids))
+    unknown = {image_id for image_id in body.image_ids if image_id not in catalogue}
+    if unknown:
+        raise HTTPException(
+            status_code=404, detail=f"Unknown images: {', '.join(sorted(unknown))}"
+        )
+    return StreamingResponse(
+        stream_batch(
+            body.model_id, body.image_ids, classify_catalogue_chunk, body.image_ids
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.post("/api/upload/batch")
+async def batch_upload_classification(request: Request):
+    """Classifies several uploaded files with a model, streaming one
+    NDJSON line per file as each chunk of files completes."""
+    fields, uploaded_files = await ingest_upload(
+        request, max_files=config.batch_max_images
+    )
+    model_id = fields.get("model_id", [None])[0]
+    try:
+        validate_batch(model_id, len(uploaded_files))
+    except HTTPException:
+        close_files(uploaded_files)
+        raise
+    names = [uploaded_file.filename for uploaded_file in uploaded_files]
+    return StreamingResponse(
+        stream_batch(model_id, names, classify_upload_chunk, uploaded_files),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(close_files, uploaded_files),
+    )
+
+
+@app.post("/api/classifications/ensemble")
+async def ensemble_classification(body: EnsembleClassificationRequest):
+    """Classifies a catalogue image with several models at once, returning
+    the per-model scores and latencies and the optional ensemble scores."""
+    unknown = set(body.model_ids).difference(Configuration.models)
+    if not body.model_ids or unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid models: {', '.join(sorted(unknown))}"
+        )
+    if body.image_id not in catalogue:
+        raise HTTPException(status_code=404, detail=f"Unknown image {body.image_id}")
+    result = await classify_ensemble(body.model_ids, body.image_id, body.ensemble)
+    result["result_id"] = result_store.put("ensemble", result)
+    return result
+
+
+def validate_similarity(model_id, k):
+    """Checks the model and the number of results of a similarity query."""
+    if model_id not in Configuration.models:
+        raise HTTPException(status_code=400, detail=f"Unknown model {model_id}")
+    if not 1 <= k <= config.similar_images_max_k:
+        raise HTTPException(
+            status_code=400,
+            detail=f"k must be between 1 and {config.similar_images_max_k}",
+        )
+
+
+def similarity_response(model_id, results, extra=None):
+    """Returns the similar images, or 404 when the embedding index of the
+    model was not built."""
+    if results is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No embedding index for {model_id}, "
+            "build it with python -m app.build_embedding_index",
+        )
+    return dict(
+        extra or {},
+        model_id=model_id,
+        results=[
+            {"image_id": image_id, "score": score} for image_id, score in results
+        ],
+    )
+
+
+@app.get("/api/similar/{image_id}")
+async def similar_images(image_id: str, model_id: str, k: int = config.similar_images_k):
+    """Returns the catalogue images most similar to a catalogue image,
+    by cosine similarity of their embeddings."""
+    validate_similarity(model_id, k)
+    metadata = catalogue.metadata(image_id)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f"Unknown image {image_id}")
+    results = await similar_to_catalogue_image(
+        model_id, image_id, metadata["sha256"], k
+    )
+    return similarity_response(model_id, results, {"image_id": image_id})
+
+
+def unsupported_image(uploaded_file):
+    """Returns the error of an uploaded file that passed the format
+    sniffing but cannot be decoded."""
+    return HTTPException(
+        status_code=415, detail=f"{uploaded_file.filename} is not a supported image"
+    )
+
+
+@app.post("/api/similar/upload")
+async def similar_uploaded_images(request: Request):
+    """Returns the catalogue images most similar to an uploaded image, by
+    cosine similarity of their embeddings."""
+    fields, uploaded_files = await ingest_upload(request)
+    try:
+        model_id = fields.get("model_id", [None])[0]
+        try:
+            k = int(fields.get("k", [config.similar_images_k])[0])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="k must be an integer")
+        validate_similarity(model_id, k)
+        uploaded_file = next(
+            (f for f in uploaded_files if f.field_name == "file_image"), None
+        )
+        if uploaded_file is None:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+        try:
+            results = await similar_to_upload(model_id, uploaded_file.file, k)
+        except UnsupportedImage:
+            raise unsupported_image(uploaded_file)
+    finally:
+        close_files(uploaded_files)
+    return similarity_response(model_id, results)
+
+
+def job_accepted(job_id):
+    """Returns the 202 response of a submitted job."""
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/api/jobs/{job_id}",
+            "events_url": f"/api/jobs/{job_id}/events",
+        },
+        headers={"Location": f"/api/jobs/{job_id}"},
+    )
+
+
+@app.post("/api/jobs")
+async def submit_job(body: JobRequest):
+    """Queues a classification, batch classification or transformation
+    job and returns its id immediately."""
+    if body.kind == "upload_classification":
+        # the file and its digest come from the upload, never from the client
+        raise HTTPException(
+            status_code=400, detail="Upload jobs are submitted to /api/jobs/upload"
+        )
+    try:
+        job_id = await asyncio.to_thread(
+            job_queue.submit,
+            body.kind,
+            body.params,
+            body.lane,
+            body.priority,
+            body.timeout,
+        )
+    except JobError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return job_accepted(job_id)
+
+
+@app.post("/api/jobs/upload")
+async def submit_upload_job(request: Request):
+    """Queues the classification of an uploaded file. The file waits for
+    its job in the scratch storage."""
+    fields, uploaded_files = await ingest_upload(request)
+    try:
+        uploaded_file = next(
+            (f for f in uploaded_files if f.field_name == "file_image"), None
+        )
+        if uploaded_file is None:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+        image_id = await executor.run(
+            scratch_store.put_file,
+            uploaded_file.file,
+            uploaded_file.digest,
+            "." + uploaded_file.image_format,
+        )
+    finally:
+        close_files(uploaded_files)
+    params = {
+        "model_id": fields.get("model_id", [None])[0],
+        "image_id": image_id,
+        "digest": uploaded_file.digest,
+    }
+    try:
+        job_id = await asyncio.to_thread(
+            job_queue.submit,
+            "upload_classification",
+            params,
+            fields.get("lane", ["interactive"])[0],
+            int(fields.get("priority", [0])[0]),
+        )
+    except (JobError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return job_accepted(job_id)
+
+
+async def get_job_or_404(job_id):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+@app.get("/api/jobs/{job_id}")
+async def read_job(job_id: str):
+    """Returns the status, the progress and the result of a job."""
+    return await get_job_or_404(job_id)
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Streams the changes of a job as Server-Sent Events, until it
+    finishes."""
+    await get_job_or_404(job_id)
+
+    async def events():
+        last = None
+        while True:
+            changed = job_queue.next_change()
+            job = await asyncio.to_thread(job_queue.get, job_id)
+            if job is None:
+                return
+            state = (job["status"], job["progress"])
+            if state != last:
+                last = state
+                yield f"event: {job['status']}\ndata: {json.dumps(job)}\n\n"
+            if job["status"] in FINISHED:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), config.job_heartbeat_seconds)
+            except asyncio.TimeoutError:
+                # keeps the connection open through the proxies
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancels a queued or running job."""
+    await get_job_or_404(job_id)
+    if not await job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is finished")
+    return {"job_id": job_id, "status": "cancelled"}
+
+
 @app.get("/histogram")
 def create_histogram(request: Request):
     return templates.TemplateResponse(
         "histogram_select.html",
         {
             "request": request,
-            "images": list_images(),
             "models": Configuration.models,
             "active_page": "histogram",
         },
@@ -94,104 +622,281 @@ def create_histogram(request: Request):
 async def request_histogram(request: Request):
     form = HistogramForm(request)
     await form.load_data()
+    if not form.is_valid():
+        return templates.TemplateResponse(
+            "histogram_select.html",
+            {
+                "request": request,
+                "errors": form.errors,
+                "models": Configuration.models,
+                "active_page": "histogram",
+            },
+        )
     image_id = form.image_id
-    hist_b, hist_g, hist_r = histogram(image_id)
+    # the page fetches the binary histograms, which are computed and
+    # memoized here so that loading errors surface on this request
+    counts = await executor.run(histogram_engine.counts, image_id)
+    result_id = store_histogram(image_id, counts, "rgb")
     return templates.TemplateResponse(
         "histogram_output.html",
         {
             "request": request,
             "image_id": image_id,
-            "histogram_blue": json.dumps(hist_b),
-            "histogram_green": json.dumps(hist_g),
-            "histogram_red": json.dumps(hist_r),
+            "result_id": result_id,
             "active_page": "histogram",
         },
     )
 
 
+def store_histogram(image_id, histograms, space):
+    """Stores the histograms of the image and returns the result id."""
+    payload = dict(histogram_payload(histograms, space), image_id=image_id)
+    return result_store.put("histogram", payload)
+
+
+def histogram_response(histograms, space, output_format, extra=None):
+    """Returns the histograms as JSON, or as binary data described by
+    the X-Histogram-* headers."""
+    if output_format == "binary":
+        names, _ = COLOR_SPACES[space]
+        return Response(
+            content=histogram_bytes(histograms),
+            media_type="application/octet-stream",
+            headers={
+                "X-Histogram-Channels": ",".join(names),
+                "X-Histogram-Bins": str(histograms.shape[1]),
+                "X-Histogram-Dtype": "uint32"
+                if histograms.dtype.kind in "ui"
+                else "float32",
+            },
+        )
+    return dict(histogram_payload(histograms, space), **(extra or {}))
+
+
+def validate_histogram(bins, space):
+    """Checks the parameters of a histogram request."""
+    if space not in COLOR_SPACES:
+        raise HTTPException(status_code=400, detail=f"Unknown color space {space}")
+    if not 1 <= bins <= 256:
+        raise HTTPException(status_code=400, detail="bins must be between 1 and 256")
+
+
+@app.get("/api/histograms/{image_id}")
+async def get_histogram(
+    image_id: str,
+    bins: int = 256,
+    space: str = "rgb",
+    normalized: bool = False,
+    cumulative: bool = False,
+    format: str = "json",
+):
+    """Returns the histograms of a catalogue image."""
+    validate_histogram(bins, space)
+    if image_id not in catalogue:
+        raise HTTPException(status_code=404, detail=f"Unknown image {image_id}")
+    counts = await executor.run(histogram_engine.counts, image_id, bins, space)
+    histograms = apply_mode(counts, normalized, cumulative)
+    if format == "binary":
+        return histogram_response(histograms, space, format)
+    result_id = store_histogram(image_id, histograms, space)
+    return histogram_response(
+        histograms, space, format, {"image_id": image_id, "result_id": result_id}
+    )
+
+
+@app.post("/api/histograms/aggregate")
+async def aggregate_histogram(body: AggregateHistogramRequest, format: str = "json"):
+    """Returns the histograms summed over a list of catalogue images, or
+    over the whole catalogue."""
+    validate_histogram(body.bins, body.space)
+    image_ids = catalogue.images() if body.image_ids is None else body.image_ids
+    unknown = {image_id for image_id in image_ids if image_id not in catalogue}
+    if unknown:
+        raise HTTPException(
+            status_code=404, detail=f"Unknown images: {', '.join(sorted(unknown))}"
+        )
+    counts = await executor.run(
+        histogram_engine.aggregate, image_ids, body.bins, body.space
+    )
+    histograms = apply_mode(counts, body.normalized, body.cumulative)
+    return histogram_response(
+        histograms, body.space, format, {"images": len(image_ids)}
+    )
+
+
 @app.get("/transformation")
 def create_transformation(request: Request):
     return templates.TemplateResponse(
         "transformation_select.html",
         {
             "request": request,
-            "images": list_images(),
             "models": Configuration.models,
             "active_page": "transformation",
         },
     )
 
 @app.post("/transformation")
-async def request_transformation(request: Request, background_tasks: BackgroundTasks):
+async def request_transformation(request: Request):
     form = TransformationForm(request)
     await form.load_data()
+    if not form.is_valid():
+        return templates.TemplateResponse(
+            "transformation_select.html",
+            {
+                "request": request,
+                "errors": form.errors,
+                "models": Configuration.models,
+                "active_page": "transformation",
+            },
+        )
     image_id = form.image_id
-    color = form.color
-    brightness = form.brightness
-    contrast = form.contrast
-    sharpness = form.sharpness
-    image_enhanced_id=transform_image(image_id, color, brightness, contrast, sharpness)
-
-    # Delete the file after 30 seconds
-    image_enhanced_path=f"app/static/enhanced_images/{image_enhanced_id}"
-    background_tasks.add_task(delete_file_after_delay, image_enhanced_path)
+    factors = {
+        "color": form.color,
+        "brightness": form.brightness,
+        "contrast": form.contrast,
+        "sharpness": form.sharpness,
+    }
+    # renders the transformation now, so that the errors surface on this
+    # request and the download is served from the in-memory cache
+    await transformation_bytes(image_id, **factors)
+    result_id = result_store.put(
+        "transformation", dict(factors, image_id=image_id)
+    )
 
     return templates.TemplateResponse(
         "transformation_output.html",
         {
             "request": request,
             "image_id": image_id,
-            "image_enhanced_id": image_enhanced_id,
+            "result_id": result_id,
             "active_page": "transformation",
         },
     )
 
-@app.get("/download_json")
-async def download_json(classification_scores: str):
-    try:
 
-        scores = json.loads(classification_scores)
+@app.get("/api/transformations/{image_id}")
+async def get_transformation(
+    image_id: str,
+    color: float = 1.0,
+    brightness: float = 1.0,
+    contrast: float = 1.0,
+    sharpness: float = 1.0,
+    size: int | None = None,
+    format: str = "jpeg",
+):
+    """Returns the enhanced image, optionally downscaled to fit size for
+    interactive previews, encoded as JPEG, PNG or WebP."""
+    image_format = format.upper()
+    if image_format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    if not all(0 <= factor <= 10 for factor in (color, brightness, contrast, sharpness)):
+        raise HTTPException(status_code=400, detail="Factors must be between 0 and 10")
+    if size is not None and not 16 <= size <= 4096:
+        raise HTTPException(status_code=400, detail="size must be between 16 and 4096")
+    if image_id not in catalogue:
+        raise HTTPException(status_code=404, detail=f"Unknown image {image_id}")
+    data = await transformation_bytes(
+        image_id, color, brightness, contrast, sharpness, size, image_format
+    )
+    return Response(
+        content=data,
+        media_type=MEDIA_TYPES[image_format],
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
 
-        return JSONResponse(
-            content=scores,
-            headers={
-                "Content-Disposition": "attachment; filename=classification_scores.json"
-            },
-        )
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON data")
+@app.get("/thumbnails/{source}/{name}")
+async def get_thumbnail(
+    request: Request, source: str, name: str, size: str = "medium", format: str = "jpeg"
+):
+    """Returns a downscaled copy of a catalogue image, an uploaded file or
+    a transformation result, with a strong ETag for revalidation."""
+    if size not in config.thumbnail_sizes:
+        raise HTTPException(status_code=400, detail=f"Unknown size {size}")
+    if format not in THUMBNAIL_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    locate = THUMBNAIL_SOURCES.get(source)
+    image_source = None if locate is None else locate(name)
+    if image_source is None:
+        raise HTTPException(status_code=404, detail=f"Unknown image {name}")
+    etag = thumbnails.etag(image_source, size, format)
+    headers = {"ETag": etag, "Cache-Control": image_source.cache_control}
+    if thumbnails.revalidated(etag, request.headers.get("if-none-match", "")):
+        return Response(status_code=304, headers=headers)
+    data = await thumbnails.get(image_source, size, format)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"Unknown image {name}")
+    return Response(
+        content=data, media_type=THUMBNAIL_MEDIA_TYPES[format], headers=headers
+    )
 
-@app.get("/download_graph")
-async def download_graph(classification_scores: str):
-    try:
-        scores = json.loads(classification_scores)
 
-        labels = [item[0] for item in scores]
-        data = [item[1] for item in scores]
+async def get_result(result_id, kinds):
+    """Returns the stored result, or raises 404 if it is unknown, expired
+    and not recreated from a job, or of another kind."""
+    result = result_store.get(result_id)
+    if result is None:
+        result = await asyncio.to_thread(result_store.recreate, result_id)
+    if result is None or result.kind not in kinds:
+        raise HTTPException(status_code=404, detail=f"Unknown result {result_id}")
+    return result
 
-        plt.barh(
-            labels, data, color=["#1a4a04", "#750014", "#795703", "#06216c", "#3f0355"]
-        )
-        plt.grid()
-        plt.title("Classification Scores")
 
-        plt.gca().invert_yaxis()
+@app.get("/api/results/{result_id}")
+async def read_result(result_id: str):
+    """Returns a stored result."""
+    result = await get_result(
+        result_id, ("classification", "ensemble", "histogram", "transformation")
+    )
+    return dict(result.payload, kind=result.kind, result_id=result_id)
+
+
+@app.get("/download_json/{result_id}")
+async def download_json(result_id: str):
+    result = await get_result(result_id, ("classification", "ensemble", "histogram"))
+    if result.kind == "classification":
+        content, filename = result.payload["scores"], "classification_scores"
+    else:
+        content, filename = result.payload, f"{result.kind}_result"
+    return JSONResponse(
+        content=content,
+        headers={"Content-Disposition": f"attachment; filename={filename}.json"},
+    )
 
-        img_buf = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(img_buf, format="png")
-        img_buf.seek(0)
-        plt.close()
 
-        return Response(
-            content=img_buf.getvalue(),
-            media_type="image/png",
-            headers={
-                "Content-Disposition": "attachment; filename=classification_graph.png"
-            },
-        )
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON data")
+@app.get("/download_graph/{result_id}")
+async def download_graph(result_id: str, format: str = "png"):
+    """Returns the chart of a classification or histogram result, rendered
+    once per payload and format."""
+    if format not in CHART_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    result = await get_result(result_id, ("classification", "histogram"))
+    if result.kind == "classification":
+        kind, payload = "scores", result.payload["scores"]
+        filename = "classification_graph"
+    else:
+        kind, payload = "histogram", result.payload["histograms"]
+        filename = "histogram_graph"
+    data = await render_chart(kind, payload, format)
+    return Response(
+        content=data,
+        media_type=CHART_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{format}"},
+    )
+
+
+@app.get("/download_image/{result_id}")
+async def download_image(result_id: str):
+    """Returns the image of a transformation result."""
+    result = await get_result(result_id, ("transformation",))
+    factors = dict(result.payload)
+    image_id = factors.pop("image_id")
+    data = await transformation_bytes(image_id, **factors)
+    return Response(
+        content=data,
+        media_type=MEDIA_TYPES["JPEG"],
+        headers={"Content-Disposition": "attachment; filename=transformation.jpeg"},
+    )
+
 
 @app.get("/upload")
 def create_classify(request: Request):
@@ -199,7 +904,6 @@ def create_classify(request: Request):
         "upload_select.html",
         {
             "request": request,
-            "images": list_images(),
             "models": Configuration.models,
             "active_page": "upload",
         },
@@ -207,52 +911,62 @@ def create_classify(request: Request):
 
 
 @app.post("/upload")
-async def classify_uploaded_image(request: Request, background_tasks: BackgroundTasks):
-    form = await request.form()
-    uploaded_file = form.get("file_image")
-    model_id = form.get("model_id")
-
-    #Add the timestamp to the filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    uploaded_file.filename = f"{uploaded_file.filename}_{timestamp}"
+async def classify_uploaded_image(request: Request):
+    # the body is streamed with a size limit, hashed and sniffed on the fly
+    fields, uploaded_files = await ingest_upload(request)
+    model_id = fields.get("model_id", [None])[0]
+    uploaded_file = next(
+        (f for f in uploaded_files if f.field_name == "file_image"), None
+    )
 
+    errors = []
     if not uploaded_file:
+        errors.append("No file uploaded")
+    if model_id not in Configuration.models:
+        errors.append("A valid model id is required")
+    if errors:
+        close_files(uploaded_files)
         return templates.TemplateResponse(
-            "error.html",
+            "upload_select.html",
             {
                 "request": request,
-                "error": "No file uploaded",
+                "errors": errors,
+                "models": Configuration.models,
                 "active_page": "upload",
             },
         )
 
-    upload_dir = "app/static/uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_location = f"{upload_dir}/{uploaded_file.filename}"
-
-    file_data = await uploaded_file.read()
-
-    with open(file_location, "wb") as output_file:
-        output_file.write(file_data)
-
-    classification_scores = uploaded_image(model_id=model_id, img_data=file_data)
-
-    # Delete the file after 30 seconds
-    background_tasks.add_task(delete_file_after_delay, file_location)
+    try:
+        try:
+            classification_scores = await classify_upload(
+                model_id, uploaded_file.file, uploaded_file.digest
+            )
+        except UnsupportedImage:
+            raise unsupported_image(uploaded_file)
+
+        image_id = None
+        if config.upload_persist:
+            # the file is named after its content, and removed by the sweeper
+            suffix = "." + uploaded_file.image_format
+            image_id = await executor.run(
+                scratch_store.put_file,
+                uploaded_file.file,
+                uploaded_file.digest,
+                suffix,
+            )
+    finally:
+        close_files(uploaded_files)
+    result_id = result_store.put(
+        "classification",
+        {"image_id": image_id, "model_id": model_id, "scores": classification_scores},
+    )
 
     return templates.TemplateResponse(
         "upload_output.html",
         {
             "request": request,
-            "image_id": uploaded_file.filename,
-            "classification_scores": json.dumps(classification_scores),
+            "image_id": image_id,
+            "result_id": result_id,
             "active_page": "upload",
         },
     )
-
-
-async def delete_file_after_delay(filepath: str, delay: int = 30):
-    await asyncio.sleep(delay)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-